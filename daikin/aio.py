@@ -0,0 +1,287 @@
+import sys
+import asyncio
+import threading
+from io import BytesIO
+from urllib.parse import unquote
+import logging
+
+import paho.mqtt.client as mqtt
+logger = logging.getLogger(__name__)
+
+# idle keep-alive connections are closed after this many seconds
+HTTP_KEEPALIVE_TIMEOUT = 15
+# a request's headers, then its body, must each arrive within this many
+# seconds
+HTTP_HEADER_TIMEOUT = 10
+HTTP_BODY_TIMEOUT = 10
+HTTP_MAX_HEADERS = 100
+HTTP_MAX_BODY = 64 * 1024
+
+REASONS = {
+    400: 'Bad Request',
+    408: 'Request Timeout',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+    501: 'Not Implemented',
+}
+
+
+class WSGIServer:
+    """
+        A small HTTP/1.1 server on an asyncio loop that runs a WSGI app
+        (server.app) on the loop itself
+
+        The app's views only read and hand states to the controller's
+        workers so they're cheap enough to call inline, nothing here blocks
+        on the IR emitter. Connections are kept alive between requests.
+    """
+
+    def __init__(self, app, host='0.0.0.0', port=5000):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.server = None
+        self.connections = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host,
+                                                 self.port)
+        # the real port when asked for port 0
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        # idle keep-alive connections
+        for task in list(self.connections):
+            task.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+
+    async def handle(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            while await self._handle_request(reader, writer):
+                pass
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                ConnectionError):
+            pass
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    async def _handle_request(self, reader, writer):
+        """
+        Serves one request, returns whether the connection stays open
+        """
+        request_line = await asyncio.wait_for(reader.readline(),
+                                              HTTP_KEEPALIVE_TIMEOUT)
+        if not request_line:
+            return False
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            await self._error(writer, 400)
+            return False
+
+        try:
+            headers = await asyncio.wait_for(self._read_headers(reader),
+                                             HTTP_HEADER_TIMEOUT)
+        except asyncio.TimeoutError:
+            await self._error(writer, 408)
+            return False
+        if headers is None:
+            await self._error(writer, 400)
+            return False
+        header_map = dict(headers)
+        if 'transfer-encoding' in header_map:
+            # only Content-Length bodies are read, the rest of a chunked
+            # body would be taken for the next request
+            await self._error(writer, 501)
+            return False
+
+        try:
+            length = int(header_map.get('content-length', 0))
+        except ValueError:
+            await self._error(writer, 400)
+            return False
+        if length > HTTP_MAX_BODY:
+            await self._error(writer, 413)
+            return False
+        try:
+            body = (await asyncio.wait_for(reader.readexactly(length),
+                                           HTTP_BODY_TIMEOUT)
+                    if length else b'')
+        except asyncio.TimeoutError:
+            await self._error(writer, 408)
+            return False
+
+        keep_alive = (version == 'HTTP/1.1'
+                      and header_map.get('connection', '').lower() != 'close')
+        environ = self._environ(method, target, version, headers, body,
+                                writer.get_extra_info('peername'))
+        status, response_headers, content = self._call_app(environ)
+        self._write_response(writer, status, response_headers, content,
+                             keep_alive)
+        await writer.drain()
+        return keep_alive
+
+    async def _read_headers(self, reader):
+        """
+        (name, value) pairs, None if there are more than HTTP_MAX_HEADERS
+        """
+        headers = []
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                return headers
+            if len(headers) == HTTP_MAX_HEADERS:
+                return None
+            name, _, value = line.decode('latin-1').partition(':')
+            headers.append((name.strip().lower(), value.strip()))
+
+    def _environ(self, method, target, version, headers, body, peer):
+        path, _, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path, 'latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': peer[0] if peer else '',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers:
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'content-length':
+                key = 'HTTP_{}'.format(name.upper().replace('-', '_'))
+                if key in environ:
+                    value = '{},{}'.format(environ[key], value)
+                environ[key] = value
+        return environ
+
+    def _call_app(self, environ):
+        response = {}
+        chunks = []
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+            return chunks.append
+
+        try:
+            result = self.app(environ, start_response)
+            try:
+                chunks.extend(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception:
+            logger.exception('Error handling {} {}'.format(
+                environ['REQUEST_METHOD'], environ['PATH_INFO']))
+            return '500 Internal Server Error', [], b''
+        return response['status'], response['headers'], b''.join(chunks)
+
+    def _write_response(self, writer, status, headers, content, keep_alive):
+        lines = ['HTTP/1.1 {}'.format(status)]
+        for name, value in headers:
+            if name.lower() not in ('content-length', 'connection'):
+                lines.append('{}: {}'.format(name, value))
+        lines.append('Content-Length: {}'.format(len(content)))
+        lines.append('Connection: {}'.format(
+            'keep-alive' if keep_alive else 'close'))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        writer.write(content)
+
+    async def _error(self, writer, code):
+        self._write_response(writer, '{} {}'.format(code, REASONS[code]), [],
+                             b'', False)
+        await writer.drain()
+
+
+class AsyncioMQTT:
+    """
+        Drives a paho client from an asyncio loop instead of paho's own
+        network thread
+
+        The client's socket is watched by the loop (paho's external event
+        loop callbacks) and keepalives run from a task. Callbacks
+        (on_connect, on_message) then run on the loop, and publishes from
+        other threads (eg. the transmitter) are handed over to it.
+    """
+
+    def __init__(self, client, loop=None, reconnect_delay=5):
+        self.client = client
+        self.loop = loop or asyncio.get_event_loop()
+        self.reconnect_delay = reconnect_delay
+        self.loop_thread = None
+        self.stopping = False
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self._call(self.loop.add_reader, sock, client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self._call(self.loop.remove_reader, sock)
+        self._call(self.loop.remove_writer, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._call(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self.loop.remove_writer, sock)
+
+    def call_soon(self, func, *args):
+        """
+        Runs func on the loop, from any thread
+        """
+        self._call(func, *args)
+
+    async def run(self, host, port=1883, keepalive=60):
+        """
+        Connects and keeps the client connected until stop()
+        """
+        self.loop_thread = threading.get_ident()
+        while not self.stopping:
+            try:
+                # the DNS lookup and TCP handshake block, run them off the
+                # loop (the socket callbacks hand themselves back to it)
+                await self.loop.run_in_executor(None, self.client.connect,
+                                                host, port, keepalive)
+            except (OSError, ValueError) as e:
+                logger.warning('MQTT connection to {}:{} failed: {}'.format(
+                    host, port, e))
+            else:
+                if self.stopping:
+                    # stop() came while connecting
+                    self.client.disconnect()
+                while (not self.stopping
+                       and self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS):
+                    await asyncio.sleep(1)
+            if not self.stopping:
+                await asyncio.sleep(self.reconnect_delay)
+
+    def stop(self):
+        self.stopping = True
+        self.client.disconnect()
+
+    def _call(self, func, *args):
+        if threading.get_ident() == self.loop_thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
@@ -0,0 +1,284 @@
+"""
+Decodes large IR captures in bulk with NumPy, for offline analysis of
+recorded remote traffic (decoder.py follows a live receiver one duration
+at a time)
+
+    python -m daikin.batch_decoder CAPTURE [--eps N] [--aeps N]
+    python -m daikin.batch_decoder --benchmark [--messages N]
+
+A capture is a flat array of alternating mark/space durations in
+microseconds starting with a mark: a .npy file, or raw native unsigned 32
+bit values (eg. durations read from a LIRC device with the mode2 flag bits
+stripped). Either is memory-mapped and decoded a chunk at a time.
+
+Every duration is classified against the timings at once, frames start at
+a header and run until the first duration that isn't a bit, and their bits
+are packed least significant bit first into bytes with np.packbits. The
+result is a table with one row per third frame: where it starts, whether
+its header and checksum are valid, and its fields as DaikinState has them
+(enums as their values).
+"""
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from .daikin import (AC_MODE, FAN_MODE, TIMER_MODE, DaikinLIRC,
+                     DaikinMessage, DaikinState)
+from .decoder import (AEPS, EPS, FRAME_ONE_ID, FRAME_THREE_ID, HEADER,
+                      LONG_FRAME_LENGTH, SHORT_FRAME_LENGTH, DaikinDecoder)
+
+# durations decoded per chunk, frames starting near the end of one are
+# decoded again from the next one
+CHUNK_SIZE = 1 << 22
+_OVERLAP = 2 * (2 + 8 * LONG_FRAME_LENGTH)
+
+FRAME_DTYPE = np.dtype([
+    ('position', np.int64),
+    ('length', np.uint8),
+    ('valid', np.bool_),
+    ('data', np.uint8, (LONG_FRAME_LENGTH, )),
+])
+
+STATE_DTYPE = np.dtype([
+    ('position', np.int64),
+    ('valid', np.bool_),
+    ('power', np.bool_),
+    ('temperature', np.uint8),
+    ('ac_mode', np.uint8),
+    ('fan_mode', np.uint8),
+    ('swing_vertical', np.bool_),
+    ('swing_horizontal', np.bool_),
+    ('economy', np.bool_),
+    ('comfort', np.bool_),
+    ('powerful', np.bool_),
+    ('timer', np.uint8),
+    ('timer_duration', np.uint16),
+])
+
+
+def load_capture(path):
+    """
+    The durations in a capture file, memory-mapped
+    """
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    return np.memmap(path, dtype=np.uint32, mode='r')
+
+
+def _matches(durations, nominal, eps, aeps):
+    return np.abs(durations - nominal) <= max(nominal * eps / 100, aeps)
+
+
+def _decode_chunk(durations, eps, aeps, timings):
+    marks = durations[0::2]
+    # a trailing mark has no space, 0 matches nothing
+    spaces = np.zeros(len(marks), dtype=np.int64)
+    spaces[:len(durations) // 2] = durations[1::2]
+
+    is_header = (_matches(marks, timings.FRAME_HEADER_PULSE, eps, aeps)
+                 & _matches(spaces, timings.FRAME_HEADER_GAP, eps, aeps))
+    is_pulse = _matches(marks, timings.PULSE, eps, aeps)
+    one = is_pulse & _matches(spaces, timings.ONE_GAP, eps, aeps)
+    is_bit = one | (is_pulse & _matches(spaces, timings.ZERO_GAP, eps, aeps))
+
+    headers = np.flatnonzero(is_header)
+    not_bits = np.append(np.flatnonzero(~is_bit), len(marks))
+    ends = not_bits[np.searchsorted(not_bits, headers + 1)]
+    # like the streaming decoder nothing is longer than the third frame
+    bit_counts = np.minimum(ends - headers - 1, 8 * LONG_FRAME_LENGTH)
+
+    frames = np.zeros(len(headers), dtype=FRAME_DTYPE)
+    frames['position'] = headers * 2
+    frames['length'] = bit_counts // 8
+    whole = bit_counts % 8 == 0
+    for length in (SHORT_FRAME_LENGTH, LONG_FRAME_LENGTH):
+        selected = np.flatnonzero(whole & (frames['length'] == length))
+        bit_index = (headers[selected, None] + 1 +
+                     np.arange(8 * length, dtype=np.int64))
+        data = np.packbits(one[bit_index].astype(np.uint8),
+                           axis=1,
+                           bitorder='little')
+        checksum = data[:, :-1].sum(axis=1, dtype=np.int64) & 0xff
+        frames['data'][selected, :length] = data
+        frames['valid'][selected] = (
+            (data[:, :len(HEADER)] == np.frombuffer(HEADER, np.uint8)).all(1)
+            & (checksum == data[:, -1]))
+    return frames
+
+
+def decode_frames(durations, eps=EPS, aeps=AEPS, timings=DaikinLIRC,
+                  chunk_size=CHUNK_SIZE):
+    """
+    Every frame in the durations as a FRAME_DTYPE array, in order. data
+    holds length bytes, the rest is zero
+    """
+    durations = np.asarray(durations)
+    # keeps marks on even indices
+    chunk_size += chunk_size % 2
+    parts = []
+    for start in range(0, max(len(durations), 1), chunk_size):
+        chunk = durations[start:start + chunk_size + _OVERLAP]
+        frames = _decode_chunk(chunk.astype(np.int64), eps, aeps, timings)
+        if start + chunk_size < len(durations):
+            frames = frames[frames['position'] < chunk_size]
+        frames['position'] += start
+        parts.append(frames)
+    return np.concatenate(parts)
+
+
+def decode_states(durations, eps=EPS, aeps=AEPS, timings=DaikinLIRC,
+                  chunk_size=CHUNK_SIZE):
+    """
+    One STATE_DTYPE row per third frame in the durations. valid is the
+    frame's header and checksum, comfort comes from the first frame two
+    frames earlier when that's valid
+    """
+    frames = decode_frames(durations, eps, aeps, timings, chunk_size)
+    data = frames['data']
+    is_three = ((frames['length'] == LONG_FRAME_LENGTH)
+                & (data[:, 4] == FRAME_THREE_ID))
+    index = np.flatnonzero(is_three)
+    frame = data[index].astype(np.uint16)
+
+    states = np.zeros(len(index), dtype=STATE_DTYPE)
+    states['position'] = frames['position'][index]
+    states['valid'] = frames['valid'][index]
+
+    mode_power = frame[:, 5]
+    states['power'] = mode_power & 0x01
+    states['temperature'] = frame[:, 6] >> 1
+    states['ac_mode'] = mode_power >> 4
+    states['fan_mode'] = frame[:, 8] >> 4
+    states['swing_vertical'] = frame[:, 9] & 0x0f
+    states['swing_horizontal'] = frame[:, 8] & 0x0f
+    states['economy'] = frame[:, 16] & 0x04
+    states['powerful'] = frame[:, 13] & 0x01
+
+    on = (mode_power & 0x02) != 0
+    off = ~on & ((mode_power & 0x04) != 0)
+    states['timer'] = np.where(on, TIMER_MODE.ON.value,
+                               np.where(off, TIMER_MODE.OFF.value,
+                                        TIMER_MODE.NONE.value))
+    on_minutes = frame[:, 10] | (frame[:, 11] & 0x0f) << 8
+    off_minutes = frame[:, 11] >> 4 | frame[:, 12] << 4
+    states['timer_duration'] = np.where(on, on_minutes,
+                                        np.where(off, off_minutes, 0))
+
+    first = index - 2
+    has_first = first >= 0
+    first = np.where(has_first, first, 0)
+    has_first &= (frames['valid'][first]
+                  & (frames['length'][first] == SHORT_FRAME_LENGTH)
+                  & (data[first, 4] == FRAME_ONE_ID))
+    states['comfort'] = has_first & ((data[first, 6] & 0x10) != 0)
+    return states
+
+
+def to_state(row):
+    """
+    The DaikinState of a decode_states row, None if DaikinState doesn't
+    know its modes
+    """
+    try:
+        return DaikinState(power=bool(row['power']),
+                           temperature=int(row['temperature']),
+                           ac_mode=AC_MODE(int(row['ac_mode'])),
+                           fan_mode=FAN_MODE(int(row['fan_mode'])),
+                           swing_vertical=bool(row['swing_vertical']),
+                           swing_horizontal=bool(row['swing_horizontal']),
+                           economy=bool(row['economy']),
+                           comfort=bool(row['comfort']),
+                           powerful=bool(row['powerful']),
+                           timer=TIMER_MODE(int(row['timer'])),
+                           timer_duration=int(row['timer_duration']))
+    except ValueError:
+        return None
+
+
+def to_states(table):
+    """
+    DaikinState for each valid row of a decode_states table that has one
+    """
+    states = (to_state(row) for row in table[table['valid']])
+    return [state for state in states if state is not None]
+
+
+def synthetic_capture(count, jitter=0.15, seed=0, gap=100000):
+    """
+    count random states as a receiver would record them (marks stretched,
+    spaces shortened by up to jitter), and the states
+    """
+    rng = np.random.default_rng(seed)
+    packed = rng.integers(0, DaikinState.STATE_COUNT, count)
+    states = [DaikinState.unpack(int(value)) for value in packed]
+    lirc = DaikinLIRC()
+    trains = []
+    for state in states:
+        trains.append(lirc.get_pulse_train(DaikinMessage(state)).durations)
+        trains.append([gap])
+    durations = np.concatenate(trains).astype(np.float64)
+    noise = rng.uniform(0, jitter, len(durations))
+    durations[0::2] *= 1 + noise[0::2]
+    durations[1::2] *= 1 - noise[1::2]
+    return durations.astype(np.uint32), states
+
+
+def benchmark(messages=2000):
+    """
+    Durations and messages a second, batch against the streaming decoder
+    """
+    durations, states = synthetic_capture(messages)
+    results = {}
+
+    start = time.perf_counter()
+    table = decode_states(durations)
+    results['batch'] = time.perf_counter() - start
+    assert to_states(table) == states
+
+    start = time.perf_counter()
+    decoded = list(DaikinDecoder().feed_durations(durations.tolist()))
+    results['streaming'] = time.perf_counter() - start
+    assert decoded == states
+
+    lines = ['{} messages, {} durations'.format(messages, len(durations))]
+    for name, seconds in results.items():
+        lines.append('{:<10} {:8.3f} s {:14,.0f} durations/s {:10,.0f} '
+                     'messages/s'.format(name, seconds,
+                                         len(durations) / seconds,
+                                         messages / seconds))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m daikin.batch_decoder',
+        description='Decodes a capture of Daikin remote messages')
+    parser.add_argument('capture', nargs='?')
+    parser.add_argument('--eps', type=int, default=EPS)
+    parser.add_argument('--aeps', type=int, default=AEPS)
+    parser.add_argument('--benchmark', action='store_true',
+                        help='time decoding a synthetic capture')
+    parser.add_argument('--messages', type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    if args.benchmark:
+        print(benchmark(args.messages))
+        return 0
+    if not args.capture:
+        parser.error('a capture file is needed')
+
+    table = decode_states(load_capture(args.capture), args.eps, args.aeps)
+    for row in table:
+        state = to_state(row) if row['valid'] else None
+        print('{:>12} {}'.format(row['position'],
+                                 state.key() if state else 'invalid'))
+    print('{} messages, {} with a bad checksum'.format(
+        len(table), int((~table['valid']).sum())),
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
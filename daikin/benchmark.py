@@ -0,0 +1,323 @@
+"""
+Times each stage of getting a state to the emitter on its own, so changes
+to the hot path can be judged by numbers
+
+    python -m daikin.benchmark [--stage NAME ...] [--sweep NAME]
+                               [--number N] [--repeat N] [--json]
+                               [--output FILE] [--baseline FILE]
+                               [--threshold FRACTION]
+
+Stages:
+    state        DaikinState construction
+    frames       DaikinMessage construction and its three frame properties
+    frame_table  the same frames sliced from a precomputed frame table
+                 (building it needs NumPy)
+    incremental  DaikinMessage.with_state from the previous state's message
+    frame_codes  DaikinLIRC._get_frame_codes for every frame
+    get_config   DaikinLIRC.get_config, the whole lircd config
+    pulse_train  DaikinLIRC.get_pulse_train (device mode)
+    save         DaikinController.save (atomic write and fsync)
+    load         DaikinController.load
+    update       DaikinController.update, saving and transmitting to a fake
+                 transmitter that renders the config but sends nothing
+
+Every timed call works on the next state of a sweep (see SWEEPS). Results
+are the best and median of --repeat runs of --number calls, per call.
+--json prints them as a JSON document (--output writes it to a file) and
+--baseline compares against an earlier one, exiting with status 1 if any
+stage got slower by more than --threshold (0.25 = 25%).
+"""
+import os
+import sys
+import json
+import shutil
+import timeit
+import argparse
+import platform
+import tempfile
+import itertools
+
+from .daikin import (AC_MODE, FAN_MODE, TIMER_MODE, DaikinController,
+                     DaikinLIRC, DaikinMessage, DaikinState)
+
+
+def _default_states():
+    return [
+        DaikinState(power=True, temperature=22, ac_mode=AC_MODE.HEAT),
+        DaikinState(power=True,
+                    temperature=25,
+                    ac_mode=AC_MODE.COOL,
+                    fan_mode=FAN_MODE.FIVE,
+                    swing_vertical=True),
+        DaikinState(),
+        DaikinState(power=True,
+                    temperature=21,
+                    ac_mode=AC_MODE.HEAT,
+                    powerful=True,
+                    timer=TIMER_MODE.OFF,
+                    timer_duration=90),
+    ]
+
+
+def _temperature_states():
+    return [
+        DaikinState(power=True, temperature=temperature, ac_mode=ac_mode)
+        for ac_mode in (AC_MODE.HEAT, AC_MODE.COOL)
+        for temperature in range(DaikinState.MIN_TEMPERATURE,
+                                 DaikinState.MAX_TEMPERATURE + 1)
+    ]
+
+
+def _mode_states():
+    return [
+        DaikinState(power=True, ac_mode=ac_mode, fan_mode=fan_mode)
+        for ac_mode in AC_MODE for fan_mode in FAN_MODE
+    ]
+
+
+def _packed_states(count=256):
+    # spread evenly through every state there is, timers included
+    step = DaikinState.STATE_COUNT // count
+    return [DaikinState.unpack(index * step) for index in range(count)]
+
+
+SWEEPS = {
+    'default': _default_states,
+    'temperatures': _temperature_states,
+    'modes': _mode_states,
+    'packed': _packed_states,
+}
+
+
+class FakeLIRC(DaikinLIRC):
+    """
+        Does the rendering a dynamic mode transmission does, then drops the
+        config instead of handing it to lircd
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.sent = 0
+
+    def send(self, message):
+        self.get_config(message)
+        self.sent += 1
+
+
+def _fields(state):
+    return {name: getattr(state, name) for name in DaikinState.FIELDS}
+
+
+def _next(items):
+    return itertools.cycle(items).__next__
+
+
+def _stage_state(states, workdir):
+    next_fields = _next([_fields(state) for state in states])
+    return lambda: DaikinState(**next_fields())
+
+
+def _stage_frames(states, workdir):
+    next_state = _next(states)
+
+    def frames():
+        message = DaikinMessage(next_state())
+        message.frame_one
+        message.frame_two
+        message.frame_three
+
+    return frames
+
+
+def _stage_frame_table(states, workdir):
+    from .frame_table import FrameTable, build
+    table = FrameTable(build(os.path.join(workdir, 'frames.bin')))
+    next_state = _next(states)
+
+    def frames():
+        message = table.message(next_state())
+        message.frame_one
+        message.frame_two
+        message.frame_three
+
+    return frames
+
+
+def _stage_incremental(states, workdir):
+    next_state = _next(states)
+    messages = [DaikinMessage(states[-1])]
+
+    def incremental():
+        message = messages[0] = messages[0].with_state(next_state())
+        message.frame_one
+        message.frame_two
+        message.frame_three
+
+    return incremental
+
+
+def _stage_frame_codes(states, workdir):
+    lirc = DaikinLIRC()
+    next_frames = _next([
+        (message.frame_one, message.frame_two, message.frame_three)
+        for message in map(DaikinMessage, states)
+    ])
+
+    def frame_codes():
+        for frame in next_frames():
+            lirc._get_frame_codes(frame)
+
+    return frame_codes
+
+
+def _stage_get_config(states, workdir):
+    lirc = DaikinLIRC()
+    next_message = _next([DaikinMessage(state) for state in states])
+    return lambda: lirc.get_config(next_message())
+
+
+def _stage_pulse_train(states, workdir):
+    lirc = DaikinLIRC()
+    next_message = _next([DaikinMessage(state) for state in states])
+    return lambda: lirc.get_pulse_train(next_message())
+
+
+def _controller(workdir):
+    storage_file = os.path.join(workdir, 'config.json')
+    with open(storage_file, 'w') as f:
+        json.dump({}, f)
+    return DaikinController(storage_file=storage_file, lirc=FakeLIRC())
+
+
+def _stage_save(states, workdir):
+    controller = _controller(workdir)
+    next_state = _next(states)
+    return lambda: controller.save(next_state())
+
+
+def _stage_load(states, workdir):
+    controller = _controller(workdir)
+    controller.save(states[0])
+    return controller.load
+
+
+def _stage_update(states, workdir):
+    controller = _controller(workdir)
+    next_fields = _next([_fields(state) for state in states])
+    return lambda: controller.update(**next_fields())
+
+
+STAGES = {
+    'state': _stage_state,
+    'frames': _stage_frames,
+    'frame_table': _stage_frame_table,
+    'incremental': _stage_incremental,
+    'frame_codes': _stage_frame_codes,
+    'get_config': _stage_get_config,
+    'pulse_train': _stage_pulse_train,
+    'save': _stage_save,
+    'load': _stage_load,
+    'update': _stage_update,
+}
+
+
+def run(stages=None, sweep='default', number=1000, repeat=5):
+    """
+    Times the stages, returns the results as a JSON-able dict
+    """
+    states = SWEEPS[sweep]()
+    results = []
+    workdir = tempfile.mkdtemp()
+    try:
+        for name in stages or STAGES:
+            func = STAGES[name](states, workdir)
+            times = timeit.repeat(func, number=number, repeat=repeat)
+            per_call = sorted(seconds / number * 1e6 for seconds in times)
+            results.append({
+                'stage': name,
+                'best_us': per_call[0],
+                'median_us': per_call[len(per_call) // 2],
+            })
+    finally:
+        shutil.rmtree(workdir)
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'sweep': sweep,
+        'states': len(states),
+        'number': number,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(report, baseline, threshold=0.25):
+    """
+    Stages slower than the baseline by more than threshold (a fraction), as
+    (stage, baseline us, now us) using the best times
+    """
+    before = {
+        result['stage']: result['best_us']
+        for result in baseline['results']
+    }
+    regressions = []
+    for result in report['results']:
+        previous = before.get(result['stage'])
+        if previous and result['best_us'] > previous * (1 + threshold):
+            regressions.append((result['stage'], previous, result['best_us']))
+    return regressions
+
+
+def format_report(report):
+    lines = [
+        '{} states ({} sweep), {} x {} calls, Python {} on {}'.format(
+            report['states'], report['sweep'], report['repeat'],
+            report['number'], report['python'], report['machine']),
+        '{:<14} {:>12} {:>12}'.format('stage', 'best us', 'median us'),
+    ]
+    for result in report['results']:
+        lines.append('{:<14} {:12.2f} {:12.2f}'.format(
+            result['stage'], result['best_us'], result['median_us']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m daikin.benchmark',
+        description='Times each stage of encoding and sending a state')
+    parser.add_argument('--stage', action='append', choices=sorted(STAGES),
+                        help='stage to time, repeatable (default: all)')
+    parser.add_argument('--sweep', default='default', choices=sorted(SWEEPS))
+    parser.add_argument('--number', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    parser.add_argument('--output', help='also write the JSON results here')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed slowdown against the baseline')
+    args = parser.parse_args(argv)
+
+    report = run(args.stage, args.sweep, args.number, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('sweep') != report['sweep']:
+            print('Baseline used the {} sweep, this run {}'.format(
+                baseline.get('sweep'), report['sweep']), file=sys.stderr)
+        regressions = compare(report, baseline, args.threshold)
+        for stage, before, now in regressions:
+            print('REGRESSION {}: {:.2f} us -> {:.2f} us (+{:.0%})'.format(
+                stage, before, now, now / before - 1), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
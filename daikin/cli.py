@@ -0,0 +1,149 @@
+"""
+The daikin command, for scripts and Home Assistant shell commands
+
+    daikin status [--unit NAME] [--json]
+    daikin set [--unit NAME] [--power on|off] [--mode heat] [--temp 22] ...
+    daikin resend [--unit NAME]
+    daikin serve
+
+It starts a fresh interpreter every time, so each subcommand imports only
+what it needs when it runs: set and status never load Flask, paho or
+NumPy. set changes the same state file the services use (see
+state_store.py) and transmits from this process.
+"""
+import sys
+import argparse
+
+SWITCH = {'on': True, 'off': False}
+
+# set's options and the fields they change, in the serialize() format
+# (DaikinState.parse_changes validates them)
+SET_OPTIONS = (
+    ('--power', 'power', SWITCH, None),
+    ('--temp', 'temperature', int, 'DEGREES'),
+    ('--mode', 'ac_mode', str, 'auto|dry|cool|heat|fan'),
+    ('--fan', 'fan_mode', str, 'auto|silent|one|...|five'),
+    ('--swing-vertical', 'swing_vertical', SWITCH, None),
+    ('--swing-horizontal', 'swing_horizontal', SWITCH, None),
+    ('--economy', 'economy', SWITCH, None),
+    ('--comfort', 'comfort', SWITCH, None),
+    ('--powerful', 'powerful', SWITCH, None),
+    ('--timer', 'timer', str, 'on|off|none'),
+    ('--timer-minutes', 'timer_duration', int, 'MINUTES'),
+)
+
+
+def open_unit(name=None, **controller_args):
+    """
+    The configured unit called name (the first one without a name), None
+    if there isn't one
+    """
+    from .units import create_unit, load_unit_configs
+
+    configs = load_unit_configs()
+    if name is not None:
+        configs = [config for config in configs if config['name'] == name]
+    if not configs:
+        return None
+    return create_unit(configs[0], **controller_args)
+
+
+def format_state(state):
+    return '\n'.join('{}: {}'.format(name, value)
+                     for name, value in state.serialize().items())
+
+
+def status(args):
+    unit = _unit(args)
+    state = unit.controller.current_state()
+    if args.json:
+        import json
+        print(json.dumps(state.serialize(), sort_keys=True))
+    else:
+        print(format_state(state))
+    return 0
+
+
+def set_state(args):
+    from .daikin import DaikinState
+
+    data = {}
+    for _, name, kind, _ in SET_OPTIONS:
+        value = getattr(args, name)
+        if value is not None:
+            data[name] = SWITCH[value] if kind is SWITCH else value
+    if not data:
+        args.parser.error('nothing to set')
+    try:
+        changes = DaikinState.parse_changes(data)
+    except ValueError as e:
+        args.parser.error(str(e))
+    unit = _unit(args)
+    state = unit.controller.update(force=args.force, **changes)
+    print(format_state(state))
+    return 0
+
+
+def resend(args):
+    unit = _unit(args)
+    unit.controller.resend()
+    return 0
+
+
+def serve(args):
+    from . import service
+    service.main()
+    return 0
+
+
+def _unit(args):
+    unit = open_unit(args.unit)
+    if unit is None:
+        args.parser.error('no unit called {}'.format(args.unit))
+    return unit
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        prog='daikin', description='Controls Daikin AC units over IR')
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    commands.required = True
+
+    command = commands.add_parser('status', help='print the current state')
+    command.add_argument('--json', action='store_true')
+    command.set_defaults(func=status, parser=command)
+
+    command = commands.add_parser(
+        'set', help='change some of the state and transmit it')
+    for option, name, kind, metavar in SET_OPTIONS:
+        if kind is SWITCH:
+            command.add_argument(option, dest=name, choices=sorted(SWITCH))
+        else:
+            command.add_argument(option, dest=name, type=kind,
+                                 metavar=metavar)
+    command.add_argument('--force', action='store_true',
+                         help='transmit even if nothing changed')
+    command.set_defaults(func=set_state, parser=command)
+
+    command = commands.add_parser(
+        'resend', help='transmit the current state again')
+    command.set_defaults(func=resend, parser=command)
+
+    for command in commands.choices.values():
+        command.add_argument('--unit', help='the unit to use (the first one '
+                             'in the units file by default)')
+
+    command = commands.add_parser(
+        'serve', help='run the web server and MQTT service')
+    command.set_defaults(func=serve, parser=command)
+    return parser
+
+
+def main(argv=None):
+    parser = create_parser()
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
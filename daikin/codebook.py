@@ -0,0 +1,204 @@
+import os
+import subprocess
+import tempfile
+from collections import OrderedDict
+import logging
+
+from .daikin import (AC_MODE, LIRC_CONFIG_DIR, TIMER_MODE, DaikinLIRC,
+                     DaikinMessage, DaikinState)
+from .metrics import STAGE_SECONDS
+logger = logging.getLogger(__name__)
+
+# installed under the same name as the dynamic config so the two never
+# define the same remote twice
+LIRC_CODEBOOK_FILE = '{}.lircd.conf'
+# lircd only includes *.conf, so the staged copy is never picked up
+LIRC_CODEBOOK_STAGING_FILE = '.{}.lircd.conf.tmp'
+# lircd rereads its configuration on SIGHUP
+LIRC_RELOAD = ['sudo', 'systemctl', 'kill', '--signal=HUP', 'lircd']
+
+
+def preset_states():
+    """
+    The states worth having loaded before anyone asks for them:
+    heat and cool across the whole temperature range plus the presets
+    served by server.py
+    """
+    states = []
+    for ac_mode in (AC_MODE.HEAT, AC_MODE.COOL):
+        for temperature in range(18, 31):
+            states.append(
+                DaikinState(
+                    power=True, temperature=temperature, ac_mode=ac_mode))
+    states.append(
+        DaikinState(
+            power=True, temperature=21, ac_mode=AC_MODE.HEAT, powerful=True))
+    states.append(DaikinState())
+    return states
+
+
+class DaikinLIRCCodebook(DaikinLIRC):
+    """
+        Keeps many named raw codes loaded in lircd at once, one per state
+
+        Presets are always present, recently sent states are kept up to
+        `capacity` and evicted least recently used first. The config is only
+        reinstalled (and lircd only reloaded) when a state is requested that
+        is not in the codebook yet, otherwise sending is a single irsend
+
+        States with a timer carry the minutes left, so they never repeat and
+        are sent through the dynamic config instead of filling the codebook
+    """
+
+    def __init__(self,
+                 presets=None,
+                 capacity=64,
+                 config_dir=None,
+                 client=None,
+                 remote_name=None,
+                 socket=None):
+        super().__init__(client=client,
+                         remote_name=remote_name,
+                         socket=socket)
+        self.config_dir = config_dir or LIRC_CONFIG_DIR
+        self.capacity = capacity
+        self.presets = OrderedDict()
+        for state in (preset_states() if presets is None else presets):
+            self.presets[state.key()] = state
+        self.recent = OrderedDict()
+        self.installed = self._read_installed()
+        # whether the installed file is known to match the codebook
+        self.synced = False
+
+        # pick up states that were added by a previous run so restarting the
+        # service doesn't force a reload
+        for key in self._installed_keys(self.installed or ''):
+            if key in self.presets:
+                continue
+            try:
+                state = DaikinState.from_key(key)
+            except (KeyError, ValueError):
+                logger.warning('Ignoring unknown code {}'.format(key))
+                continue
+            if state.timer == TIMER_MODE.NONE:
+                self.recent[key] = state
+        self._evict()
+
+    @property
+    def config_path(self):
+        return os.path.join(self.config_dir,
+                            LIRC_CODEBOOK_FILE.format(self.remote_name))
+
+    @property
+    def staging_path(self):
+        return os.path.join(
+            self.config_dir,
+            LIRC_CODEBOOK_STAGING_FILE.format(self.remote_name))
+
+    def __contains__(self, key):
+        return key in self.presets or key in self.recent
+
+    def keys(self):
+        return list(self.presets) + list(self.recent)
+
+    def get_codebook_config(self):
+        # recent codes are written in key order, not usage order, so a cache
+        # hit never changes the file
+        states = list(self.presets.items()) + sorted(self.recent.items())
+        codes = [
+            self.get_raw_code(DaikinMessage(state), key)
+            for key, state in states
+        ]
+        return ''.join([
+            self.remote_header,
+            '\n        '.join(codes),
+            self.REMOTE_FOOTER,
+        ])
+
+    def add(self, state):
+        """
+        Makes sure a state is in the codebook, returns True if the codebook
+        changed
+        """
+        key = state.key()
+        if key in self.presets:
+            return False
+        if key in self.recent:
+            self.recent.move_to_end(key)
+            return False
+        self.recent[key] = state
+        self._evict()
+        return True
+
+    def install(self):
+        """
+        Atomically replaces the installed codebook and reloads lircd,
+        skipped entirely when the installed codebook is already identical
+        """
+        config = self.get_codebook_config()
+        if config == self.installed:
+            self.synced = True
+            return False
+
+        with tempfile.NamedTemporaryFile(
+                'w', prefix='{}-'.format(self.remote_name), suffix='.conf',
+                delete=False) as config_file:
+            config_file.write(config)
+
+        try:
+            # copy next to the target then rename, lircd never sees a
+            # partially written file
+            subprocess.check_output([
+                'sudo', 'install', '-m', '644', config_file.name,
+                self.staging_path
+            ])
+            subprocess.check_output(
+                ['sudo', 'mv', '-f', self.staging_path, self.config_path])
+        finally:
+            os.unlink(config_file.name)
+
+        subprocess.check_output(LIRC_RELOAD)
+        self.installed = config
+        self.synced = True
+        logger.info('Installed codebook with {} codes'.format(
+            len(self.presets) + len(self.recent)))
+        return True
+
+    def send(self, message):
+        if message.state.timer != TIMER_MODE.NONE:
+            # the dynamic config replaces the codebook file, so it has to be
+            # installed again for the next state without a timer
+            super().send(message)
+            self.installed = None
+            self.synced = False
+            return
+
+        key = message.state.key()
+        if self.add(message.state) or not self.synced:
+            with STAGE_SECONDS.time('install_codebook'):
+                self.install()
+        self.send_once(key)
+
+    def _evict(self):
+        while len(self.recent) > self.capacity:
+            self.recent.popitem(last=False)
+
+    def _read_installed(self):
+        try:
+            with open(self.config_path) as config_file:
+                return config_file.read()
+        except (IOError, OSError):
+            return None
+
+    def _installed_keys(self, config):
+        keys = []
+        in_raw_codes = False
+        for line in config.splitlines():
+            words = line.split()
+            if words[:2] == ['begin', 'raw_codes']:
+                in_raw_codes = True
+            elif words[:2] == ['end', 'raw_codes']:
+                in_raw_codes = False
+            elif in_raw_codes and len(words) == 2 and words[0] == 'name':
+                keys.append(words[1])
+        return keys
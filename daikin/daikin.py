@@ -1,18 +1,61 @@
 import subprocess
 import os
+import re
+import math
+import time
+import threading
 from enum import Enum
+from operator import attrgetter
 import json
-from jinja2 import Template
 import logging
+
+from .metrics import STAGE_SECONDS, TRANSMISSIONS
+from .pulses import PulseTrain, lsb_byte_table, lsb_text_table
+from .tracing import event, span
 logger = logging.getLogger(__name__)
 
+LIRC_CONFIG_DIR = '/etc/lirc/lircd.conf.d/'
+# one config per remote name
 # TODO: use os.tempfile or something
-DAIKIN_LIRC_CONFIG_TMP = '/tmp/daikin-pi.lircd.conf'
-LIRC_CONFIG_COPY_CMD = [
-    'sudo', 'cp', DAIKIN_LIRC_CONFIG_TMP, '/etc/lirc/lircd.conf.d/'
-]
+DAIKIN_LIRC_CONFIG_TMP = '/tmp/{}.lircd.conf'
 LIRC_RESTART = ['sudo', 'systemctl', 'restart', 'lircd']
-LIRC_SEND_COMMAND = ['irsend', 'SEND_ONCE', 'daikin-pi', 'dynamic-signal']
+LIRC_SEND_COMMAND = ['irsend']
+LIRC_DYNAMIC_CODE = 'dynamic-signal'
+
+# dynamic: rewrite the config and restart lircd for every command
+# codebook: send preloaded codes by name (see codebook.py)
+# device: write pulses straight to the LIRC device (see lirc_device.py)
+DAIKIN_LIRC_MODE = os.environ.get('DAIKIN_LIRC_MODE', 'dynamic')
+# irsend: fork irsend for every code sent
+# socket: send codes over a persistent connection to the lircd socket
+DAIKIN_LIRC_SENDER = os.environ.get('DAIKIN_LIRC_SENDER', 'irsend')
+
+
+def _default_data_dir():
+    # a source checkout keeps its state in data/ beside the package, an
+    # installed package (in site-packages) in the user's data directory
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if os.path.exists(os.path.join(root, 'setup.py')):
+        return os.path.join(root, 'data')
+    return os.path.join(
+        os.environ.get('XDG_DATA_HOME') or os.path.join(
+            os.path.expanduser('~'), '.local', 'share'), 'daikin')
+
+
+# state files, units.json, the schedule and the frame table
+DAIKIN_DATA_DIR = os.environ.get('DAIKIN_DATA_DIR') or _default_data_dir()
+
+
+def data_file(name):
+    return os.path.join(DAIKIN_DATA_DIR, name)
+
+
+def make_parent_dir(path):
+    """
+    Creates the directory a file is about to be written to, eg. a fresh
+    DAIKIN_DATA_DIR
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
 
 
 class AC_MODE(Enum):
@@ -40,12 +83,44 @@ class FAN_MODE(Enum):
 # off = delay til unit turns off
 # none = no timer
 class TIMER_MODE(Enum):
-    SET_ON = True
-    SET_OFF = False
-    SET_NONE = None
+    NONE = 0
+    ON = 1
+    OFF = 2
+
+    # old names
+    SET_NONE = 0
+    SET_ON = 1
+    SET_OFF = 2
 
 
 class DaikinState:
+    """
+        An immutable AC state, use replace() to derive a changed one
+
+        States compare and hash by value and pack losslessly into a small
+        integer (see pack) so they can key caches and be stored compactly
+    """
+
+    FIELDS = (
+        'power',
+        'temperature',
+        'ac_mode',
+        'fan_mode',
+        'swing_vertical',
+        'swing_horizontal',
+        'economy',
+        'comfort',
+        'powerful',
+        'timer',
+        'timer_duration',
+    )
+    __slots__ = FIELDS + ('_packed', )
+
+    MIN_TEMPERATURE = 18
+    MAX_TEMPERATURE = 30
+    # minutes, the remote arms timers for up to 12 hours
+    MAX_TIMER_DURATION = 12 * 60
+
     def __init__(
             self,
             power=False,
@@ -57,105 +132,155 @@ class DaikinState:
             economy=False,
             comfort=False,
             powerful=False,
+            timer=TIMER_MODE.NONE,
+            timer_duration=0,
     ):
+        """
+        timer: switch the unit on (TIMER_MODE.ON) or off (TIMER_MODE.OFF)
+        timer_duration minutes after the state is received
+        """
+        if temperature < self.MIN_TEMPERATURE:
+            temperature = self.MIN_TEMPERATURE
+        if temperature > self.MAX_TEMPERATURE:
+            temperature = self.MAX_TEMPERATURE
+        if not isinstance(ac_mode, AC_MODE):
+            ac_mode = AC_MODE.AUTO
+        if not isinstance(fan_mode, FAN_MODE):
+            fan_mode = FAN_MODE.AUTO
+        if not isinstance(timer, TIMER_MODE):
+            timer = TIMER_MODE.NONE
+        if timer == TIMER_MODE.NONE:
+            timer_duration = 0
+        else:
+            timer_duration = min(max(int(timer_duration), 1),
+                                 self.MAX_TIMER_DURATION)
+
+        init = object.__setattr__
+        init(self, 'power', bool(power))
+        init(self, 'temperature', int(temperature))
+        init(self, 'ac_mode', ac_mode)
+        init(self, 'fan_mode', fan_mode)
+        init(self, 'swing_vertical', bool(swing_vertical))
+        init(self, 'swing_horizontal', bool(swing_horizontal))
+        init(self, 'economy', bool(economy))
+        init(self, 'comfort', bool(comfort))
+        init(self, 'powerful', bool(powerful))
+        init(self, 'timer', timer)
+        init(self, 'timer_duration', timer_duration)
+        init(self, '_packed', self._pack())
+
+    def __setattr__(self, name, value):
+        raise AttributeError('DaikinState is immutable, use replace()')
+
+    def __delattr__(self, name):
+        raise AttributeError('DaikinState is immutable')
+
+    def __eq__(self, other):
+        if not isinstance(other, DaikinState):
+            return NotImplemented
+        return self._packed == other._packed
+
+    def __hash__(self):
+        return hash(self._packed)
+
+    def __repr__(self):
+        return 'DaikinState({})'.format(', '.join(
+            '{}={!r}'.format(name, getattr(self, name))
+            for name in self.FIELDS))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (DaikinState.unpack, (self._packed, ))
+
+    def replace(self, **changes):
+        values = {name: getattr(self, name) for name in self.FIELDS}
+        values.update(changes)
+        return DaikinState(**values)
+
+    # Packed encoding: every field as a digit of a mixed radix number so
+    # all valid states map onto 0..STATE_COUNT - 1 without gaps
+    #   timer (1 + 2 * MAX_TIMER_DURATION: none, or on/off and the minutes)
+    #   power (2) temperature (13) ac_mode (5) fan_mode (7) then one bit each
+    #   for swing_vertical, swing_horizontal, economy, comfort, powerful
+    # the timer is the most significant digit so states without one pack
+    # to the same numbers they did before timers existed
+    _AC_MODES = tuple(AC_MODE)
+    _FAN_MODES = tuple(FAN_MODE)
+    _AC_MODE_INDEX = {mode: index for index, mode in enumerate(_AC_MODES)}
+    _FAN_MODE_INDEX = {mode: index for index, mode in enumerate(_FAN_MODES)}
+    _RADICES = (1 + 2 * MAX_TIMER_DURATION, 2,
+                MAX_TEMPERATURE - MIN_TEMPERATURE + 1, len(_AC_MODES),
+                len(_FAN_MODES), 2, 2, 2, 2, 2)
+    STATE_COUNT = (1 + 2 * 720) * 2 * 13 * 5 * 7 * 2 * 2 * 2 * 2 * 2
+    PACKED_SIZE = 4  # bytes
+
+    def _pack(self):
+        timer = self.timer_duration
+        if self.timer == TIMER_MODE.OFF:
+            timer += self.MAX_TIMER_DURATION
+        digits = (
+            timer,
+            self.power,
+            self.temperature - self.MIN_TEMPERATURE,
+            self._AC_MODE_INDEX[self.ac_mode],
+            self._FAN_MODE_INDEX[self.fan_mode],
+            self.swing_vertical,
+            self.swing_horizontal,
+            self.economy,
+            self.comfort,
+            self.powerful,
+        )
+        packed = 0
+        for digit, radix in zip(digits, self._RADICES):
+            packed = packed * radix + digit
+        return packed
 
-        self.power = power
-        self.temperature = temperature
-        self.ac_mode = ac_mode
-        self.fan_mode = fan_mode
-        self.swing_vertical = swing_vertical
-        self.swing_horizontal = swing_horizontal
-        self.economy = economy
-        self.comfort = comfort
-        self.powerful = powerful
-        self.timer = None  # Not Implemented
-
-    @property
-    def power(self):
-        return self.__power
-
-    @power.setter
-    def power(self, value):
-        self.__power = bool(value)
-
-    @property
-    def temperature(self):
-        return self.__temperature
-
-    @temperature.setter
-    def temperature(self, value):
-        if value < 18:
-            value = 18
-        if value > 30:
-            value = 30
-
-        self.__temperature = value
-
-    @property
-    def ac_mode(self):
-        return self.__ac_mode
-
-    @ac_mode.setter
-    def ac_mode(self, value):
-        if value not in AC_MODE:
-            value = AC_MODE.AUTO
-
-        self.__ac_mode = value
-
-    @property
-    def fan_mode(self):
-        return self.__fan_mode
-
-    @fan_mode.setter
-    def fan_mode(self, value):
-        if value not in FAN_MODE:
-            value = FAN_MODE.AUTO
-
-        self.__fan_mode = value
-
-    @property
-    def swing_vertical(self):
-        return self.__swing_vertical
-
-    @swing_vertical.setter
-    def swing_vertical(self, value):
-        self.__swing_vertical = bool(value)
-
-    @property
-    def swing_horizontal(self):
-        return self.__swing_horizontal
-
-    @swing_horizontal.setter
-    def swing_horizontal(self, value):
-        self.__swing_horizontal = bool(value)
-
-    @property
-    def economy(self):
-        return self.__economy
-
-    @economy.setter
-    def economy(self, value):
-        self.__economy = bool(value)
-
-    @property
-    def powerful(self):
-        return self.__powerful
-
-    @powerful.setter
-    def powerful(self, value):
-        self.__powerful = bool(value)
+    def pack(self):
+        """
+        This state as an integer in range(STATE_COUNT)
+        """
+        return self._packed
 
-    @property
-    def comfort(self):
-        return self.__comfort
+    @classmethod
+    def unpack(cls, packed):
+        if not 0 <= packed < cls.STATE_COUNT:
+            raise ValueError('Invalid packed state: {}'.format(packed))
+        digits = []
+        for radix in reversed(cls._RADICES):
+            packed, digit = divmod(packed, radix)
+            digits.append(digit)
+        (powerful, comfort, economy, swing_horizontal, swing_vertical,
+         fan_mode, ac_mode, temperature, power, timer) = digits
+        if timer > cls.MAX_TIMER_DURATION:
+            timer_mode = TIMER_MODE.OFF
+            timer -= cls.MAX_TIMER_DURATION
+        else:
+            timer_mode = TIMER_MODE.ON if timer else TIMER_MODE.NONE
+        return cls(
+            power=power,
+            temperature=temperature + cls.MIN_TEMPERATURE,
+            ac_mode=cls._AC_MODES[ac_mode],
+            fan_mode=cls._FAN_MODES[fan_mode],
+            swing_vertical=swing_vertical,
+            swing_horizontal=swing_horizontal,
+            economy=economy,
+            comfort=comfort,
+            powerful=powerful,
+            timer=timer_mode,
+            timer_duration=timer,
+        )
 
-    @comfort.setter
-    def comfort(self, value):
-        self.__comfort = bool(value)
+    def to_bytes(self):
+        return self._packed.to_bytes(self.PACKED_SIZE, 'big')
 
-    @property
-    def timer(self):
-        return self.__timer
+    @classmethod
+    def from_bytes(cls, data):
+        return cls.unpack(int.from_bytes(data, 'big'))
 
     def serialize(self):
         return {
@@ -168,21 +293,181 @@ class DaikinState:
             'economy': self.economy,
             'comfort': self.comfort,
             'powerful': self.powerful,
+            'timer': self.timer.name,
+            'timer_duration': self.timer_duration,
         }
 
     @classmethod
     def deserialize(cls, data):
         data['ac_mode'] = AC_MODE[data['ac_mode']]
         data['fan_mode'] = FAN_MODE[data['fan_mode']]
+        # saved before timers existed
+        if 'timer' in data:
+            data['timer'] = TIMER_MODE[data['timer']]
         return cls(**data)
 
+    @classmethod
+    def parse_changes(cls, data):
+        """
+        Validates a partial state in the serialize() format (mode names are
+        case insensitive), returns the changes as replace()/update() keyword
+        arguments or raises ValueError
+        """
+        if not isinstance(data, dict) or not data:
+            raise ValueError('Expected an object with the fields to change')
+        changes = {}
+        for name, value in data.items():
+            if name not in cls.FIELDS:
+                raise ValueError('Unknown field: {}'.format(name))
+            if name == 'temperature':
+                if (isinstance(value, bool) or not isinstance(value, int)
+                        or not cls.MIN_TEMPERATURE <= value <=
+                        cls.MAX_TEMPERATURE):
+                    raise ValueError(
+                        'temperature must be a whole number from {} to {}'.
+                        format(cls.MIN_TEMPERATURE, cls.MAX_TEMPERATURE))
+            elif name == 'timer_duration':
+                if (isinstance(value, bool) or not isinstance(value, int)
+                        or not 0 <= value <= cls.MAX_TIMER_DURATION):
+                    raise ValueError(
+                        'timer_duration must be a whole number of minutes '
+                        'from 0 to {}'.format(cls.MAX_TIMER_DURATION))
+            elif name in ('ac_mode', 'fan_mode', 'timer'):
+                modes = {
+                    'ac_mode': AC_MODE,
+                    'fan_mode': FAN_MODE,
+                    'timer': TIMER_MODE,
+                }[name]
+                try:
+                    value = modes[value.upper()]
+                except (AttributeError, KeyError):
+                    raise ValueError('{} must be one of {}'.format(
+                        name, ', '.join(mode.name for mode in modes)))
+            elif not isinstance(value, bool):
+                raise ValueError('{} must be true or false'.format(name))
+            changes[name] = value
+        if changes.get('timer') not in (None, TIMER_MODE.NONE) and not (
+                changes.get('timer_duration')):
+            raise ValueError('timer needs a timer_duration')
+        return changes
+
+    def key(self):
+        """
+        Stable name for this state, safe to use as an LIRC code name
+        eg. on-22-heat-auto-00000 (flags: vertical, horizontal, economy,
+        comfort, powerful), with a timer eg. off-22-heat-auto-00000-on90
+        """
+        flags = (self.swing_vertical, self.swing_horizontal, self.economy,
+                 self.comfort, self.powerful)
+        key = '{}-{}-{}-{}-{}'.format(
+            'on' if self.power else 'off',
+            self.temperature,
+            self.ac_mode.name.lower(),
+            self.fan_mode.name.lower(),
+            ''.join('1' if flag else '0' for flag in flags),
+        )
+        if self.timer != TIMER_MODE.NONE:
+            key += '-{}{}'.format(self.timer.name.lower(), self.timer_duration)
+        return key
+
+    @classmethod
+    def from_key(cls, key):
+        parts = key.split('-')
+        timer, timer_duration = TIMER_MODE.NONE, 0
+        if len(parts) == 6:
+            match = re.match(r'^(on|off)(\d+)$', parts.pop())
+            if not match:
+                raise ValueError('Invalid state key: {}'.format(key))
+            timer = TIMER_MODE[match.group(1).upper()]
+            timer_duration = int(match.group(2))
+        power, temperature, ac_mode, fan_mode, flags = parts
+        if power not in ('on', 'off') or len(flags) != 5:
+            raise ValueError('Invalid state key: {}'.format(key))
+        vertical, horizontal, economy, comfort, powerful = [
+            flag == '1' for flag in flags
+        ]
+        return cls(
+            power=power == 'on',
+            temperature=int(temperature),
+            ac_mode=AC_MODE[ac_mode.upper()],
+            fan_mode=FAN_MODE[fan_mode.upper()],
+            swing_vertical=vertical,
+            swing_horizontal=horizontal,
+            economy=economy,
+            comfort=comfort,
+            powerful=powerful,
+            timer=timer,
+            timer_duration=timer_duration,
+        )
+
+
+# where each frame lives in DaikinMessage.buffer, the last byte of each is
+# its checksum
+FRAME_ONE = slice(0, 8)
+FRAME_TWO = slice(8, 16)
+FRAME_THREE = slice(16, 35)
+MESSAGE_SIZE = 35
+
 
 class DaikinMessage:
-    def __init__(self, state):
+    """
+        A state's three frames, encoded once into one immutable buffer
+        (frame one, two and three back to back, see FRAME_ONE etc.) and
+        handed out as memoryview slices of it
+
+        with_state() derives the message for another state by patching only
+        the bytes of the fields that changed, adjusting each checksum by the
+        difference instead of summing the frame again
+    """
+
+    __slots__ = ('state', 'buffer')
+
+    def __init__(self, state, buffer=None):
+        """
+        buffer: the encoded frames when they're known already (eg. a
+        frame_table record), encoded from the state without
+        """
         self.state = state
+        if buffer is None:
+            buffer = bytes(self._encode_frame_one() +
+                           self._encode_frame_two() +
+                           self._encode_frame_three())
+        self.buffer = buffer
 
     @property
     def frame_one(self):
+        return memoryview(self.buffer)[FRAME_ONE]
+
+    @property
+    def frame_two(self):
+        return memoryview(self.buffer)[FRAME_TWO]
+
+    @property
+    def frame_three(self):
+        return memoryview(self.buffer)[FRAME_THREE]
+
+    def with_state(self, state):
+        """
+        The message for state, patched from this one
+        """
+        previous = self.state
+        if state == previous:
+            return DaikinMessage(state, self.buffer)
+        buffer = bytearray(self.buffer)
+        for fields, offset, encode, checksum in _FIELD_BYTES:
+            if fields(state) == fields(previous):
+                continue
+            values = encode(state)
+            end = offset + len(values)
+            delta = sum(values) - sum(buffer[offset:end])
+            buffer[offset:end] = values
+            buffer[checksum] = (buffer[checksum] + delta) & 0xff
+        return DaikinMessage(state, bytes(buffer))
+
+    def replace(self, **changes):
+        return self.with_state(self.state.replace(**changes))
+
+    def _encode_frame_one(self):
         # relevant bit indicies
         MESSAGE_ID = 4
         COMFORT = 6
@@ -202,8 +487,7 @@ class DaikinMessage:
 
         return frame
 
-    @property
-    def frame_two(self):
+    def _encode_frame_two(self):
 
         # relevant bit indicies
         MESSAGE_ID = 4
@@ -219,8 +503,7 @@ class DaikinMessage:
 
         return frame
 
-    @property
-    def frame_three(self):
+    def _encode_frame_three(self):
         """
         Most relevant information is stored in this frame
         A number of methods are used to update the frame data from empty bytes
@@ -268,18 +551,17 @@ class DaikinMessage:
 
         #  AC_MODE_POWER_TIMERS - encodes all three into one byte (two nybbles)
         # [ 0     0     0     0     1      0        0       0     ]
-        # [(       ac_mode      ) fixed (set on)(set off)(pwr on) ]
+        # [(       ac_mode      ) fixed (set off)(set on)(pwr on) ]
 
         # Set AC_MODE
         self._set_first_nybble(frame, MODE_POWER_TIMERS,
                                self.state.ac_mode.value)
 
         # Timer Is Setting Unit On/Off
-        if self.state.timer is not None:
-            if self.state.timer == TIMER_MODE.OFF:
-                frame[MODE_POWER_TIMERS] = frame[MODE_POWER_TIMERS] | 0x04
-            elif self.state.timer == TIMER_MODE.ON:
-                frame[MODE_POWER_TIMERS] = frame[MODE_POWER_TIMERS] | 0x02
+        if self.state.timer == TIMER_MODE.OFF:
+            frame[MODE_POWER_TIMERS] = frame[MODE_POWER_TIMERS] | 0x04
+        elif self.state.timer == TIMER_MODE.ON:
+            frame[MODE_POWER_TIMERS] = frame[MODE_POWER_TIMERS] | 0x02
 
         # Power On/Off
         if self.state.power:
@@ -294,33 +576,12 @@ class DaikinMessage:
         self._set_second_nybble(frame, SWING_VERTICAL,
                                 self.state.swing_vertical)
 
-        # Timer Delay - complicated encoding not really completely understood
-        # Timer ON sets duration at TIMER_A and TIMER_B
-        # Timer OFF sets duration at TIMER_B and TIMER_C
-        frame[TIMER_A] = 0x00
-        frame[TIMER_B] = 0x00
-        frame[TIMER_C] = 0x00
-
-        if self.state.timer is None:
-            frame[TIMER_B] = 0x06
-            frame[TIMER_C] = 0x60
-
-        # wat?
-        frame[TIMER_B] = frame[TIMER_B] | 0x06
-        frame[TIMER_C] = frame[TIMER_C] | 0x60
-
-        if self.state.timer == TIMER_MODE.SET_OFF:
-            mins = self.state.timer_duration * 60
-            if mins > 0xff:
-                frame[TIMER_C] = mins >> 8
-                frame[TIMER_B] = mins & 0xff
-            else:
-                frame[TIMER_C] = mins >> 4
-                frame[TIMER_B] = frame[TIMER_B] | (mins & 0x0f) << 4
-        elif self.state.timer == TIMER_MODE.SET_ON:
-            mins = self.state.timer_duration * 60
-            frame[TIMER_A] = mins & 0xff
-            frame[TIMER_B] = (mins >> 8) & 0xff
+        # Timer Delay - two 12 bit minute counts, little endian
+        # Timer ON sets duration at TIMER_A and the low nybble of TIMER_B
+        # Timer OFF sets duration at the high nybble of TIMER_B and TIMER_C
+        # an unset timer reads 0x600, see _timer_minutes
+        frame[TIMER_A], frame[TIMER_B], frame[TIMER_C] = _timer_bytes(
+            self.state)
 
         # Powerful
         if self.state.powerful:
@@ -355,81 +616,220 @@ class DaikinMessage:
         frame[index] = frame[index] | to
 
 
+def _timer_minutes(state):
+    # (on, off) as frame three has them, 0x600 when unset
+    on_minutes = off_minutes = 0x600
+    if state.timer == TIMER_MODE.ON:
+        on_minutes = state.timer_duration
+    elif state.timer == TIMER_MODE.OFF:
+        off_minutes = state.timer_duration
+    return on_minutes, off_minutes
+
+
+def _mode_power_byte(state):
+    value = state.ac_mode.value << 4 | 0x08 | state.power
+    if state.timer == TIMER_MODE.OFF:
+        value |= 0x04
+    elif state.timer == TIMER_MODE.ON:
+        value |= 0x02
+    return (value, )
+
+
+def _timer_bytes(state):
+    on_minutes, off_minutes = _timer_minutes(state)
+    return (on_minutes & 0xff, (on_minutes >> 8) | (off_minutes & 0x0f) << 4,
+            off_minutes >> 4)
+
+
+# the fields each run of bytes in the buffer depends on (see
+# DaikinMessage._encode_frame_*), what with_state patches
+_FIELD_BYTE_RUNS = (
+    (('comfort', ), FRAME_ONE.start + 6,
+     lambda state: (0x10 if state.comfort else 0, )),
+    (('ac_mode', 'power', 'timer'), FRAME_THREE.start + 5, _mode_power_byte),
+    (('temperature', ), FRAME_THREE.start + 6,
+     lambda state: (state.temperature << 1, )),
+    (('fan_mode', 'swing_horizontal'), FRAME_THREE.start + 8,
+     lambda state: (state.fan_mode.value << 4 | state.swing_horizontal, )),
+    (('swing_vertical', ), FRAME_THREE.start + 9,
+     lambda state: (int(state.swing_vertical), )),
+    (('timer', 'timer_duration'), FRAME_THREE.start + 10, _timer_bytes),
+    (('powerful', ), FRAME_THREE.start + 13,
+     lambda state: (int(state.powerful), )),
+    (('economy', ), FRAME_THREE.start + 16,
+     lambda state: (0x84 if state.economy else 0x80, )),
+)
+# as (fields getter, offset, encoder, offset of the frame's checksum)
+_FIELD_BYTES = tuple(
+    (attrgetter(*fields), offset, encode, frame.stop - 1)
+    for fields, offset, encode in _FIELD_BYTE_RUNS
+    for frame in (FRAME_ONE, FRAME_TWO, FRAME_THREE)
+    if frame.start <= offset < frame.stop)
+
+
+def _remote_header(name):
+    return '\n'.join([
+        'begin remote',
+        '    name    {}'.format(name),
+        '    flags   RAW_CODES',
+        '    eps     30',
+        '    aeps    100',
+        '    gap     34978',
+        '    begin raw_codes',
+        '        ',
+    ])
+
+
 class DaikinLIRC:
 
     GPIO_PIN_TX = 22
+    REMOTE_NAME = 'daikin-pi'
 
     PULSE = 430
     ZERO_GAP = 430
     ONE_GAP = 1320
+    FRAME_HEADER_PULSE = 3440
+    FRAME_HEADER_GAP = 1720
+    SHORT_GAP_SPACE = 25000
+    LONG_GAP_SPACE = 35500
 
     # these are strings as they will be output to an LIRC conf (as microsecond commands)
     ZERO = '{} {}'.format(PULSE, ZERO_GAP)
     ONE = '{} {}'.format(PULSE, ONE_GAP)
-    FRAME_HEADER = '3440 1720'
-    SHORT_GAP = '{} 25000'.format(PULSE)
-    LONG_GAP = '{} 35500'.format(PULSE)
+    FRAME_HEADER = '{} {}'.format(FRAME_HEADER_PULSE, FRAME_HEADER_GAP)
+    SHORT_GAP = '{} {}'.format(PULSE, SHORT_GAP_SPACE)
+    LONG_GAP = '{} {}'.format(PULSE, LONG_GAP_SPACE)
+
+    # fixed sections of the generated config, only the frames change
+    REMOTE_HEADER = _remote_header(REMOTE_NAME)
+    REMOTE_FOOTER = '\n    end raw_codes\nend remote\n'
+    CODE_PREAMBLE = '\n        '.join([''] + [ZERO] * 5 +
+                                      [SHORT_GAP, FRAME_HEADER, ''])
+    FRAME_SEPARATOR = '\n        '.join(['', LONG_GAP, FRAME_HEADER, ''])
+    CODE_END = '\n        {}'.format(PULSE)
+
+    def __init__(self, client=None, remote_name=None, socket=None):
+        """
+        client: an optional LircdClient, irsend is used without one
+        remote_name: lets several units share one lircd
+        socket: the lircd socket irsend talks to, lircd's default without one
+        """
+        self.client = client
+        self.remote_name = remote_name or self.REMOTE_NAME
+        self.remote_header = _remote_header(self.remote_name)
+        self.socket = socket
 
-    def _get_lsb_binary_string(self, frame):
-        # convert to binary byte string and reverse it
-        return "".join(['{0:08b}'.format(item)[::-1] for item in frame])
+    @property
+    def byte_table(self):
+        return lsb_byte_table(self.PULSE, self.ZERO_GAP, self.ONE_GAP)
 
     def _get_frame_codes(self, frame):
-        binary_frame = self._get_lsb_binary_string(frame)
-        # swap binary digits for pulse codes as defined above
-        return '\n        '.join([
-            self.ONE if digit == '1' else self.ZERO for digit in binary_frame
-        ])
+        # one pulse code line per bit, looked up a byte at a time
+        table = lsb_text_table(self.PULSE, self.ZERO_GAP, self.ONE_GAP,
+                               '\n        ')
+        return '\n        '.join(map(table.__getitem__, frame))
+
+    def get_pulse_train(self, message):
+        """
+        The whole message as alternating pulse/space lengths in microseconds,
+        starting and ending with a pulse
+        """
+        table = self.byte_table
+        train = PulseTrain()
+        for _ in range(5):
+            train.append(self.PULSE, self.ZERO_GAP)
+        train.append(self.PULSE, self.SHORT_GAP_SPACE)
+        frames = [message.frame_one, message.frame_two, message.frame_three]
+        for index, frame in enumerate(frames):
+            if index:
+                train.append(self.PULSE, self.LONG_GAP_SPACE)
+            train.append(self.FRAME_HEADER_PULSE, self.FRAME_HEADER_GAP)
+            train.extend_bytes(frame, table)
+        train.append(self.PULSE)
+        return train
+
+    def get_durations(self, message):
+        return list(self.get_pulse_train(message))
 
     def get_config(self, message):
-        frame_one = self._get_frame_codes(message.frame_one)
-        frame_two = self._get_frame_codes(message.frame_two)
-        frame_three = self._get_frame_codes(message.frame_three)
-        template = Template("""begin remote
-    name    daikin-pi
-    flags   RAW_CODES
-    eps     30
-    aeps    100
-    gap     34978
-    begin raw_codes
-        name dynamic-signal
-        {{zero}}
-        {{zero}}
-        {{zero}}
-        {{zero}}
-        {{zero}}
-        {{short_gap}}
-        {{frame_header}}
-        {{frame_one}}
-        {{long_gap}}
-        {{frame_header}}
-        {{frame_two}}
-        {{long_gap}}
-        {{frame_header}}
-        {{frame_three}}
-        {{pulse}}
-    end raw_codes
-end remote
-        """)
-        return template.render(
-            zero=self.ZERO,
-            pulse=self.PULSE,
-            frame_header=self.FRAME_HEADER,
-            short_gap=self.SHORT_GAP,
-            long_gap=self.LONG_GAP,
-            frame_one=frame_one,
-            frame_two=frame_two,
-            frame_three=frame_three,
-        )
+        return ''.join([
+            self.remote_header,
+            self.get_raw_code(message, LIRC_DYNAMIC_CODE),
+            self.REMOTE_FOOTER,
+            # left over from the template this used to be rendered from
+            '        ',
+        ])
 
-    def transmit(self, config):
+    def get_raw_code(self, message, name):
+        """
+        A single named entry for the raw_codes section of a remote
+        """
+        return ''.join([
+            'name ',
+            name,
+            self.CODE_PREAMBLE,
+            self._get_frame_codes(message.frame_one),
+            self.FRAME_SEPARATOR,
+            self._get_frame_codes(message.frame_two),
+            self.FRAME_SEPARATOR,
+            self._get_frame_codes(message.frame_three),
+            self.CODE_END,
+        ])
+
+    def send(self, message):
+        with STAGE_SECONDS.time('render'):
+            config = self.get_config(message)
+        self.transmit(config)
 
-        with open(DAIKIN_LIRC_CONFIG_TMP, 'w') as config_file:
-            config_file.write(config)
+    def send_once(self, code):
+        with STAGE_SECONDS.time('send_once'):
+            if self.client is not None:
+                self.client.send_once(self.remote_name, code)
+            else:
+                command = list(LIRC_SEND_COMMAND)
+                if self.socket:
+                    command.append('--device={}'.format(self.socket))
+                subprocess.check_output(
+                    command + ['SEND_ONCE', self.remote_name, code])
 
-        subprocess.check_output(LIRC_CONFIG_COPY_CMD)
-        subprocess.check_output(LIRC_RESTART)
-        subprocess.check_output(LIRC_SEND_COMMAND)
+    def transmit(self, config):
+        config_tmp = DAIKIN_LIRC_CONFIG_TMP.format(self.remote_name)
+        with STAGE_SECONDS.time('write_config'):
+            with open(config_tmp, 'w') as config_file:
+                config_file.write(config)
+
+        with STAGE_SECONDS.time('copy_config'):
+            subprocess.check_output(
+                ['sudo', 'cp', config_tmp, LIRC_CONFIG_DIR])
+        with STAGE_SECONDS.time('restart_lircd'):
+            subprocess.check_output(LIRC_RESTART)
+        self.send_once(LIRC_DYNAMIC_CODE)
+
+
+def create_lirc(mode=None,
+                sender=None,
+                remote_name=None,
+                device=None,
+                socket=None):
+    mode = mode or DAIKIN_LIRC_MODE
+    sender = sender or DAIKIN_LIRC_SENDER
+
+    if mode == 'device':
+        # lircd isn't involved at all
+        from .lirc_device import DaikinLIRCDevice
+        return DaikinLIRCDevice(device=device)
+
+    client = None
+    if sender == 'socket':
+        from .lircd_client import LircdClient
+        client = LircdClient(socket)
+
+    if mode == 'codebook':
+        from .codebook import DaikinLIRCCodebook
+        return DaikinLIRCCodebook(client=client,
+                                  remote_name=remote_name,
+                                  socket=socket)
+    return DaikinLIRC(client=client, remote_name=remote_name, socket=socket)
 
 
 class DaikinController:
@@ -437,50 +837,359 @@ class DaikinController:
         A simple state controller for the Daikin
         Persists the state each time it is set and allows incremental changes
         (Does the job of the remote control persistence)
+
+        With background=True saving and transmitting are handed to worker
+        threads (latest state wins) and set_state returns straight away,
+        the controller then keeps the current state in memory so
+        incremental changes never wait on a pending save
+
+        The controller's in-memory state is authoritative, saves replace the
+        storage file atomically and with flush_interval (background only)
+        are batched so at most one write happens per interval, stop()
+        writes whatever is still pending
+
+        With a store_file the current state lives in a StateStore shared
+        with other processes instead, incremental updates are applied with
+        compare-and-swap so concurrent changes from the web server and the
+        MQTT service never overwrite each other
+
+        The last state actually transmitted is remembered and sending the
+        same state again is skipped (eg. retained MQTT messages replayed on
+        reconnect), pass force=True to resend anyway
+
+        With a pool (a WorkerPool, background only) transmissions run on the
+        pool's threads in the given emitter's lane, so controllers sharing
+        an emitter never transmit over each other
+
+        on_transmit, if set, is called with every state actually sent
+
+        Timers run on the unit itself (see arm_timer). Later states that
+        carry the same timer on are sent with the minutes left rather than
+        restarting it, and once it has run out the state takes the power
+        setting the unit switched to. The deadline is kept with the state
+        (in the StateStore record or the storage file) so every process
+        sharing it counts down to the same moment.
     """
 
     def __init__(self,
                  storage_file=None,
                  autosave=True,
                  autotransmit=True,
-                 lirc=None):
+                 lirc=None,
+                 background=False,
+                 flush_interval=0,
+                 store_file=None,
+                 pool=None,
+                 emitter=None,
+                 frame_table=None):
+        """
+        frame_table: a frame_table.FrameTable to take encoded frames from,
+        the built table in FRAME_TABLE_FILE is used when there is one
+        """
         self.autotransmit = autotransmit
         self.autosave = autosave
-        self.storage_file = os.path.join(os.path.dirname(__file__),
-                                         '../data/config.json')
-        self.lirc = lirc or DaikinLIRC()
+        self.storage_file = storage_file or data_file('config.json')
+        self.lirc = lirc or create_lirc()
+        self.state = None
+        if frame_table is None:
+            from .frame_table import load_frame_table
+            frame_table = load_frame_table()
+        self.frame_table = frame_table
+
+        self.store = None
+        if store_file:
+            from .state_store import StateStore
+            # seeded from the JSON file the first time
+            self.store = StateStore(store_file, initial=self.load)
+        self.last_transmitted = None
+        self.last_message = None
+        self.sent_count = 0
+        self.skipped_count = 0
+        self.on_transmit = None
+        self._timer_expires = None
+        # held from working out a change until it's saved and queued (or
+        # sent), so this process never saves or sends an older state after
+        # a newer one. The store orders changes across processes
+        self.lock = threading.Lock()
+
+        self.persister = None
+        self.transmitter = None
+        if background:
+            from .worker import LatestWinsWorker
+            self.persister = LatestWinsWorker(self.save,
+                                              name='daikin-persister',
+                                              interval=flush_interval)
+            self.persister.start()
+            if pool is not None:
+                self.transmitter = pool.worker(
+                    emitter, lambda item: self.transmit(*item),
+                    merge=_merge_transmissions)
+            else:
+                self.transmitter = LatestWinsWorker(
+                    lambda item: self.transmit(*item),
+                    name='daikin-transmitter',
+                    merge=_merge_transmissions)
+                self.transmitter.start()
 
-    def save(self, state):
-        with open(self.storage_file, 'w') as f:
-            print('writing to {}'.format(self.storage_file))
-            json.dump(state.serialize(), f)
+    def save(self, state, timer_expires=None):
+        """
+        timer_expires: the deadline of state's timer, the one kept with the
+        current state by default
+        """
+        if timer_expires is None:
+            timer_expires = self._timer_expires_for(state)
+        with STAGE_SECONDS.time('save'), span('save', state=state):
+            self._save(state, timer_expires)
+
+    def _save(self, state, timer_expires=None):
+        # written next to the real file and renamed over it, a crash leaves
+        # either the old state or the new one, never a truncated file.
+        # the temp name is unique so concurrent writers can't mix their data
+        import tempfile
+        data = state.serialize()
+        if timer_expires is not None:
+            data['timer_expires'] = timer_expires
+        make_parent_dir(self.storage_file)
+        fd, tmp_file = tempfile.mkstemp(
+            prefix='{}.'.format(os.path.basename(self.storage_file)),
+            suffix='.tmp',
+            dir=os.path.dirname(os.path.abspath(self.storage_file)))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.storage_file)
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
+        self._fsync_directory()
+
+    def _fsync_directory(self):
+        # makes the rename itself durable
+        try:
+            fd = os.open(os.path.dirname(os.path.abspath(self.storage_file)),
+                         os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
 
     def load(self):
-        with open(self.storage_file, 'r') as f:
-            data = None
+        return self._load_record()[0]
+
+    def _load_record(self):
+        """
+        (state, timer_expires) from the storage file
+        """
+        data = None
+        with STAGE_SECONDS.time('load'):
             try:
-                data = json.load(f)
-            except ValueError:
+                with open(self.storage_file, 'r') as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                # a fresh install, it's written on the first change
                 pass
+            except ValueError:
+                logger.error('Invalid state in {}, using defaults'.format(
+                    self.storage_file))
+
+        if not data:
+            return DaikinState(), None
+        timer_expires = data.pop('timer_expires', None)
+        return DaikinState.deserialize(data), timer_expires
 
-        return DaikinState.deserialize(data) if data else DaikinState()
+    def _record(self):
+        """
+        The current state as stored, and its timer's deadline
+        """
+        if self.store is not None:
+            return self.store.read_record()[1:]
+        if self.state is None:
+            self.state, self._timer_expires = self._load_record()
+        return self.state, self._timer_expires
 
-    def transmit(self, state):
-        message = DaikinMessage(state)
-        config = self.lirc.get_config(message)
-        print('Transmitting to LIRC')
-        self.lirc.transmit(config)
+    @property
+    def timer_expires(self):
+        """
+        When the current state's timer runs out (time.time()), or None
+        """
+        return self._record()[1]
+
+    def _timer_expires_for(self, state):
+        if state.timer == TIMER_MODE.NONE:
+            return None
+        current, timer_expires = self._record()
+        if (current.timer, current.timer_duration) != (state.timer,
+                                                       state.timer_duration):
+            return None
+        return timer_expires
+
+    def current_state(self):
+        state, timer_expires = self._record()
+        return _expire_timer(state, timer_expires, time.time())[0]
+
+    def transmit(self, state, force=False):
+        if not force and state == self.last_transmitted:
+            self.skipped_count += 1
+            TRANSMISSIONS.inc('skipped')
+            logger.info('State unchanged, skipping transmission '
+                        '({} sent, {} skipped)'.format(self.sent_count,
+                                                       self.skipped_count))
+            return False
+
+        if self.store is not None:
+            # another process may have changed the state since this one was
+            # queued, the unit should end up in the latest one
+            _, state, timer_expires = self.store.read_record()
+            if not force and state == self.last_transmitted:
+                self.skipped_count += 1
+                TRANSMISSIONS.inc('skipped')
+                return False
+        else:
+            timer_expires = self._timer_expires_for(state)
+
+        message = self._message(_with_time_left(state, timer_expires,
+                                                time.time()))
+        try:
+            with STAGE_SECONDS.time('transmit'), span('transmit',
+                                                      state=state):
+                self.lirc.send(message)
+        except Exception:
+            TRANSMISSIONS.inc('failed')
+            raise
+        TRANSMISSIONS.inc('sent')
+        self.last_transmitted = state
+        self.last_message = message
+        self.sent_count += 1
+        if self.on_transmit is not None:
+            try:
+                self.on_transmit(state)
+            except Exception:
+                logger.exception('on_transmit failed')
+        return True
+
+    def _message(self, state):
+        if self.frame_table is not None and state in self.frame_table:
+            return self.frame_table.message(state)
+        if self.last_message is not None:
+            # usually only a field or two away from the last one
+            return self.last_message.with_state(state)
+        return DaikinMessage(state)
+
+    def set_state(self, state, force=False):
+        with STAGE_SECONDS.time('set_state'), span('set_state',
+                                                   state=state):
+            return self._set_state(state, force)
+
+    def _set_state(self, state, force=False):
+        with self.lock:
+            previous, state = self._change(lambda current: state)
+            return self._apply_state(state, previous, force)
+
+    def change(self, func, force=False):
+        """
+        Replaces the current state with func(current), eg. a step up in
+        temperature. func runs against the latest state (inside the
+        store's compare-and-swap, maybe more than once) so concurrent
+        changes all count, unlike reading the state and then setting it
+        """
+        with STAGE_SECONDS.time('update'), span('change'), self.lock:
+            previous, state = self._change(func)
+            return self._apply_state(state, previous, force)
 
-    def set_state(self, state):
-        print('setting state')
-        if self.autosave:
-            print('autosaving')
-            self.save(state)
+    def _change(self, change, rearm=False):
+        """
+        Replaces the current state with change(current), current having
+        had its timer run out if it's due. Returns (previous, new) states,
+        called with the lock held
+
+        The timer's deadline is stored with the state, it only moves when
+        the timer itself changes (or with rearm, the unit restarts its
+        countdown whenever it's sent one), so every process sharing the
+        state counts down to the same moment
+        """
+        now = time.time()
+
+        def next_record(current, timer_expires):
+            # runs inside the store's compare-and-swap, maybe more than once
+            previous, timer_expires = _expire_timer(current, timer_expires,
+                                                    now)
+            state = change(previous)
+            if state.timer == TIMER_MODE.NONE:
+                return state, None
+            if (rearm or timer_expires is None
+                    or (state.timer, state.timer_duration) !=
+                    (previous.timer, previous.timer_duration)):
+                timer_expires = now + state.timer_duration * 60
+            return state, timer_expires
+
+        if self.store is not None:
+            previous, state, _ = self.store.update_record(next_record)
+        else:
+            previous, timer_expires = self._record()
+            state, self._timer_expires = next_record(previous,
+                                                     timer_expires)
+        self.state = state
+        return previous, state
+
+    def _apply_state(self, state, previous, force=False):
+        event('apply_state', state=state, previous=previous)
+        if self.autosave and state != previous:
+            if self.persister is not None:
+                event('queue_save', state=state)
+                self.persister.submit(state)
+            else:
+                self.save(state)
         if self.autotransmit:
-            print('autotransmitting')
-            self.transmit(state)
+            if self.transmitter is not None:
+                event('queue_transmit', state=state, force=force)
+                self.transmitter.submit((state, force))
+            else:
+                self.transmit(state, force)
         return state
 
+    def resend(self):
+        """
+        Transmits the current state even if it was the last one sent
+        """
+        return self.set_state(self.current_state(), force=True)
+
+    def sync(self, state):
+        """
+        Takes a state the unit received from elsewhere (its own remote, see
+        decoder.py) as the current one, it's saved but not transmitted
+        """
+        event('sync', state=state)
+        with self.lock:
+            # the unit restarted any timer in it when it received it
+            previous, state = self._change(lambda current: state,
+                                           rearm=True)
+            self.last_transmitted = state
+            if self.autosave and state != previous:
+                if self.persister is not None:
+                    self.persister.submit(state)
+                else:
+                    self.save(state)
+        if self.on_transmit is not None:
+            try:
+                self.on_transmit(state)
+            except Exception:
+                logger.exception('on_transmit failed')
+        return state
+
+    def stop(self, timeout=None):
+        """
+        Finishes any pending save and transmission and stops the workers
+        """
+        for worker in (self.transmitter, self.persister):
+            if worker is not None:
+                worker.stop(timeout)
+
     def update(
             self,
             power=None,
@@ -490,33 +1199,92 @@ class DaikinController:
             swing_vertical=None,
             swing_horizontal=None,
             powerful=None,
+            economy=None,
+            comfort=None,
+            timer=None,
+            timer_duration=None,
+            force=False,
     ):
-        state = self.load()
+        """
+        Applies any subset of the fields at once, one save and one
+        transmission however many change
+        """
+        changes = {
+            'power': power,
+            'temperature': temperature,
+            'ac_mode': ac_mode,
+            'fan_mode': fan_mode,
+            'swing_vertical': swing_vertical,
+            'swing_horizontal': swing_horizontal,
+            'powerful': powerful,
+            'economy': economy,
+            'comfort': comfort,
+            'timer': timer,
+            'timer_duration': timer_duration,
+        }
+        changes = {
+            name: value
+            for name, value in changes.items() if value is not None
+        }
+        return self._update(changes, force)
 
-        if power is not None:
-            state.power = power
+    def _update(self, changes, force=False, rearm=False):
+        with STAGE_SECONDS.time('update'), span('update', changes=changes), \
+                self.lock:
+            previous, state = self._change(
+                lambda current: current.replace(**changes), rearm)
+            self._apply_state(state, previous, force=force)
 
-        if temperature is not None:
-            state.temperature = temperature
+        return state
 
-        if ac_mode is not None:
-            state.ac_mode = ac_mode
+    def arm_timer(self, mode, minutes):
+        """
+        Has the unit itself switch on (TIMER_MODE.ON) or off (TIMER_MODE.OFF)
+        in minutes (1 to DaikinState.MAX_TIMER_DURATION), replacing any timer
+        already armed. Nothing on this side needs to be awake when it fires
 
-        if fan_mode is not None:
-            state.fan_mode = fan_mode
+        Arming the same timer again restarts it, and is sent even though the
+        state hasn't changed so the unit restarts it too
+        """
+        if mode == TIMER_MODE.NONE:
+            return self.cancel_timer()
+        return self._update({'timer': mode, 'timer_duration': minutes},
+                            force=True, rearm=True)
 
-        if swing_horizontal is not None:
-            state.swing_horizontal = swing_horizontal
+    def cancel_timer(self):
+        return self.update(timer=TIMER_MODE.NONE)
 
-        if swing_vertical is not None:
-            state.swing_vertical = swing_vertical
 
-        if powerful is not None:
-            state.powerful = powerful
+def _expire_timer(state, timer_expires, now):
+    """
+    (state, timer_expires) with a timer that has run out applied: the unit
+    has switched itself on or off and forgotten it
+    """
+    if (state.timer == TIMER_MODE.NONE or timer_expires is None
+            or now < timer_expires):
+        return state, timer_expires
+    return state.replace(power=state.timer == TIMER_MODE.ON,
+                         timer=TIMER_MODE.NONE), None
 
-        self.set_state(state)
 
+def _with_time_left(state, timer_expires, now):
+    """
+    state as it should be sent: a pending timer carries the minutes left
+    rather than restarting
+    """
+    state, timer_expires = _expire_timer(state, timer_expires, now)
+    if timer_expires is None:
         return state
+    return state.replace(
+        timer_duration=int(math.ceil((timer_expires - now) / 60)))
+
+
+def _merge_transmissions(pending, item):
+    """
+    The transmitter's (state, force) replacing a pending one: the latest
+    state, still forced if either was (eg. a resend)
+    """
+    return item[0], pending[1] or item[1]
 
 
 """
@@ -0,0 +1,279 @@
+"""
+Decodes what a Daikin remote sends back into a DaikinState, the inverse of
+DaikinMessage and DaikinLIRC, so the state can follow the unit when someone
+uses the real remote
+
+DaikinDecoder takes mark/space durations one at a time from a receiver
+(mode2 text, a LIRC device in mode2, a PulseTrain) and holds no more than
+the frame it's in the middle of. Durations match their nominal timings
+within the same eps/aeps tolerances lircd uses for the generated config.
+"""
+import os
+import struct
+import threading
+import logging
+
+from .daikin import AC_MODE, FAN_MODE, TIMER_MODE, DaikinLIRC, DaikinState
+logger = logging.getLogger(__name__)
+
+# the LIRC device of an IR receiver, eg. /dev/lirc1 (see Receiver)
+LIRC_RECEIVER_DEVICE = os.environ.get('LIRC_RECEIVER_DEVICE')
+
+# as in the generated config: a duration matches within eps percent or
+# aeps microseconds of the nominal one, whichever is more lenient
+EPS = 30
+AEPS = 100
+
+HEADER = bytes([0x11, 0xda, 0x27, 0x00])
+FRAME_ONE_ID = 0xc5
+FRAME_TWO_ID = 0x42
+FRAME_THREE_ID = 0x00
+SHORT_FRAME_LENGTH = 8
+LONG_FRAME_LENGTH = 19
+
+# from linux/lirc.h, what a receiving device reads in LIRC_MODE_MODE2
+LIRC_MODE2_MASK = 0xff000000
+LIRC_VALUE_MASK = 0x00ffffff
+LIRC_MODE2_SPACE = 0x00000000
+LIRC_MODE2_PULSE = 0x01000000
+LIRC_MODE2_TIMEOUT = 0x03000000
+
+# where the decoder is up to
+_IDLE = 0
+_HEADER_SPACE = 1
+_BIT_MARK = 2
+_BIT_SPACE = 3
+
+
+def matches(duration, nominal, eps=EPS, aeps=AEPS):
+    return abs(duration - nominal) <= max(nominal * eps / 100, aeps)
+
+
+def is_valid_frame(frame):
+    return (len(frame) in (SHORT_FRAME_LENGTH, LONG_FRAME_LENGTH)
+            and frame[:len(HEADER)] == HEADER
+            and sum(frame[:-1]) & 0xff == frame[-1])
+
+
+def state_from_frames(frame_three, frame_one=None):
+    """
+    The state a (valid) third frame encodes, comfort comes from the first
+    frame and is off without it. Raises ValueError for modes DaikinState
+    doesn't know
+    """
+    mode_power = frame_three[5]
+    on_minutes = frame_three[10] | (frame_three[11] & 0x0f) << 8
+    off_minutes = frame_three[11] >> 4 | frame_three[12] << 4
+    timer, timer_duration = TIMER_MODE.NONE, 0
+    if mode_power & 0x02:
+        timer, timer_duration = TIMER_MODE.ON, on_minutes
+    elif mode_power & 0x04:
+        timer, timer_duration = TIMER_MODE.OFF, off_minutes
+    return DaikinState(
+        power=bool(mode_power & 0x01),
+        temperature=frame_three[6] >> 1,
+        ac_mode=AC_MODE(mode_power >> 4),
+        fan_mode=FAN_MODE(frame_three[8] >> 4),
+        swing_vertical=bool(frame_three[9] & 0x0f),
+        swing_horizontal=bool(frame_three[8] & 0x0f),
+        economy=bool(frame_three[16] & 0x04),
+        comfort=bool(frame_one is not None and frame_one[6] & 0x10),
+        powerful=bool(frame_three[13] & 0x01),
+        timer=timer,
+        timer_duration=timer_duration,
+    )
+
+
+class DaikinDecoder:
+    """
+        Rebuilds states from a stream of marks and spaces, feed() returns
+        a DaikinState whenever one completes
+
+        Anything that isn't a frame (the wake-up preamble, other remotes,
+        noise) is skipped, a frame that breaks off or fails its checksum is
+        counted in errors and dropped, and the decoder picks up again at
+        the next frame header.
+    """
+
+    def __init__(self, eps=EPS, aeps=AEPS, timings=DaikinLIRC):
+        self.eps = eps
+        self.aeps = aeps
+        self.timings = timings
+        self.stage = _IDLE
+        self.frame = bytearray()
+        self.value = 0
+        self.bits = 0
+        self.frame_one = None
+        self.frames = 0
+        self.errors = 0
+
+    def feed(self, pulse, duration):
+        """
+        pulse: whether it's a mark (IR on) or a space
+        """
+        if pulse:
+            self._mark(duration)
+            return None
+        return self._space(duration)
+
+    def feed_durations(self, durations):
+        """
+        Alternating marks and spaces starting with a mark (eg. a PulseTrain
+        or lircd raw code), yields the states they decode to
+        """
+        pulse = True
+        for duration in durations:
+            state = self.feed(pulse, duration)
+            if state is not None:
+                yield state
+            pulse = not pulse
+
+    def feed_all(self, items):
+        """
+        (pulse, duration) pairs, yields the states they decode to
+        """
+        for pulse, duration in items:
+            state = self.feed(pulse, duration)
+            if state is not None:
+                yield state
+
+    def end(self):
+        """
+        The stream stopped (eg. a receiver timeout), finishes any frame
+        """
+        return self._space(float('inf'))
+
+    def _matches(self, duration, nominal):
+        return matches(duration, nominal, self.eps, self.aeps)
+
+    def _mark(self, duration):
+        if self._matches(duration, self.timings.FRAME_HEADER_PULSE):
+            if self.stage != _IDLE:
+                self._error('frame header in the middle of a frame')
+            self.stage = _HEADER_SPACE
+        elif (self.stage == _BIT_MARK
+              and self._matches(duration, self.timings.PULSE)):
+            self.stage = _BIT_SPACE
+        elif self.stage != _IDLE:
+            self._error('unexpected mark of {}us'.format(duration))
+
+    def _space(self, duration):
+        if self.stage == _BIT_SPACE:
+            if self._matches(duration, self.timings.ZERO_GAP):
+                return self._bit(0)
+            if self._matches(duration, self.timings.ONE_GAP):
+                return self._bit(1)
+            # the gap after a frame's trailing mark
+            return self._end_frame()
+        if self.stage == _HEADER_SPACE and self._matches(
+                duration, self.timings.FRAME_HEADER_GAP):
+            del self.frame[:]
+            self.value = self.bits = 0
+            self.stage = _BIT_MARK
+        elif self.stage != _IDLE:
+            self._error('unexpected space of {}us'.format(duration))
+        return None
+
+    def _bit(self, bit):
+        # bytes are sent least significant bit first
+        self.value |= bit << self.bits
+        self.bits += 1
+        self.stage = _BIT_MARK
+        if self.bits == 8:
+            self.frame.append(self.value)
+            self.value = self.bits = 0
+            if len(self.frame) == LONG_FRAME_LENGTH:
+                # nothing is longer, no need to wait for the gap
+                return self._end_frame()
+        return None
+
+    def _end_frame(self):
+        self.stage = _IDLE
+        frame = bytes(self.frame)
+        if self.bits or not is_valid_frame(frame):
+            self._error('invalid frame {}'.format(frame.hex()))
+            return None
+        self.frames += 1
+        if len(frame) == SHORT_FRAME_LENGTH:
+            if frame[4] == FRAME_ONE_ID:
+                self.frame_one = frame
+            return None
+
+        frame_one, self.frame_one = self.frame_one, None
+        if frame[4] != FRAME_THREE_ID:
+            return None
+        try:
+            return state_from_frames(frame, frame_one)
+        except ValueError as e:
+            self._error('undecodable frame {}: {}'.format(frame.hex(), e))
+            return None
+
+    def _error(self, reason):
+        logger.debug('Decoder reset: {}'.format(reason))
+        self.errors += 1
+        self.stage = _IDLE
+
+
+def read_mode2(lines):
+    """
+    (pulse, duration) pairs from mode2's text output ("pulse 430",
+    "space 1320", "timeout 125000"), other lines are skipped
+    """
+    for line in lines:
+        parts = line.split()
+        if len(parts) != 2 or not parts[1].isdigit():
+            continue
+        kind, duration = parts[0], int(parts[1])
+        if kind == 'pulse':
+            yield True, duration
+        elif kind in ('space', 'timeout'):
+            yield False, duration
+
+
+def read_lirc_device(f, chunk_size=512):
+    """
+    (pulse, duration) pairs from a LIRC device in mode2 (native unsigned
+    32 bit values), a timeout comes through as a space
+    """
+    while True:
+        data = f.read(chunk_size * 4)
+        if not data:
+            return
+        data = data[:len(data) - len(data) % 4]
+        for value, in struct.iter_unpack('I', data):
+            mode = value & LIRC_MODE2_MASK
+            if mode == LIRC_MODE2_PULSE:
+                yield True, value & LIRC_VALUE_MASK
+            elif mode in (LIRC_MODE2_SPACE, LIRC_MODE2_TIMEOUT):
+                yield False, value & LIRC_VALUE_MASK
+
+
+class Receiver(threading.Thread):
+    """
+        Decodes an IR receiver's LIRC device on a background thread and
+        passes each state received to on_state (eg. DaikinController.sync)
+    """
+
+    def __init__(self, device, on_state, name=None):
+        super().__init__(name=name or 'daikin-receiver')
+        self.daemon = True
+        self.device = device
+        self.on_state = on_state
+        self.decoder = DaikinDecoder()
+        self.stopping = False
+
+    def stop(self):
+        # the read blocks until the next IR, the thread is a daemon
+        self.stopping = True
+
+    def run(self):
+        with open(self.device, 'rb', buffering=0) as f:
+            for state in self.decoder.feed_all(read_lirc_device(f)):
+                if self.stopping:
+                    return
+                logger.info('Received {} from the remote'.format(
+                    state.key()))
+                try:
+                    self.on_state(state)
+                except Exception:
+                    logger.exception('Failed to apply received state')
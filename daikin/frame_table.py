@@ -0,0 +1,249 @@
+"""
+Every state's encoded frames, computed ahead of time into a memory mapped
+table indexed by packed state so sending one is a slice instead of
+DaikinMessage building three frames bit by bit
+
+    python -m daikin.frame_table build [PATH]
+    python -m daikin.frame_table verify [PATH]
+
+Building needs NumPy (encode_packed works on whole arrays of packed
+states at once), using the table doesn't. The table holds the states
+without a timer (the first TABLE_STATE_COUNT packed values, a timer is the
+most significant digit of a packed state); states with a timer are
+encoded by DaikinMessage as before.
+
+Layout: magic (4 bytes), format version (u16), record size (u16), state
+count (u32), then one record per packed state of frame one, frame two and
+frame three back to back.
+"""
+import os
+import sys
+import mmap
+import struct
+import threading
+import logging
+
+from .daikin import (FRAME_ONE, FRAME_THREE, FRAME_TWO, MESSAGE_SIZE,
+                     DaikinMessage, DaikinState, data_file, make_parent_dir)
+logger = logging.getLogger(__name__)
+
+FRAME_TABLE_FILE = os.environ.get('DAIKIN_FRAME_TABLE',
+                                  data_file('frames.bin'))
+
+MAGIC = b'DKFT'
+# bump whenever the encoding changes, older tables are then ignored
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHHI')
+
+# a record is a DaikinMessage buffer
+RECORD_SIZE = MESSAGE_SIZE
+
+# DaikinState.STATE_COUNT divided by the timer digit's radix
+TABLE_STATE_COUNT = DaikinState.STATE_COUNT // DaikinState._RADICES[0]
+
+
+def encode_packed(packed):
+    """
+    The records for an array of packed states, as an (n, RECORD_SIZE)
+    uint8 array. The vectorised twin of DaikinMessage, states with timers
+    included
+    """
+    import numpy as np
+
+    remaining = np.asarray(packed, dtype=np.int64)
+    digits = []
+    for radix in reversed(DaikinState._RADICES):
+        remaining, digit = np.divmod(remaining, radix)
+        digits.append(digit)
+    (powerful, comfort, economy, swing_horizontal, swing_vertical,
+     fan_index, ac_index, temperature_index, power, timer) = digits
+
+    ac_mode = np.array([mode.value for mode in DaikinState._AC_MODES])
+    fan_mode = np.array([mode.value for mode in DaikinState._FAN_MODES])
+    on = (timer > 0) & (timer <= DaikinState.MAX_TIMER_DURATION)
+    off = timer > DaikinState.MAX_TIMER_DURATION
+    # an unset timer reads 0x600, see DaikinMessage.frame_three
+    on_minutes = np.where(on, timer, 0x600)
+    off_minutes = np.where(off, timer - DaikinState.MAX_TIMER_DURATION,
+                           0x600)
+
+    records = np.zeros((len(remaining), RECORD_SIZE), dtype=np.int64)
+    for frame, message_id in ((FRAME_ONE, 0xc5), (FRAME_TWO, 0x42),
+                              (FRAME_THREE, 0x00)):
+        start = frame.start
+        records[:, start:start + 5] = [0x11, 0xda, 0x27, 0x00, message_id]
+    records[:, FRAME_ONE.start + 6] = comfort * 0x10
+
+    three = records[:, FRAME_THREE]
+    three[:, 5] = (ac_mode[ac_index] << 4 | 0x08 | off * 0x04 | on * 0x02
+                   | power)
+    three[:, 6] = (temperature_index + DaikinState.MIN_TEMPERATURE) << 1
+    three[:, 8] = fan_mode[fan_index] << 4 | swing_horizontal
+    three[:, 9] = swing_vertical
+    three[:, 10] = on_minutes & 0xff
+    three[:, 11] = on_minutes >> 8 | (off_minutes & 0x0f) << 4
+    three[:, 12] = off_minutes >> 4
+    three[:, 13] = powerful
+    three[:, 15] = 0xc1
+    three[:, 16] = 0x80 | economy * 0x04
+
+    for frame in (FRAME_ONE, FRAME_TWO, FRAME_THREE):
+        section = records[:, frame]
+        section[:, -1] = section[:, :-1].sum(axis=1) & 0xff
+    return records.astype(np.uint8)
+
+
+def encode_record(state):
+    """
+    A state's record with the scalar encoder
+    """
+    return DaikinMessage(state).buffer
+
+
+def build(path=None, count=TABLE_STATE_COUNT):
+    """
+    Writes the table (atomically, like the state file), returns its path
+    """
+    import tempfile
+    import numpy as np
+
+    path = path or FRAME_TABLE_FILE
+    records = encode_packed(np.arange(count))
+    make_parent_dir(path)
+    fd, tmp_file = tempfile.mkstemp(
+        prefix='{}.'.format(os.path.basename(path)),
+        suffix='.tmp',
+        dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, RECORD_SIZE, count))
+            f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+    return path
+
+
+class FrameTable:
+    """
+        A built table, read through a shared read-only memory map
+    """
+
+    def __init__(self, path=None):
+        self.path = path or FRAME_TABLE_FILE
+        with open(self.path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, record_size, count = HEADER.unpack_from(self.map)
+            if magic != MAGIC:
+                raise ValueError('{} is not a frame table'.format(self.path))
+            if (version, record_size) != (FORMAT_VERSION, RECORD_SIZE):
+                raise ValueError(
+                    '{} is version {}, expected {}, rebuild it'.format(
+                        self.path, version, FORMAT_VERSION))
+            if len(self.map) != HEADER.size + count * RECORD_SIZE:
+                raise ValueError('{} is truncated'.format(self.path))
+        except Exception:
+            self.map.close()
+            raise
+        self.count = count
+        self.view = memoryview(self.map)[HEADER.size:]
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, state):
+        return state.pack() < self.count
+
+    def record(self, state):
+        """
+        The state's three frames as a memoryview into the table, None if
+        the table doesn't have it
+        """
+        packed = state.pack()
+        if packed >= self.count:
+            return None
+        offset = packed * RECORD_SIZE
+        return self.view[offset:offset + RECORD_SIZE]
+
+    def message(self, state):
+        """
+        A message for the state, from the table when it's there
+        """
+        record = self.record(state)
+        if record is None:
+            return DaikinMessage(state)
+        return DaikinMessage(state, record)
+
+    def verify(self):
+        """
+        Compares every record with the scalar encoder, returns the packed
+        states that differ
+        """
+        return [
+            packed for packed in range(self.count)
+            if self.view[packed * RECORD_SIZE:(packed + 1) *
+                         RECORD_SIZE] != encode_record(
+                             DaikinState.unpack(packed))
+        ]
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # records still held (eg. by a message being sent) keep the
+            # mapping alive until they're gone
+            pass
+
+
+_shared_table = None
+_shared_lock = threading.Lock()
+
+
+def load_frame_table(path=None):
+    """
+    The table at path (FRAME_TABLE_FILE by default) opened once per
+    process, None if there isn't a usable one
+    """
+    global _shared_table
+    path = path or FRAME_TABLE_FILE
+    with _shared_lock:
+        if _shared_table is not None and _shared_table.path == path:
+            return _shared_table
+        if not os.path.exists(path):
+            return None
+        try:
+            table = FrameTable(path)
+        except (OSError, ValueError) as e:
+            logger.warning('Not using frame table: {}'.format(e))
+            return None
+        _shared_table = table
+        return table
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in ('build', 'verify'):
+        print('usage: python -m daikin.frame_table build|verify [PATH]',
+              file=sys.stderr)
+        return 2
+    path = argv[1] if len(argv) > 1 else FRAME_TABLE_FILE
+    if argv[0] == 'build':
+        build(path)
+    table = FrameTable(path)
+    mismatched = table.verify()
+    table.close()
+    for packed in mismatched[:10]:
+        print('Mismatch for {}'.format(DaikinState.unpack(packed).key()),
+              file=sys.stderr)
+    print('{}: {} states, {} mismatched'.format(path, len(table),
+                                               len(mismatched)))
+    return 1 if mismatched else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,200 @@
+import os
+import json
+import socket
+import threading
+import logging
+
+import paho.mqtt.client as mqtt
+from .daikin import AC_MODE, FAN_MODE, DaikinState
+logger = logging.getLogger(__name__)
+
+HA_DISCOVERY_PREFIX = os.environ.get('HA_DISCOVERY_PREFIX', 'homeassistant')
+
+# retained state topics, relative to the unit's topic prefix
+POWER_STATE_TOPIC = 'power/state'
+MODE_STATE_TOPIC = 'mode/state'
+TEMPERATURE_STATE_TOPIC = 'temperature/state'
+FAN_STATE_TOPIC = 'fan/state'
+SWING_STATE_TOPIC = 'swing/state'
+
+# the reverse of the set-command payloads mqtt_service understands
+MODE_PAYLOADS = {
+    AC_MODE.AUTO: 'auto',
+    AC_MODE.DRY: 'dry',
+    AC_MODE.COOL: 'cool',
+    AC_MODE.HEAT: 'heat',
+    AC_MODE.FAN: 'fan_only',
+}
+FAN_PAYLOADS = {
+    FAN_MODE.AUTO: 'auto',
+    FAN_MODE.SILENT: 'auto',
+    FAN_MODE.ONE: 'low',
+    FAN_MODE.TWO: 'low',
+    FAN_MODE.THREE: 'medium',
+    FAN_MODE.FOUR: 'high',
+    FAN_MODE.FIVE: 'high',
+}
+
+
+def state_payloads(state):
+    """
+    Retained state topic -> payload for every published field
+    """
+    if state.swing_vertical and state.swing_horizontal:
+        swing = 'both'
+    elif state.swing_vertical:
+        swing = 'vertical'
+    elif state.swing_horizontal:
+        swing = 'horizontal'
+    else:
+        swing = 'off'
+    return {
+        POWER_STATE_TOPIC: 'ON' if state.power else 'OFF',
+        # Home Assistant models power as one of the modes
+        MODE_STATE_TOPIC: MODE_PAYLOADS[state.ac_mode]
+        if state.power else 'off',
+        TEMPERATURE_STATE_TOPIC: str(state.temperature),
+        FAN_STATE_TOPIC: FAN_PAYLOADS[state.fan_mode],
+        SWING_STATE_TOPIC: swing,
+    }
+
+
+class StatePublisher:
+    """
+        Publishes a unit's state back to the broker as retained per-field
+        topics, plus a Home Assistant MQTT discovery config, so Home
+        Assistant shows what the unit was actually sent instead of running
+        optimistically
+
+        Only the fields whose payload changed since the last publish are
+        sent, a field whose publish failed is sent again next time. With
+        cork set a batch is written with the socket corked (where
+        supported) so the publishes from one transmission leave in a single
+        flush.
+    """
+
+    def __init__(self, client, name, topic_prefix, command_topics,
+                 cork=False):
+        """
+        command_topics: field -> set-command topic (relative to the prefix)
+        for power, mode, temperature, fan and swing
+        cork: only when publish runs on the thread that drives the client's
+        network loop (see service.py), paho's own thread writes to the
+        socket at any time otherwise
+        """
+        self.client = client
+        self.name = name
+        self.topic_prefix = topic_prefix
+        self.command_topics = command_topics
+        self.cork = cork
+        self.published = {}
+        self.lock = threading.Lock()
+        # everything this publisher sends under the unit's prefix, so the
+        # service can ignore its own messages
+        self.topics = set(
+            self.topic(control)
+            for control in state_payloads(DaikinState()))
+
+    def topic(self, control):
+        return '{}{}'.format(self.topic_prefix, control)
+
+    @property
+    def discovery_topic(self):
+        return '{}/climate/daikin-pi-{}/config'.format(HA_DISCOVERY_PREFIX,
+                                                      self.name)
+
+    def discovery_config(self):
+        command = self.command_topics
+        return {
+            'name': self.name,
+            'unique_id': 'daikin-pi-{}'.format(self.name),
+            'modes': ['off'] + sorted(set(MODE_PAYLOADS.values())),
+            'fan_modes': ['auto', 'low', 'medium', 'high'],
+            'swing_modes': ['both', 'vertical', 'horizontal', 'off'],
+            'min_temp': DaikinState.MIN_TEMPERATURE,
+            'max_temp': DaikinState.MAX_TEMPERATURE,
+            'temp_step': 1,
+            'precision': 1.0,
+            'power_command_topic': self.topic(command['power']),
+            'payload_on': 'on',
+            'payload_off': 'off',
+            'mode_command_topic': self.topic(command['mode']),
+            'mode_state_topic': self.topic(MODE_STATE_TOPIC),
+            'temperature_command_topic': self.topic(command['temperature']),
+            'temperature_state_topic': self.topic(TEMPERATURE_STATE_TOPIC),
+            'fan_mode_command_topic': self.topic(command['fan']),
+            'fan_mode_state_topic': self.topic(FAN_STATE_TOPIC),
+            'swing_mode_command_topic': self.topic(command['swing']),
+            'swing_mode_state_topic': self.topic(SWING_STATE_TOPIC),
+        }
+
+    def publish_discovery(self):
+        self.client.publish(self.discovery_topic,
+                            json.dumps(self.discovery_config(),
+                                       sort_keys=True),
+                            retain=True)
+
+    def publish(self, state, full=False):
+        """
+        Publishes the fields that changed, or all of them with full=True
+        (eg. after connecting, the broker may have lost retained messages).
+        Returns the number of messages sent
+        """
+        with self.lock:
+            payloads = state_payloads(state)
+            if not full:
+                payloads = {
+                    control: payload
+                    for control, payload in payloads.items()
+                    if self.published.get(control) != payload
+                }
+            if not payloads:
+                return 0
+
+            sent = {}
+            with self._corked():
+                for control, payload in sorted(payloads.items()):
+                    info = self.client.publish(self.topic(control),
+                                               payload,
+                                               retain=True)
+                    # eg. not connected, it's sent again after connecting
+                    if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                        sent[control] = payload
+                if self.cork:
+                    # anything paho queued rather than wrote (eg. driven by
+                    # an event loop) goes out before the cork comes off
+                    self.client.loop_write()
+            self.published.update(sent)
+            logger.debug('Published {} for {}'.format(sorted(sent),
+                                                      self.name))
+            return len(sent)
+
+    def _corked(self):
+        return _Cork(self.client.socket() if self.cork else None)
+
+
+class _Cork:
+    """
+        Holds back partial TCP segments while a batch is written, the kernel
+        sends everything when the cork is removed
+    """
+
+    def __init__(self, sock):
+        if not hasattr(socket, 'TCP_CORK'):
+            sock = None
+        self.sock = sock
+
+    def __enter__(self):
+        self._set(1)
+
+    def __exit__(self, type, value, traceback):
+        self._set(0)
+
+    def _set(self, value):
+        if self.sock is None:
+            return
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, value)
+        except (OSError, ValueError):
+            # not TCP (eg. a websocket or TLS wrapper without the option)
+            self.sock = None
@@ -0,0 +1,65 @@
+import os
+import stat
+import fcntl
+import struct
+import logging
+
+from .daikin import DaikinLIRC
+from .metrics import STAGE_SECONDS
+logger = logging.getLogger(__name__)
+
+LIRC_DEVICE = os.environ.get('LIRC_DEVICE', '/dev/lirc0')
+
+# from linux/lirc.h
+LIRC_MODE_PULSE = 0x00000002
+LIRC_SET_SEND_MODE = 0x40046911
+LIRC_SET_SEND_CARRIER = 0x40046913
+CARRIER_FREQUENCY = 38000
+
+
+class DaikinLIRCDevice(DaikinLIRC):
+    """
+        Writes the message straight to a LIRC character device in pulse mode,
+        no config file, no lircd
+
+        The kernel expects the durations as native unsigned 32 bit
+        microseconds, alternating pulse/space and ending on a pulse, and
+        transmits the whole buffer from a single write
+    """
+
+    def __init__(self, device=None, carrier=CARRIER_FREQUENCY):
+        super().__init__()
+        self.device = device or LIRC_DEVICE
+        self.carrier = carrier
+
+    def get_buffer(self, message):
+        # zero-copy view of the durations, already in the kernel's layout
+        return self.get_pulse_train(message).memoryview()
+
+    def send(self, message):
+        with STAGE_SECONDS.time('render'):
+            buffer = self.get_buffer(message)
+        with STAGE_SECONDS.time('device_write'):
+            self.write(buffer)
+
+    def write(self, buffer):
+        fd = os.open(self.device, os.O_WRONLY)
+        try:
+            # tests point this at a plain file or fifo, only real devices
+            # take ioctls
+            if stat.S_ISCHR(os.fstat(fd).st_mode):
+                self._configure(fd)
+            written = os.write(fd, buffer)
+        finally:
+            os.close(fd)
+
+        if written != len(buffer):
+            raise IOError('Short write to {}: {} of {} bytes'.format(
+                self.device, written, len(buffer)))
+
+    def _configure(self, fd):
+        fcntl.ioctl(fd, LIRC_SET_SEND_MODE,
+                    struct.pack('I', LIRC_MODE_PULSE))
+        if self.carrier:
+            fcntl.ioctl(fd, LIRC_SET_SEND_CARRIER,
+                        struct.pack('I', self.carrier))
@@ -0,0 +1,159 @@
+import os
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+LIRCD_SOCKET = os.environ.get('LIRCD_SOCKET', '/var/run/lirc/lircd')
+
+
+class LircdError(Exception):
+    pass
+
+
+class LircdConnectionError(LircdError):
+    pass
+
+
+class LircdClient:
+    """
+        Talks the lircd command protocol over its unix socket, replacing a
+        forked irsend per command
+
+        The connection is opened lazily and kept open between commands.
+        If lircd went away (eg. restarted to load a new config) the command
+        goes out on a fresh connection instead. Once a command is written
+        it's never sent again: a failure waiting for the reply (eg. a
+        timeout) is raised, lircd may have transmitted it already.
+
+        Replies look like:
+            BEGIN
+            <command>
+            SUCCESS|ERROR
+            [DATA
+            <n>
+            <n lines>]
+            END
+        lircd also broadcasts SIGHUP packets and decoded button presses to
+        every client, those are skipped.
+    """
+
+    def __init__(self, path=None, timeout=5):
+        self.path = path or LIRCD_SOCKET
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = b''
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # only here, units.py reads LIRCD_SOCKET for every unit
+        import socket
+        self.close()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except (IOError, OSError):
+            sock.close()
+            raise
+        self.sock = sock
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.buffer = b''
+
+    def send_command(self, command):
+        """
+        Sends a single command and returns the DATA lines of the reply,
+        raises LircdError if lircd reports an error
+        """
+        with self.lock:
+            try:
+                self._write(command)
+            except (IOError, OSError) as e:
+                logger.warning(
+                    'lircd connection lost ({}), reconnecting'.format(e))
+                self.close()
+                self._write(command)
+            try:
+                return self._read_reply(command)
+            except (IOError, OSError, LircdConnectionError):
+                # a late reply would be taken for the next command's
+                self.close()
+                raise
+
+    def send_once(self, remote, code, repeats=0):
+        command = 'SEND_ONCE {} {}'.format(remote, code)
+        if repeats:
+            command = '{} {}'.format(command, repeats)
+        return self.send_command(command)
+
+    def version(self):
+        return self.send_command('VERSION')[0]
+
+    def _write(self, command):
+        if self.sock is None or self._hung_up():
+            self.connect()
+        self.sock.sendall('{}\n'.format(command).encode('ascii'))
+
+    def _hung_up(self):
+        """
+        Whether lircd closed the idle connection, without waiting
+        """
+        import select
+        import socket
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        # readable with nothing to read is the end of the stream, anything
+        # else is a broadcast left for _read_reply to skip
+        return bool(readable) and not self.sock.recv(1, socket.MSG_PEEK)
+
+    def _read_reply(self, command):
+        while True:
+            if self._readline() != 'BEGIN':
+                # decoded button press broadcast
+                continue
+
+            echo = self._readline()
+            if echo != command:
+                # SIGHUP broadcast or a reply to someone else's command
+                self._skip_packet()
+                continue
+
+            status = self._readline()
+            data = []
+            line = self._readline()
+            if line == 'DATA':
+                try:
+                    count = int(self._readline())
+                except ValueError:
+                    raise self._malformed(command)
+                data = [self._readline() for _ in range(count)]
+                line = self._readline()
+
+            if line != 'END':
+                raise self._malformed(command)
+            if status == 'ERROR':
+                raise LircdError('{} failed: {}'.format(
+                    command, ' '.join(data)))
+            if status != 'SUCCESS':
+                raise self._malformed(command)
+            return data
+
+    def _malformed(self, command):
+        # the rest of the stream can't be trusted, start over next time
+        self.close()
+        return LircdError('Malformed reply to {}'.format(command))
+
+    def _skip_packet(self):
+        while self._readline() != 'END':
+            pass
+
+    def _readline(self):
+        while b'\n' not in self.buffer:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise LircdConnectionError('lircd closed the connection')
+            self.buffer += chunk
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return line.decode('ascii', 'replace').strip()
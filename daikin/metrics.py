@@ -0,0 +1,266 @@
+import os
+import time
+import bisect
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+# the MQTT service serves /metrics on this port when set, the web server
+# (and daikin.service) always has it
+METRICS_PORT = os.environ.get('METRICS_PORT')
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, from a cached lookup up to a slow lircd restart
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    """
+        A named metric with a fixed set of label names, values are kept per
+        combination of label values (passed positionally, in order)
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError('{} takes labels {}'.format(
+                self.name, self.labelnames))
+        return tuple(str(value) for value in labelvalues)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{{{}}}'.format(','.join(
+            '{}="{}"'.format(name, _escape(value)) for name, value in pairs))
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.kind),
+        ]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return [
+            '{}{} {}'.format(self.name, self._labels(key), _number(value))
+            for key, value in items
+        ]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        key = self._key(labelvalues)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, *labelvalues):
+        return self.values.get(self._key(labelvalues), 0)
+
+
+class Gauge(Metric):
+    """
+        Either set directly or read from a function whenever it's scraped
+        (eg. the length of a queue)
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.functions = {}
+
+    def set(self, value, *labelvalues):
+        key = self._key(labelvalues)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, func, *labelvalues):
+        key = self._key(labelvalues)
+        with self.lock:
+            self.functions[key] = func
+
+    def value(self, *labelvalues):
+        key = self._key(labelvalues)
+        func = self.functions.get(key)
+        return func() if func is not None else self.values.get(key, 0)
+
+    def _samples(self):
+        with self.lock:
+            values = dict(self.values)
+            functions = dict(self.functions)
+        for key, func in functions.items():
+            try:
+                values[key] = func()
+            except Exception:
+                logger.exception('Reading gauge {} failed'.format(self.name))
+        return [
+            '{}{} {}'.format(self.name, self._labels(key), _number(value))
+            for key, value in sorted(values.items())
+        ]
+
+
+class Histogram(Metric):
+    """
+        Counts observations into buckets, time() measures a block with
+        the monotonic performance counter
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        key = self._key(labelvalues)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one per bucket plus +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1)
+                counts.append(0.0)
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, *labelvalues):
+        return _Timer(self, labelvalues)
+
+    def count(self, *labelvalues):
+        counts = self.values.get(self._key(labelvalues))
+        return sum(counts[:-1]) if counts else 0
+
+    def _samples(self):
+        with self.lock:
+            items = sorted((key, list(counts))
+                           for key, counts in self.values.items())
+        lines = []
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'), ),
+                                    counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, self._labels(key, [('le', _number(bound))]),
+                    cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, self._labels(key),
+                                              _number(counts[-1])))
+            lines.append('{}_count{} {}'.format(self.name, self._labels(key),
+                                                cumulative))
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start,
+                               *self.labelvalues)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace(
+        '"', '\\"')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+class Registry:
+    """
+        The metrics a process exposes, rendered in the Prometheus text
+        format
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(
+    Histogram('daikin_stage_seconds',
+              'Time spent in each stage of setting and sending a state',
+              ['stage']))
+TRANSMISSIONS = REGISTRY.register(
+    Counter('daikin_transmissions_total',
+            'States sent to the emitter, skipped as unchanged or failed',
+            ['result']))
+MQTT_MESSAGES = REGISTRY.register(
+    Counter('daikin_mqtt_messages_total',
+            'MQTT messages received, by unit and set-command (other for '
+            'anything else, topics are whatever clients publish)',
+            ['unit', 'control']))
+QUEUE_DEPTH = REGISTRY.register(
+    Gauge('daikin_queue_depth', 'Items waiting in a background queue',
+          ['queue', 'unit']))
+
+
+def start_exporter(port, host='0.0.0.0', registry=REGISTRY):
+    """
+    Serves GET /metrics from a daemon thread, for processes without the web
+    server (eg. mqtt_service)
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = ThreadingHTTPServer((host, int(port)), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever,
+                              name='daikin-metrics')
+    thread.daemon = True
+    thread.start()
+    logger.info('Metrics on {}:{}/metrics'.format(host,
+                                                  server.server_address[1]))
+    return server
@@ -1,9 +1,17 @@
 import os
 import logging
 import json
+import threading
 from datetime import datetime
 import paho.mqtt.client as mqtt
-from daikin import (AC_MODE, FAN_MODE, DaikinController)
+from .daikin import (AC_MODE, FAN_MODE, TIMER_MODE, DaikinState, data_file,
+                     make_parent_dir)
+from .worker import LatestWinsWorker
+from .units import UnitRegistry, create_unit, default_unit_config
+from .home_assistant import StatePublisher
+from .metrics import METRICS_PORT, MQTT_MESSAGES, start_exporter
+from . import tracing
+from .tracing import event, traced
 """
 # Full example configuration.yaml entry
 climate:
@@ -42,26 +50,67 @@ MQTT_BROKER = os.environ.get('MQTT_BROKER', '10.245.52.187')
 # MQTT_BROKER = os.environ.get('MQTT_BROKER', 'localhost')
 MQTT_USER = os.environ.get('MQTT_USER', 'mqtt_user')
 MQTT_PASS = os.environ.get('MQTT_PASS', 'mqtt_password')
-MQTT_TOPIC_PREFIX = 'livingroom/ac/'
 SET_TEMPERATURE_TOPIC = os.environ.get('SET_TEMPERATURE_TOPIC',
                                        'temperature/set')
 SET_POWER_TOPIC = os.environ.get('SET_POWER_TOPIC', 'power/set')
 SET_MODE_TOPIC = os.environ.get('SET_MODE_TOPIC', 'mode/set')
 SET_FAN_TOPIC = os.environ.get('SET_FAN_TOPIC', 'fan/set')
 SET_SWING_TOPIC = os.environ.get('SET_SWING_TOPIC', 'swing/set')
-
-TOPICS_LIST_FILE = os.path.join(os.path.dirname(__file__), 'topics')
-
-
-def create_mqtt_loop():
+# transmits the current state again even if nothing changed
+SET_RESEND_TOPIC = os.environ.get('SET_RESEND_TOPIC', 'resend/set')
+# a JSON object with any subset of the state's fields, sent together
+SET_STATE_TOPIC = os.environ.get('SET_STATE_TOPIC', 'state/set')
+# "on <minutes>" or "off <minutes>" arms the unit's timer, "cancel" clears it
+SET_TIMER_TOPIC = os.environ.get('SET_TIMER_TOPIC', 'timer/set')
+
+# set-commands arriving within this many seconds of each other are merged
+# into a single transmission, delayed by no more than the max delay
+COALESCE_WINDOW = float(os.environ.get('MQTT_COALESCE_WINDOW', '0.15'))
+COALESCE_MAX_DELAY = float(os.environ.get('MQTT_COALESCE_MAX_DELAY', '1.0'))
+# the state file is written at most once per this many seconds
+STATE_FLUSH_INTERVAL = float(os.environ.get('STATE_FLUSH_INTERVAL', '5.0'))
+
+# every topic seen so far, the list shipped with the package (which may
+# be installed read-only) is where it starts
+TOPICS_LIST_FILE = data_file('topics')
+DEFAULT_TOPICS_FILE = os.path.join(os.path.dirname(__file__), 'topics')
+
+# started by the service so callbacks on paho's network thread only ever
+# enqueue work, without them (eg. on service.py's loop) it runs inline
+topics_writer = None
+republisher = None
+# the service's units (see units.py), set by the service
+registry = None
+registry_lock = threading.Lock()
+
+
+def get_registry():
+    """
+    The service's units, a single unit configured from the environment
+    (under MQTT_TOPIC_PREFIX) when it hasn't set any
+    """
+    global registry
+    with registry_lock:
+        if registry is None:
+            registry = UnitRegistry([create_unit(default_unit_config())])
+        return registry
+
+
+def create_mqtt_client():
     client = mqtt.Client("P1")
     client.on_connect = on_connect
     client.on_disconnect = on_disconnect
     client.on_message = on_message
     client.on_log = on_log
     client.username_pw_set(username="mqtt_user", password="mqtt_password")
+    attach_publishers(client)
+    return client
+
+
+def create_mqtt_loop():
+    client = create_mqtt_client()
     client.connect(MQTT_BROKER, 1883, 60)
-    client.subscribe('{}#'.format(MQTT_TOPIC_PREFIX))
+    subscribe(client)
     logger.info('Connection to {} on port {} established at {} UTC'.format(
         MQTT_BROKER, 1883,
         datetime.utcnow().isoformat()))
@@ -70,7 +119,49 @@ def create_mqtt_loop():
 
 def on_connect(client, userdata, flags, rc):
     logger.info('Connected {}'.format(str(rc)))
-    client.subscribe('{}#'.format(MQTT_TOPIC_PREFIX))
+    if republisher is not None:
+        republisher.submit(None)
+    else:
+        republish()
+    # retained set-commands are replayed after this, unchanged states
+    # are skipped rather than transmitted again
+    subscribe(client)
+
+
+def republish(item=None):
+    """
+    Every unit's discovery config and full state, the broker may have lost
+    retained messages while we were away
+    """
+    for unit in get_registry():
+        logger.info('{}: {} sent, {} skipped so far'.format(
+            unit.name, unit.controller.sent_count,
+            unit.controller.skipped_count))
+        if unit.publisher is not None:
+            unit.publisher.publish_discovery()
+            unit.publisher.publish(unit.controller.current_state(), full=True)
+
+
+def attach_publishers(client):
+    """
+    Publishes each unit's state back after every transmission
+    """
+    command_topics = {
+        'power': SET_POWER_TOPIC,
+        'mode': SET_MODE_TOPIC,
+        'temperature': SET_TEMPERATURE_TOPIC,
+        'fan': SET_FAN_TOPIC,
+        'swing': SET_SWING_TOPIC,
+    }
+    for unit in get_registry():
+        unit.attach_publisher(
+            StatePublisher(client, unit.name, unit.topic_prefix,
+                           command_topics))
+
+
+def subscribe(client):
+    for topic in get_registry().subscriptions():
+        client.subscribe(topic)
 
 
 def on_disconnect(client, userdata, rc):
@@ -78,59 +169,82 @@ def on_disconnect(client, userdata, rc):
 
 
 def on_log(client, obj, level, string):
-    print(string)
+    logger.debug(string)
 
 
-def get_control_topic(control):
-    return '{}{}'.format(MQTT_TOPIC_PREFIX, control)
+def on_message(client, userdata, msg):
+    unit, control = get_registry().route(msg.topic)
+    if unit is not None and unit.publisher is not None and (
+            msg.topic in unit.publisher.topics):
+        # our own state coming back through the '#' subscription
+        return
+    if unit is not None and control in CONTROL_HANDLERS:
+        MQTT_MESSAGES.inc(unit.name, control)
+    else:
+        MQTT_MESSAGES.inc('other', 'other')
+    with traced():
+        event('mqtt_message', topic=msg.topic, payload=msg.payload)
+        _handle_message(unit, control, msg)
 
 
-def on_message(client, userdata, msg):
-    print('Message Received\ntopic: {}\npayload: {}'.format(
+def _handle_message(unit, control, msg):
+    logger.debug('Message Received\ntopic: {}\npayload: {}'.format(
         msg.topic, msg.payload))
 
     if msg.topic not in MQTT_TOPICS:
         MQTT_TOPICS.append(msg.topic)
-        with open(TOPICS_LIST_FILE, 'w') as topics:
-            json.dump({'topics': sorted(MQTT_TOPICS)},
-                      topics,
-                      indent=4,
-                      sort_keys=True)
-            logger.info('Found new mqtt topic: {} and saved it to file'.format(
-                msg.topic))
-
-    if msg.topic == get_control_topic(SET_TEMPERATURE_TOPIC):
-        set_temperature(msg.payload.decode('utf-8'))
-    elif msg.topic == get_control_topic(SET_MODE_TOPIC):
-        set_mode(msg.payload.decode('utf-8'))
-    elif msg.topic == get_control_topic(SET_FAN_TOPIC):
-        set_fan(msg.payload.decode('utf-8'))
-    elif msg.topic == get_control_topic(SET_SWING_TOPIC):
-        set_swing(msg.payload.decode('utf-8'))
-    elif msg.topic == get_control_topic(SET_POWER_TOPIC):
-        set_power(msg.payload.decode('utf-8'))
-    else:
+        logger.info('Found new mqtt topic: {}'.format(msg.topic))
+        if topics_writer is not None:
+            topics_writer.submit(sorted(MQTT_TOPICS))
+        else:
+            write_topics(sorted(MQTT_TOPICS))
+
+    handler = CONTROL_HANDLERS.get(control)
+    if handler is None:
         logger.warning('Unknown message: {}: {}'.format(
             msg.topic, msg.payload))
+        return
+    handler(msg.payload.decode('utf-8'), unit=unit)
+
 
+def load_topics():
+    path = TOPICS_LIST_FILE
+    if not os.path.exists(path):
+        path = DEFAULT_TOPICS_FILE
+    with open(path) as topics_file:
+        return json.load(topics_file)['topics']
 
-def send_daikin_state(**values):
-    controller = DaikinController()
-    controller.update(**values)
 
+def write_topics(topics_list):
+    make_parent_dir(TOPICS_LIST_FILE)
+    with open(TOPICS_LIST_FILE, 'w') as topics:
+        json.dump({'topics': topics_list}, topics, indent=4, sort_keys=True)
 
-def set_temperature(value):
+
+def send_daikin_state(unit=None, **values):
+    """
+    Hands values to unit (the first one by default), through its coalescer
+    when it has one
+    """
+    (unit or get_registry().default()).send(**values)
+
+
+def set_temperature(value, unit=None):
     logger.info('setting temperature to {}'.format(value))
     try:
         degrees = int(float(value))
     except ValueError:
         pass
 
-    send_daikin_state(temperature=degrees)
+    send_daikin_state(unit, temperature=degrees)
 
 
-def set_mode(value):
-    logger.info('setting power to {}'.format(value))
+def set_mode(value, unit=None):
+    logger.info('setting mode to {}'.format(value))
+    if value == 'off':
+        # Home Assistant treats off as a mode
+        send_daikin_state(unit, power=False)
+        return
     ac_mode = {
         'auto': AC_MODE.AUTO,
         'dry': AC_MODE.DRY,
@@ -139,10 +253,10 @@ def set_mode(value):
         'fan_only': AC_MODE.FAN,
     }.get(value, AC_MODE.AUTO)
 
-    send_daikin_state(ac_mode=ac_mode)
+    send_daikin_state(unit, ac_mode=ac_mode)
 
 
-def set_fan(value):
+def set_fan(value, unit=None):
     logger.info('setting fan to {}'.format(value))
     fan = {
         'auto': FAN_MODE.AUTO,
@@ -151,21 +265,72 @@ def set_fan(value):
         'high': FAN_MODE.FIVE,
     }.get(value, FAN_MODE.AUTO)
 
-    send_daikin_state(fan_mode=fan)
+    send_daikin_state(unit, fan_mode=fan)
 
 
-def set_swing(value):
+def set_swing(value, unit=None):
     logger.info('setting swing mode to {}'.format(value))
     vertical = value in ['both', 'vertical']
     horizontal = value in ['both', 'horizontal']
-    send_daikin_state(swing_vertical=vertical, swing_horizontal=horizontal)
+    send_daikin_state(unit,
+                      swing_vertical=vertical,
+                      swing_horizontal=horizontal)
 
 
-def set_power(value):
+def set_power(value, unit=None):
     logger.info('setting power to {}'.format(value))
     power = value.lower() == 'on'
-    send_daikin_state(power=power)
+    send_daikin_state(unit, power=power)
+
+
+def set_state(value, unit=None):
+    logger.info('setting state to {}'.format(value))
+    try:
+        changes = DaikinState.parse_changes(json.loads(value))
+    except ValueError as e:
+        logger.warning('Invalid state {}: {}'.format(value, e))
+        return
 
+    send_daikin_state(unit, **changes)
+
+
+def set_timer(value, unit=None):
+    logger.info('setting timer to {}'.format(value))
+    words = value.lower().split()
+    if words in (['cancel'], ['none']):
+        send_daikin_state(unit, timer=TIMER_MODE.NONE)
+        return
+    try:
+        mode, minutes = words
+        minutes = int(minutes)
+    except ValueError:
+        logger.warning('Invalid timer {}'.format(value))
+        return
+    if (mode not in ('on', 'off')
+            or not 1 <= minutes <= DaikinState.MAX_TIMER_DURATION):
+        logger.warning('Invalid timer {}'.format(value))
+        return
+
+    send_daikin_state(unit,
+                      timer=TIMER_MODE[mode.upper()],
+                      timer_duration=minutes)
+
+
+def resend(value=None, unit=None):
+    logger.info('resending current state')
+    send_daikin_state(unit, force=True)
+
+
+CONTROL_HANDLERS = {
+    SET_TEMPERATURE_TOPIC: set_temperature,
+    SET_MODE_TOPIC: set_mode,
+    SET_FAN_TOPIC: set_fan,
+    SET_SWING_TOPIC: set_swing,
+    SET_POWER_TOPIC: set_power,
+    SET_RESEND_TOPIC: resend,
+    SET_STATE_TOPIC: set_state,
+    SET_TIMER_TOPIC: set_timer,
+}
 
 if __name__ == '__main__':
     logger = logging.getLogger('daikin-pi-mqtt-service')
@@ -173,7 +338,28 @@ if __name__ == '__main__':
     logging.basicConfig()
     logger.info('MQTT Service Started')
 
-    with open(TOPICS_LIST_FILE) as topics_file:
-        MQTT_TOPICS = json.load(topics_file)['topics']
-
-    create_mqtt_loop()
+    MQTT_TOPICS = load_topics()
+
+    registry = UnitRegistry.load(background=True,
+                                 flush_interval=STATE_FLUSH_INTERVAL)
+    for unit in registry:
+        logger.info('Unit {} on {} via {}'.format(unit.name,
+                                                  unit.topic_prefix,
+                                                  unit.emitter))
+        unit.start_coalescing(COALESCE_WINDOW, COALESCE_MAX_DELAY)
+        unit.start_receiving()
+    topics_writer = LatestWinsWorker(write_topics, name='daikin-topics')
+    topics_writer.start()
+    republisher = LatestWinsWorker(republish, name='daikin-republisher')
+    republisher.start()
+    trace_listener = tracing.configure()
+    if METRICS_PORT:
+        start_exporter(METRICS_PORT)
+    try:
+        create_mqtt_loop()
+    finally:
+        registry.stop()
+        topics_writer.stop()
+        republisher.stop()
+        if trace_listener is not None:
+            trace_listener.stop()
@@ -0,0 +1,156 @@
+from array import array
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def lsb_byte_table(mark, zero_space, one_space):
+    """
+    The mark/space durations for every byte value sent least significant
+    bit first, indexed by the byte
+    """
+    table = []
+    for value in range(256):
+        durations = array('I')
+        for bit in range(8):
+            durations.append(mark)
+            durations.append(one_space if (value >> bit) & 1 else zero_space)
+        table.append(durations)
+    return tuple(table)
+
+
+@lru_cache(maxsize=None)
+def lsb_text_table(mark, zero_space, one_space, separator='\n'):
+    """
+    lsb_byte_table rendered as lircd raw code lines, so a frame's text is a
+    single join over its bytes
+    """
+    return tuple(
+        PulseTrain(durations).lircd_text(separator)
+        for durations in lsb_byte_table(mark, zero_space, one_space))
+
+
+class _PairText(dict):
+    def __missing__(self, pair):
+        text = self[pair] = '{} {}'.format(*pair)
+        return text
+
+
+_pair_text = _PairText()
+
+
+class PulseTrain:
+    """
+        An IR message as alternating mark/space durations in microseconds,
+        starting with a mark
+
+        Durations live in one compact array('I') so every output format
+        (lircd raw code text, the binary buffer the LIRC device takes, a
+        level/duration waveform) is produced from the same data without
+        building intermediate strings per bit
+    """
+
+    __slots__ = ('durations', )
+
+    def __init__(self, durations=()):
+        self.durations = array('I', durations)
+
+    @classmethod
+    def from_bytes(cls, data, table):
+        train = cls()
+        train.extend_bytes(data, table)
+        return train
+
+    def append(self, *durations):
+        self.durations.extend(durations)
+
+    def extend_bytes(self, data, table):
+        durations = self.durations
+        for value in data:
+            durations.extend(table[value])
+
+    def __len__(self):
+        return len(self.durations)
+
+    def __iter__(self):
+        return iter(self.durations)
+
+    def __eq__(self, other):
+        if not isinstance(other, PulseTrain):
+            return NotImplemented
+        return self.durations == other.durations
+
+    def memoryview(self):
+        """
+        Zero-copy view of the raw native u32 durations as bytes
+        """
+        return memoryview(self.durations).cast('B')
+
+    def tobytes(self):
+        return self.durations.tobytes()
+
+    def lircd_lines(self):
+        """
+        One 'mark space' pair per line as used in lircd raw codes, a trailing
+        mark gets a line of its own
+        """
+        durations = self.durations
+        pairs = iter(durations)
+        lines = list(map(_pair_text.__getitem__, zip(pairs, pairs)))
+        if len(durations) % 2:
+            lines.append(str(durations[-1]))
+        return lines
+
+    def lircd_text(self, separator='\n'):
+        return separator.join(self.lircd_lines())
+
+    def waveform(self):
+        """
+        (level, duration) steps, 1 while the carrier is on
+        """
+        return [(1 - index % 2, duration)
+                for index, duration in enumerate(self.durations)]
+
+
+def _benchmark(number=2000):
+    import timeit
+    from .daikin import AC_MODE, DaikinLIRC, DaikinMessage, DaikinState
+
+    lirc = DaikinLIRC()
+    message = DaikinMessage(
+        DaikinState(power=True, temperature=22, ac_mode=AC_MODE.HEAT))
+    frames = [message.frame_one, message.frame_two, message.frame_three]
+
+    def string_path():
+        # the per-bit string formatting this module replaced
+        for frame in frames:
+            binary = ''.join(['{0:08b}'.format(item)[::-1] for item in frame])
+            '\n        '.join(
+                [lirc.ONE if digit == '1' else lirc.ZERO for digit in binary])
+
+    table = lsb_byte_table(lirc.PULSE, lirc.ZERO_GAP, lirc.ONE_GAP)
+    table_text = lsb_text_table(lirc.PULSE, lirc.ZERO_GAP, lirc.ONE_GAP,
+                                '\n        ')
+
+    def text_table_path():
+        for frame in frames:
+            '\n        '.join(map(table_text.__getitem__, frame))
+
+    def train_text_path():
+        for frame in frames:
+            PulseTrain.from_bytes(frame, table).lircd_text('\n        ')
+
+    def train_binary_path():
+        for frame in frames:
+            PulseTrain.from_bytes(frame, table).memoryview()
+
+    for name, func in [('per-bit strings', string_path),
+                       ('byte text table', text_table_path),
+                       ('PulseTrain lircd text', train_text_path),
+                       ('PulseTrain memoryview', train_binary_path)]:
+        seconds = min(timeit.repeat(func, number=number, repeat=5))
+        print('{:<24} {:8.1f} us/message'.format(name,
+                                                 seconds / number * 1e6))
+
+
+if __name__ == '__main__':
+    _benchmark()
@@ -0,0 +1,485 @@
+import os
+import json
+import time
+import heapq
+import itertools
+import tempfile
+import threading
+from datetime import datetime, timedelta
+import logging
+
+from .daikin import DaikinState, data_file, make_parent_dir
+from .tracing import event, traced
+from .worker import LatestWinsWorker
+logger = logging.getLogger(__name__)
+
+SCHEDULE_FILE = os.environ.get('SCHEDULE_FILE', data_file('schedule.json'))
+# runs missed while the service was down are caught up if they were due
+# within this many seconds, older ones are dropped
+SCHEDULE_CATCH_UP = float(os.environ.get('SCHEDULE_CATCH_UP', '43200'))
+# the Pi has no real time clock and its clock can jump when NTP syncs, the
+# scheduler never sleeps longer than this before checking the time again
+SCHEDULE_MAX_SLEEP = 3600
+# the schedule file is written at most once per this many seconds
+SCHEDULE_FLUSH_INTERVAL = float(
+    os.environ.get('SCHEDULE_FLUSH_INTERVAL', '1.0'))
+"""
+# Example schedule.json, heat the living room on weekday mornings and switch
+# the bedroom off once
+{
+    "entries": [
+        {"id": "morning", "unit": "livingroom", "cron": "30 6 * * 1-5",
+         "changes": {"power": true, "ac_mode": "heat", "temperature": 21,
+                     "powerful": true}},
+        {"id": "bedroom-off", "unit": "bedroom", "at": "2026-11-02T23:30",
+         "changes": {"power": false}}
+    ]
+}
+"""
+
+
+class CronExpression:
+    """
+        A standard five field cron expression, minute hour day month weekday,
+        in local time. Fields take *, numbers, ranges (1-5), lists (1,3) and
+        steps (*/15, 8-18/2), weekdays run 0-7 with Sunday as 0 or 7. As in
+        cron, when both day and weekday are restricted either may match.
+    """
+
+    FIELDS = (
+        ('minute', 0, 59),
+        ('hour', 0, 23),
+        ('day', 1, 31),
+        ('month', 1, 12),
+        ('weekday', 0, 7),
+    )
+    # no match within this many days means there never is one (eg. 31 2 *)
+    MAX_SEARCH_DAYS = 366 * 5
+
+    def __init__(self, text):
+        self.text = text
+        parts = text.split()
+        if len(parts) != len(self.FIELDS):
+            raise ValueError('Cron expression needs {} fields: {}'.format(
+                len(self.FIELDS), text))
+        values = [
+            _parse_cron_field(part, low, high)
+            for part, (_, low, high) in zip(parts, self.FIELDS)
+        ]
+        (self.minutes, self.hours, self.days, self.months,
+         weekdays) = [sorted(field) for field in values]
+        self.weekdays = set(day % 7 for day in weekdays)
+        self.any_day = parts[2] == '*'
+        self.any_weekday = parts[4] == '*'
+
+    def __repr__(self):
+        return 'CronExpression({!r})'.format(self.text)
+
+    def _day_matches(self, moment):
+        day = moment.day in self.days
+        # datetime weeks start on Monday = 0, cron's on Sunday = 0
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, timestamp):
+        """
+        The first matching minute strictly after timestamp, as a timestamp
+        """
+        moment = datetime.fromtimestamp(timestamp).replace(
+            second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=self.MAX_SEARCH_DAYS)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = _next_month(moment)
+            elif not self._day_matches(moment):
+                moment = _start_of_day(moment) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                later = [hour for hour in self.hours if hour > moment.hour]
+                if later:
+                    moment = moment.replace(hour=later[0], minute=0)
+                else:
+                    moment = _start_of_day(moment) + timedelta(days=1)
+            elif moment.minute not in self.minutes:
+                later = [
+                    minute for minute in self.minutes
+                    if minute > moment.minute
+                ]
+                if later:
+                    moment = moment.replace(minute=later[0])
+                else:
+                    moment = moment.replace(minute=0) + timedelta(hours=1)
+            else:
+                return moment.timestamp()
+        raise ValueError('{} never matches'.format(self.text))
+
+
+def _parse_cron_field(text, low, high):
+    values = set()
+    for part in text.split(','):
+        span, _, step = part.partition('/')
+        try:
+            step = int(step) if step else 1
+            if span == '*':
+                start, end = low, high
+            elif '-' in span:
+                start, end = [int(value) for value in span.split('-', 1)]
+            else:
+                start = int(span)
+                # 5/15 means every 15 starting at 5
+                end = high if step > 1 else start
+        except ValueError:
+            raise ValueError('Invalid cron field: {}'.format(text))
+        if step < 1 or not low <= start <= end <= high:
+            raise ValueError('Invalid cron field: {}'.format(text))
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def _start_of_day(moment):
+    return moment.replace(hour=0, minute=0)
+
+
+def _next_month(moment):
+    if moment.month == 12:
+        return moment.replace(year=moment.year + 1, month=1, day=1, hour=0,
+                              minute=0)
+    return moment.replace(month=moment.month + 1, day=1, hour=0, minute=0)
+
+
+def parse_time(value):
+    """
+    A timestamp, or an ISO 8601 date and time (local unless it has an
+    offset), as a timestamp
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        raise ValueError('Invalid time: {}'.format(value))
+
+
+class ScheduleEntry:
+    """
+        Changes to apply to a unit (any DaikinState fields, in the
+        serialize() format), either once at a time (`at`) or whenever a cron
+        expression matches (`cron`)
+
+        last_run is when it last ran, or when it was added if it never has,
+        and is what missed runs are worked out from after a restart
+    """
+
+    def __init__(self, id, changes, unit=None, cron=None, at=None,
+                 last_run=None):
+        if (cron is None) == (at is None):
+            raise ValueError('Schedule entry {} needs one of cron or at'.
+                             format(id))
+        self.id = str(id)
+        self.unit = unit
+        self.changes = changes
+        # validates, and what's handed to the unit's controller
+        self.values = DaikinState.parse_changes(changes)
+        self.cron = CronExpression(cron) if cron is not None else None
+        self.at = parse_time(at) if at is not None else None
+        self.last_run = last_run
+        self.due = None
+        # entries taken off the schedule stay in the heap until popped
+        self.cancelled = False
+
+    @property
+    def one_shot(self):
+        return self.cron is None
+
+    def next_due(self, after):
+        """
+        When this entry runs next after `after`, None if never again
+        """
+        if self.one_shot:
+            return self.at if self.last_run is None else None
+        return self.cron.next_after(after)
+
+    def serialize(self):
+        data = {'id': self.id, 'changes': self.changes}
+        if self.unit is not None:
+            data['unit'] = self.unit
+        if self.one_shot:
+            data['at'] = self.at
+        else:
+            data['cron'] = self.cron.text
+        if self.last_run is not None:
+            data['last_run'] = self.last_run
+        return data
+
+    @classmethod
+    def deserialize(cls, data):
+        try:
+            return cls(data['id'],
+                       data['changes'],
+                       unit=data.get('unit'),
+                       cron=data.get('cron'),
+                       at=data.get('at'),
+                       last_run=data.get('last_run'))
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError('Invalid schedule entry {}: {}'.format(data, e))
+
+
+class Scheduler(threading.Thread):
+    """
+        Runs schedule entries on a background thread, calling
+        dispatch(unit, values) with the entry's unit name and changes (as
+        DaikinController.update keyword arguments) when each is due
+
+        Upcoming runs are kept in a min-heap, the thread sleeps until the
+        earliest one is due (or the schedule changes) so thousands of entries
+        cost nothing between runs. The schedule is saved to `path` behind
+        the scenes whenever it changes and after every run (at most once per
+        flush_interval, stop() writes what's pending).
+
+        On start, runs missed while nothing was running are caught up in the
+        order they were due: the last missed run of each cron entry and every
+        missed one-shot, as long as they were due within `catch_up` seconds.
+        One-shot entries are dropped once they have run.
+    """
+
+    def __init__(self, dispatch, path=None, catch_up=None, clock=time.time,
+                 flush_interval=SCHEDULE_FLUSH_INTERVAL, name=None):
+        super().__init__(name=name or 'daikin-scheduler')
+        self.daemon = True
+        self.dispatch = dispatch
+        self.path = path or SCHEDULE_FILE
+        self.catch_up = SCHEDULE_CATCH_UP if catch_up is None else catch_up
+        self.clock = clock
+        self.entries = {}
+        self.heap = []
+        self.counter = itertools.count()
+        self.stopping = False
+        self.run_count = 0
+        self.condition = threading.Condition()
+        # the file is written from a snapshot taken when the write happens
+        self.persister = LatestWinsWorker(lambda _: self._write(),
+                                          name='daikin-schedule-persister',
+                                          interval=flush_interval)
+        self.persister.start()
+
+    @classmethod
+    def load(cls, dispatch, path=None, **kwargs):
+        scheduler = cls(dispatch, path, **kwargs)
+        try:
+            with open(scheduler.path) as schedule_file:
+                entries = json.load(schedule_file)['entries']
+        except (IOError, OSError):
+            entries = []
+        now = scheduler.clock()
+        for data in entries:
+            entry = ScheduleEntry.deserialize(data)
+            if entry.last_run is None and not entry.one_shot:
+                # written by hand, nothing to catch up on yet
+                entry.last_run = now
+            scheduler.entries[entry.id] = entry
+        return scheduler
+
+    def __iter__(self):
+        with self.condition:
+            return iter(sorted(self.entries.values(), key=lambda e: e.id))
+
+    def add(self, entry):
+        """
+        Adds an entry, replacing any with the same id
+        """
+        with self.condition:
+            now = self.clock()
+            if entry.last_run is None and not entry.one_shot:
+                entry.last_run = now
+            self._remove(entry.id)
+            self.entries[entry.id] = entry
+            self._push(entry, entry.next_due(max(entry.last_run or 0, now)))
+            self._save()
+            self.condition.notify()
+        return entry
+
+    def remove(self, id):
+        with self.condition:
+            entry = self._remove(id)
+            if entry is not None:
+                self._save()
+                self.condition.notify()
+            return entry
+
+    def next_due(self):
+        """
+        (timestamp, entry) of the next run, None when nothing is scheduled
+        """
+        with self.condition:
+            self._discard_cancelled()
+            if not self.heap:
+                return None
+            due, _, entry = self.heap[0]
+            return due, entry
+
+    def start(self):
+        self.catch_up_missed()
+        super().start()
+
+    def stop(self, timeout=None):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.ident is not None:
+            self.join(timeout)
+        self.persister.stop(timeout)
+
+    def flush(self, timeout=None):
+        """
+        Waits for the schedule file to catch up with the schedule
+        """
+        return self.persister.join_pending(timeout)
+
+    def catch_up_missed(self):
+        """
+        Runs what was due while nothing was running and schedules the rest
+        """
+        missed = []
+        with self.condition:
+            now = self.clock()
+            oldest = now - self.catch_up
+            for entry in list(self.entries.values()):
+                if entry.due is not None:
+                    # added since loading, already scheduled
+                    continue
+                if entry.one_shot:
+                    if entry.last_run is not None:
+                        # ran but wasn't removed before the restart
+                        self.entries.pop(entry.id)
+                    elif entry.at > now:
+                        self._push(entry, entry.at)
+                    elif entry.at >= oldest:
+                        missed.append((entry.at, entry))
+                    else:
+                        logger.warning('Dropping {}, due at {} {}'.format(
+                            entry.id, datetime.fromtimestamp(entry.at),
+                            'and too long ago to catch up'))
+                        self.entries.pop(entry.id)
+                    continue
+
+                # only the latest missed run of a cron entry matters, the
+                # search can start at the edge of the catch up window
+                due = entry.next_due(max(entry.last_run, oldest))
+                latest = None
+                while due <= now:
+                    latest = due
+                    due = entry.next_due(due)
+                if latest is not None:
+                    # rescheduled once it has run
+                    missed.append((latest, entry))
+                else:
+                    self._push(entry, due)
+
+        missed.sort(key=lambda item: item[0])
+        for due, entry in missed:
+            logger.info('Catching up on {} due at {}'.format(
+                entry.id, datetime.fromtimestamp(due)))
+            self._run(entry)
+        with self.condition:
+            self._finish(entry for _, entry in missed)
+
+    def run(self):
+        while True:
+            due_entries = self._take()
+            if due_entries is None:
+                return
+            for entry in due_entries:
+                self._run(entry)
+            with self.condition:
+                self._finish(due_entries)
+
+    def _take(self):
+        """
+        Waits for the next entries to come due, None once stopped
+        """
+        with self.condition:
+            while not self.stopping:
+                self._discard_cancelled()
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                delay = self.heap[0][0] - self.clock()
+                if delay <= 0:
+                    break
+                self.condition.wait(min(delay, SCHEDULE_MAX_SLEEP))
+            if self.stopping:
+                return None
+
+            now = self.clock()
+            due_entries = []
+            while self.heap and self.heap[0][0] <= now:
+                _, _, entry = heapq.heappop(self.heap)
+                if not entry.cancelled:
+                    due_entries.append(entry)
+            return due_entries
+
+    def _run(self, entry):
+        with traced():
+            event('scheduled', entry=entry.id, unit=entry.unit)
+            try:
+                self.dispatch(entry.unit, dict(entry.values))
+            except Exception:
+                logger.exception('Scheduled {} failed'.format(entry.id))
+        self.run_count += 1
+
+    def _finish(self, entries):
+        # records the runs and schedules the next ones, entries removed or
+        # replaced while running are left alone
+        now = self.clock()
+        for entry in entries:
+            if entry.cancelled:
+                continue
+            entry.last_run = now
+            if entry.one_shot:
+                self._remove(entry.id)
+            else:
+                self._push(entry, entry.next_due(now))
+        self._save()
+
+    def _push(self, entry, due):
+        entry.due = due
+        if due is not None:
+            heapq.heappush(self.heap, (due, next(self.counter), entry))
+
+    def _remove(self, id):
+        entry = self.entries.pop(id, None)
+        if entry is not None:
+            entry.cancelled = True
+        return entry
+
+    def _discard_cancelled(self):
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+
+    def _save(self):
+        self.persister.submit(None)
+
+    def _write(self):
+        with self.condition:
+            data = {
+                'entries': [
+                    entry.serialize() for entry in sorted(
+                        self.entries.values(), key=lambda e: e.id)
+                ]
+            }
+        # replaced atomically like the controller's state file
+        make_parent_dir(self.path)
+        fd, tmp_file = tempfile.mkstemp(
+            prefix='{}.'.format(os.path.basename(self.path)),
+            suffix='.tmp',
+            dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.path)
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
@@ -1,31 +1,48 @@
 #!/usr/bin/python3.6
 
-from .daikin import DaikinMessage, DaikinState, DaikinLIRC, AC_MODE
-import json
-from flask import Flask, request, jsonify
+from .daikin import DaikinState, AC_MODE, TIMER_MODE
+from .metrics import CONTENT_TYPE, REGISTRY
+from .scheduler import ScheduleEntry
+from .tracing import correlation_id, event, new_id
+from .units import create_unit, load_unit_configs
+import os
+import atexit
+import threading
+from flask import Flask, g, request, jsonify
 app = Flask(__name__)
-CONFIG_FILE_NAME = '../data/config.json'
 
+# the state file is written at most once per this many seconds
+STATE_FLUSH_INTERVAL = float(os.environ.get('STATE_FLUSH_INTERVAL', '5.0'))
 
-def save(state):
-    with open(CONFIG_FILE_NAME, 'w') as f:
-        json.dump(state.serialize(), f)
+controller = None
+controller_lock = threading.Lock()
+# set by service.py when schedules are run in-process
+scheduler = None
 
 
-def load():
-    with open(CONFIG_FILE_NAME, 'r') as f:
-        data = json.load(f)
+def get_controller():
+    global controller
+    with controller_lock:
+        if controller is None:
+            # the first configured unit, sharing its state with the MQTT
+            # service through the unit's store
+            controller = create_unit(
+                load_unit_configs()[0],
+                background=True,
+                flush_interval=STATE_FLUSH_INTERVAL).controller
+            # write out anything still pending on shutdown
+            atexit.register(controller.stop)
+        return controller
+
 
-    return DaikinState.deserialize(data) if data else DaikinState()
+def load():
+    return get_controller().current_state()
 
 
 def transmit(state):
-    # save each time so incremental changes can be restored
-    save(state)
-    message = DaikinMessage(state)
-    lirc = DaikinLIRC()
-    config = lirc.get_config(message)
-    lirc.transmit(config)
+    # state is kept in memory, saved behind the scenes so incremental
+    # changes can be restored
+    get_controller().set_state(state)
     return 'OK'
 
 
@@ -45,6 +62,27 @@ class InvalidUsage(Exception):
         return rv
 
 
+@app.before_request
+def start_trace():
+    # a caller's own ID is kept so its logs line up with ours
+    id = request.headers.get('X-Correlation-ID') or new_id()
+    g.trace_token = correlation_id.set(id)
+    event('http_request', method=request.method, path=request.path)
+
+
+@app.after_request
+def add_correlation_id(response):
+    response.headers['X-Correlation-ID'] = correlation_id.get()
+    return response
+
+
+@app.teardown_request
+def end_trace(exception=None):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        correlation_id.reset(token)
+
+
 @app.errorhandler(InvalidUsage)
 def handle_invalid_usage(error):
     response = jsonify(error.to_dict())
@@ -69,8 +107,8 @@ def cool(temperature):
 
 @app.route('/morning', methods=['POST'])
 def morning():
-    state = DaikinState(power=True, temperature=21, ac_mode=AC_MODE.HEAT)
-    state.powerful = True
+    state = DaikinState(
+        power=True, temperature=21, ac_mode=AC_MODE.HEAT, powerful=True)
     return transmit(state)
 
 
@@ -83,10 +121,9 @@ def get_power(value):
 
 @app.route('/power/<string:value>', methods=['POST'])
 def set_power(value):
-    state = load()
     if value in ['off', 'on']:
-        state.power = value == 'on'
-        return transmit(state)
+        get_controller().update(power=value == 'on')
+        return 'OK'
     else:
         raise InvalidUsage('Invalid power setting')
 
@@ -100,23 +137,103 @@ def get_temperature():
 
 @app.route('/temperature/<int:degrees>', methods=['POST'])
 def set_temperature(degrees=None):
-    state = load()
-    state.temperature = degrees
-    return transmit(state)
+    get_controller().update(temperature=degrees)
+    return 'OK'
 
 
+# stepped from whatever the state is when the change is made, so
+# concurrent steps (eg. from the MQTT service too) all count
 @app.route('/temperature/increase', methods=['POST'])
 def increase_temperature():
-    state = load()
-    state.temperature = state.temperature + 1
-    return transmit(state)
+    get_controller().change(
+        lambda current: current.replace(temperature=current.temperature + 1))
+    return 'OK'
 
 
 @app.route('/temperature/decrease', methods=['POST'])
 def decrease_temperature():
-    state = load()
-    state.temperature = state.temperature - 1
-    return transmit(state)
+    get_controller().change(
+        lambda current: current.replace(temperature=current.temperature - 1))
+    return 'OK'
+
+
+@app.route('/state')
+def get_state():
+    return jsonify(load().serialize())
+
+
+@app.route('/state', methods=['PATCH'])
+def patch_state():
+    """
+    Changes any subset of the fields, eg.
+    {"ac_mode": "heat", "temperature": 22, "fan_mode": "auto"}
+    with a single transmission
+    """
+    try:
+        changes = DaikinState.parse_changes(request.get_json(silent=True))
+    except ValueError as e:
+        raise InvalidUsage(str(e))
+    return jsonify(get_controller().update(**changes).serialize())
+
+
+# Timers run on the unit, nothing here has to be up when they fire
+@app.route('/timer/<string:mode>/<int:minutes>', methods=['POST'])
+def set_timer(mode, minutes):
+    if mode not in ['on', 'off']:
+        raise InvalidUsage('Invalid timer, expected on or off')
+    if not 1 <= minutes <= DaikinState.MAX_TIMER_DURATION:
+        raise InvalidUsage('Timer must be 1 to {} minutes'.format(
+            DaikinState.MAX_TIMER_DURATION))
+    state = get_controller().arm_timer(TIMER_MODE[mode.upper()], minutes)
+    return jsonify(state.serialize())
+
+
+@app.route('/timer', methods=['DELETE'])
+def cancel_timer():
+    return jsonify(get_controller().cancel_timer().serialize())
+
+
+def get_scheduler():
+    if scheduler is None:
+        raise InvalidUsage('Scheduling runs in daikin.service only',
+                           status_code=404)
+    return scheduler
+
+
+@app.route('/schedule')
+def get_schedule():
+    entries = []
+    for entry in get_scheduler():
+        data = entry.serialize()
+        data['next_due'] = entry.due
+        entries.append(data)
+    return jsonify({'entries': entries})
+
+
+@app.route('/schedule/<string:id>', methods=['PUT'])
+def put_schedule_entry(id):
+    """
+    Adds or replaces an entry, eg.
+    {"cron": "30 6 * * 1-5", "changes": {"power": true, "temperature": 21}}
+    or {"at": "2026-11-02T23:30", "unit": "bedroom",
+        "changes": {"power": false}}
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise InvalidUsage('Expected a schedule entry')
+    try:
+        entry = ScheduleEntry.deserialize(dict(data, id=id))
+    except ValueError as e:
+        raise InvalidUsage(str(e))
+    get_scheduler().add(entry)
+    return jsonify(entry.serialize())
+
+
+@app.route('/schedule/<string:id>', methods=['DELETE'])
+def delete_schedule_entry(id):
+    if get_scheduler().remove(id) is None:
+        raise InvalidUsage('No schedule entry {}'.format(id), status_code=404)
+    return 'OK'
 
 
 @app.route('/ac_mode')
@@ -127,12 +244,17 @@ def get_ac_mode():
 
 @app.route('/ac_mode/<string:value>', methods=['POST'])
 def set_ac_mode(value):
-    state = load()
-    if value in DaikinState.AC_MODE:
-        state.ac_mode = value
-        transmit(state)
-    else:
+    try:
+        changes = DaikinState.parse_changes({'ac_mode': value})
+    except ValueError:
         raise InvalidUsage('Invalid mode setting')
+    get_controller().update(**changes)
+    return 'OK'
+
+
+@app.route('/metrics')
+def metrics():
+    return app.response_class(REGISTRY.render(), content_type=CONTENT_TYPE)
 
 
 if __name__ == '__main__':
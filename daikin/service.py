@@ -0,0 +1,143 @@
+import os
+import asyncio
+import signal
+import logging
+
+from . import mqtt_service, server, tracing
+from .aio import AsyncioMQTT, WSGIServer
+from .scheduler import Scheduler
+from .units import UnitRegistry
+from .worker import LatestWinsWorker
+logger = logging.getLogger(__name__)
+
+HTTP_HOST = os.environ.get('HTTP_HOST', '0.0.0.0')
+HTTP_PORT = int(os.environ.get('HTTP_PORT', '5000'))
+MQTT_PORT = int(os.environ.get('MQTT_PORT', '1883'))
+
+
+class DaikinService:
+    """
+        The web server and the MQTT service in one process on one asyncio
+        loop, sharing the units' in-memory controllers
+
+        HTTP requests and MQTT messages are handled on the loop, IR
+        transmission and disk writes stay on the controllers' worker
+        threads (the transmitter pool) so neither ever waits on the emitter
+
+        The scheduler, if given, runs on its own thread and hands due
+        entries to the loop too
+    """
+
+    def __init__(self, registry, host=HTTP_HOST, port=HTTP_PORT,
+                 broker=None, broker_port=MQTT_PORT, scheduler=None):
+        self.registry = registry
+        self.scheduler = scheduler
+        self.http = WSGIServer(server.app, host, port)
+        self.broker = broker or mqtt_service.MQTT_BROKER
+        self.broker_port = broker_port
+        self.mqtt = None
+        self.mqtt_task = None
+        self.stopped = None
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        self.stopped = asyncio.Event()
+
+        # both front ends work on the same units
+        mqtt_service.registry = self.registry
+        server.controller = self.registry.default().controller
+
+        client = mqtt_service.create_mqtt_client()
+        self.mqtt = AsyncioMQTT(client, loop)
+        for unit in self.registry:
+            if unit.publisher is not None:
+                # transmissions finish on a worker thread, publish from the
+                # loop that owns the client, which can then cork its socket
+                unit.controller.on_transmit = self._on_loop(
+                    unit.publisher.publish)
+                unit.publisher.cork = True
+
+        if self.scheduler is not None:
+            self.scheduler.dispatch = self._on_loop(self.run_scheduled)
+            server.scheduler = self.scheduler
+            self.scheduler.start()
+
+        await self.http.start()
+        logger.info('HTTP on {}:{}, MQTT broker {}:{}'.format(
+            self.http.host, self.http.port, self.broker, self.broker_port))
+        self.mqtt_task = loop.create_task(
+            self.mqtt.run(self.broker, self.broker_port))
+
+    async def run(self):
+        await self.start()
+        try:
+            await self.stopped.wait()
+        finally:
+            await self.close()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run_scheduled(self, unit_name, values):
+        try:
+            unit = (self.registry.get(unit_name)
+                    if unit_name else self.registry.default())
+        except KeyError:
+            logger.warning('Scheduled change for unknown unit {}'.format(
+                unit_name))
+            return
+        unit.controller.update(**values)
+
+    async def close(self):
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        # start() may not have got this far
+        if self.mqtt is not None:
+            self.mqtt.stop()
+        if self.mqtt_task is not None:
+            self.mqtt_task.cancel()
+        await self.http.stop()
+        # pending saves and transmissions, off the loop
+        await asyncio.get_event_loop().run_in_executor(
+            None, self.registry.stop)
+
+    def _on_loop(self, func):
+        def call(*args):
+            self.mqtt.call_soon(func, *args)
+        return call
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    trace_listener = tracing.configure()
+
+    mqtt_service.MQTT_TOPICS = mqtt_service.load_topics()
+    mqtt_service.topics_writer = LatestWinsWorker(mqtt_service.write_topics,
+                                                  name='daikin-topics')
+    mqtt_service.topics_writer.start()
+
+    registry = UnitRegistry.load(
+        background=True, flush_interval=mqtt_service.STATE_FLUSH_INTERVAL)
+    for unit in registry:
+        unit.start_coalescing(mqtt_service.COALESCE_WINDOW,
+                              mqtt_service.COALESCE_MAX_DELAY)
+        unit.start_receiving()
+
+    # dispatch is set once the service's loop is running
+    scheduler = Scheduler.load(None)
+    service = DaikinService(registry, scheduler=scheduler)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, service.stop)
+    try:
+        loop.run_until_complete(service.run())
+    finally:
+        mqtt_service.topics_writer.stop()
+        loop.close()
+        if trace_listener is not None:
+            trace_listener.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+Compares the single asyncio service (service.py) with the old setup of the
+Flask dev server plus a separate mqtt_service process
+
+    python -m daikin.service_benchmark [requests]
+
+Every process transmits for real, in device mode into a plain file, and no
+broker is needed (the MQTT side keeps retrying in the background).
+Reported: request latency for POSTs to /temperature/<n>, a new connection
+per request like the Google Assistant webhooks, and the total resident
+memory of each setup once it has served them.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import tempfile
+import subprocess
+import http.client
+
+FLASK_SERVER = """
+from daikin import server
+server.app.run(host='127.0.0.1', port={port}, threaded=True)
+"""
+
+# what mqtt_service sets up before connecting, minus the broker
+MQTT_PROCESS = """
+import time
+from daikin import mqtt_service
+from daikin.units import UnitRegistry
+mqtt_service.registry = UnitRegistry.load(background=True)
+for unit in mqtt_service.registry:
+    unit.start_coalescing(0.15, 1.0)
+mqtt_service.create_mqtt_client()
+while True:
+    time.sleep(1)
+"""
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_port(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('Nothing listening on {}'.format(port))
+
+
+def rss_kib(pid):
+    with open('/proc/{}/status'.format(pid)) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def measure(port, requests):
+    latencies = []
+    for index in range(requests):
+        start = time.perf_counter()
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        connection.request('POST', '/temperature/{}'.format(18 + index % 13))
+        response = connection.getresponse()
+        response.read()
+        connection.close()
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            raise RuntimeError('Request failed: {}'.format(response.status))
+    return sorted(latencies)
+
+
+class Setup:
+    def __init__(self, name, workdir):
+        self.name = name
+        self.workdir = workdir
+        self.processes = []
+        self.port = free_port()
+        self.env = dict(
+            os.environ,
+            DAIKIN_UNITS_FILE=os.path.join(workdir, 'units.json'),
+            MQTT_BROKER='127.0.0.1',
+            HTTP_HOST='127.0.0.1',
+            HTTP_PORT=str(self.port),
+            PYTHONPATH=os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__))),
+        )
+
+    def spawn(self, *args):
+        self.processes.append(
+            subprocess.Popen([sys.executable] + list(args),
+                             env=self.env,
+                             cwd=self.workdir,
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL))
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait(10)
+
+    def rss_kib(self):
+        return sum(rss_kib(process.pid) for process in self.processes)
+
+
+def write_units(workdir):
+    storage_file = os.path.join(workdir, 'livingroom.json')
+    with open(storage_file, 'w') as f:
+        json.dump({}, f)
+    units = [{
+        'name': 'livingroom',
+        'topic_prefix': 'livingroom/ac/',
+        'mode': 'device',
+        'device': os.path.join(workdir, 'lirc0'),
+        'storage_file': storage_file,
+        'store_file': os.path.join(workdir, 'livingroom.bin'),
+    }]
+    with open(os.path.join(workdir, 'units.json'), 'w') as f:
+        json.dump({'units': units}, f)
+    open(os.path.join(workdir, 'lirc0'), 'w').close()
+
+
+def run(requests=200):
+    workdir = tempfile.mkdtemp()
+    try:
+        write_units(workdir)
+
+        two_process = Setup('flask + mqtt_service', workdir)
+        two_process.spawn('-c', FLASK_SERVER.format(port=two_process.port))
+        two_process.spawn('-c', MQTT_PROCESS)
+
+        single = Setup('asyncio service', workdir)
+        single.spawn('-m', 'daikin.service')
+
+        results = []
+        for setup in (two_process, single):
+            try:
+                wait_for_port(setup.port)
+                latencies = measure(setup.port, requests)
+                results.append((setup, latencies, setup.rss_kib()))
+            finally:
+                setup.stop()
+    finally:
+        shutil.rmtree(workdir)
+
+    print('{:<22} {:>9} {:>9} {:>9} {:>10}'.format('setup', 'p50 ms',
+                                                   'p95 ms', 'max ms',
+                                                   'RSS MiB'))
+    for setup, latencies, rss in results:
+        print('{:<22} {:9.2f} {:9.2f} {:9.2f} {:10.1f}'.format(
+            setup.name,
+            latencies[len(latencies) // 2] * 1e3,
+            latencies[int(len(latencies) * 0.95)] * 1e3,
+            latencies[-1] * 1e3,
+            rss / 1024.0,
+        ))
+
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:]])
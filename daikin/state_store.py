@@ -0,0 +1,197 @@
+import os
+import mmap
+import fcntl
+import struct
+import threading
+import logging
+
+from .daikin import DaikinState, data_file, make_parent_dir
+logger = logging.getLogger(__name__)
+
+STATE_STORE_FILE = os.environ.get('STATE_STORE_FILE',
+                                  data_file('state.bin'))
+
+
+class StateStore:
+    """
+        The current state shared between processes (server.py and
+        mqtt_service.py) through a small memory mapped record
+
+        Layout: magic (4 bytes), sequence (u64), packed DaikinState (u32,
+        stores written when it was a u16 read the same, the upper half was
+        zero padding), then when the state's timer runs out (f64 seconds
+        since the epoch, 0 for none; stores from before it are extended)
+
+        Writers take an fcntl lock on the file (plus a thread lock, fcntl
+        locks don't exclude threads of the same process) and bump the
+        sequence to odd while writing and back to even when done. Readers
+        don't lock at all, they retry until they see the same even sequence
+        before and after reading the state. The version of a state is
+        sequence // 2 and compare_and_swap only writes if nobody else has
+        written since that version was read.
+    """
+
+    MAGIC = b'DKS1'
+    RECORD = struct.Struct('<4sQId')
+    SEQUENCE_OFFSET = 4
+    STATE_OFFSET = 12
+    TIMER_OFFSET = 16
+    SIZE = 24
+    # before the timer deadline was added
+    STATE_SIZE = 16
+    READ_RETRIES = 100
+
+    def __init__(self, path=None, initial=None):
+        """
+        initial: callable returning the state to start from when the store
+        doesn't exist yet
+        """
+        self.path = path or STATE_STORE_FILE
+        self.lock = threading.Lock()
+        make_parent_dir(self.path)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            with self._locked():
+                size = os.fstat(self.fd).st_size
+                if size < self.STATE_SIZE:
+                    self._create(initial() if initial else DaikinState())
+                    size = self.SIZE
+                if os.pread(self.fd, len(self.MAGIC), 0) != self.MAGIC:
+                    raise ValueError('{} is not a state store'.format(
+                        self.path))
+                if size < self.SIZE:
+                    # zeros, no timer deadline
+                    os.ftruncate(self.fd, self.SIZE)
+                self.map = mmap.mmap(self.fd, self.SIZE)
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    def read(self):
+        """
+        (version, state) without taking any locks
+        """
+        return self.read_record()[:2]
+
+    def read_record(self):
+        """
+        (version, state, timer_expires) without taking any locks,
+        timer_expires is None without a deadline
+        """
+        for _ in range(self.READ_RETRIES):
+            sequence = self._sequence()
+            if sequence % 2:
+                continue
+            packed = struct.unpack_from('<I', self.map, self.STATE_OFFSET)[0]
+            expires = struct.unpack_from('<d', self.map, self.TIMER_OFFSET)[0]
+            if self._sequence() == sequence:
+                return sequence // 2, DaikinState.unpack(packed), (expires
+                                                                   or None)
+
+        # a writer is taking a while (or died mid-write), wait our turn
+        with self._locked():
+            return self._read_locked()
+
+    def compare_and_swap(self, version, state, timer_expires=None):
+        """
+        Writes state only if the store is still at version, returns the new
+        version or None if someone else got there first
+        """
+        with self._locked():
+            current = self._read_locked()[0]
+            if current != version:
+                return None
+            return self._write_locked(state, timer_expires=timer_expires)
+
+    def write(self, state, timer_expires=None):
+        """
+        Unconditionally replaces the state, returns the one it replaced
+        """
+        with self._locked():
+            previous = self._read_locked()[1]
+            self._write_locked(state, timer_expires=timer_expires)
+            return previous
+
+    def update(self, func):
+        """
+        Applies func to the current state with optimistic retries, func runs
+        without any lock held and may be called more than once.
+        Returns (previous, new) states, a timer deadline is kept
+        """
+        previous, state, _ = self.update_record(
+            lambda state, expires: (func(state), expires))
+        return previous, state
+
+    def update_record(self, func):
+        """
+        As update(), func takes and returns (state, timer_expires).
+        Returns (previous, new, timer_expires)
+        """
+        while True:
+            version, state, expires = self.read_record()
+            new_state, new_expires = func(state, expires)
+            if self.compare_and_swap(version, new_state,
+                                     new_expires) is not None:
+                return state, new_state, new_expires
+
+    def _sequence(self):
+        return struct.unpack_from('<Q', self.map, self.SEQUENCE_OFFSET)[0]
+
+    def _read_locked(self):
+        sequence = self._sequence()
+        packed = struct.unpack_from('<I', self.map, self.STATE_OFFSET)[0]
+        expires = struct.unpack_from('<d', self.map, self.TIMER_OFFSET)[0]
+        if sequence % 2:
+            # a writer died mid-write, we hold the lock so nobody else is
+            # writing, settle on whatever made it into the record
+            logger.warning('Recovering interrupted write to {}'.format(
+                self.path))
+            try:
+                state = DaikinState.unpack(packed)
+            except ValueError:
+                state = DaikinState()
+            self._write_locked(state, sequence=sequence - 1,
+                               timer_expires=expires)
+            return self._sequence() // 2, state, expires or None
+        return sequence // 2, DaikinState.unpack(packed), expires or None
+
+    def _write_locked(self, state, sequence=None, timer_expires=None):
+        if sequence is None:
+            sequence = self._sequence()
+        struct.pack_into('<Q', self.map, self.SEQUENCE_OFFSET, sequence + 1)
+        struct.pack_into('<I', self.map, self.STATE_OFFSET, state.pack())
+        struct.pack_into('<d', self.map, self.TIMER_OFFSET, timer_expires
+                         or 0.0)
+        struct.pack_into('<Q', self.map, self.SEQUENCE_OFFSET, sequence + 2)
+        return (sequence + 2) // 2
+
+    def _create(self, state):
+        record = self.RECORD.pack(self.MAGIC, 0, state.pack(), 0.0)
+        os.ftruncate(self.fd, 0)
+        os.pwrite(self.fd, record.ljust(self.SIZE, b'\0'), 0)
+        os.fsync(self.fd)
+
+    def _locked(self):
+        return _FileLock(self.lock, self.fd)
+
+
+class _FileLock:
+    def __init__(self, lock, fd):
+        self.lock = lock
+        self.fd = fd
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except Exception:
+            self.lock.release()
+            raise
+
+    def __exit__(self, type, value, traceback):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.lock.release()
@@ -32,7 +32,7 @@ class daikin_machine(object):
 
 def main():
     state = DaikinState(power=True, temperature=29, ac_mode=AC_MODE.HEAT)
-    state.fan_mode = FAN_MODE.FIVE
+    state = state.replace(fan_mode=FAN_MODE.FIVE)
 
     state = load()
 
@@ -0,0 +1,83 @@
+import io
+import os
+import shutil
+import tempfile
+from contextlib import redirect_stdout, redirect_stderr
+from unittest import TestCase, skipIf
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from daikin.daikin import AC_MODE, DaikinLIRC, DaikinMessage, DaikinState
+from daikin.decoder import DaikinDecoder
+
+if np is not None:
+    from daikin import batch_decoder
+    from daikin.batch_decoder import (decode_frames, decode_states,
+                                      load_capture, synthetic_capture,
+                                      to_states)
+
+
+@skipIf(np is None, 'numpy is not installed')
+class TestBatchDecoder(TestCase):
+    def setUp(self):
+        self.durations, self.states = synthetic_capture(300, seed=3)
+
+    def test_decodes_every_state(self):
+        frames = decode_frames(self.durations)
+        self.assertEqual(900, len(frames))
+        self.assertTrue(frames['valid'].all())
+        table = decode_states(self.durations)
+        self.assertEqual(self.states, to_states(table))
+
+    def test_matches_the_streaming_decoder(self):
+        self.assertEqual(
+            list(DaikinDecoder().feed_durations(self.durations.tolist())),
+            to_states(decode_states(self.durations)))
+
+    def test_chunks(self):
+        whole = decode_states(self.durations)
+        chunked = decode_states(self.durations, chunk_size=1001)
+        np.testing.assert_array_equal(whole, chunked)
+
+    def test_fields(self):
+        state = DaikinState(power=True, temperature=21, ac_mode=AC_MODE.HEAT,
+                            comfort=True, swing_vertical=True)
+        durations = DaikinLIRC().get_pulse_train(DaikinMessage(state))
+        row = decode_states(np.array(durations.durations))[0]
+        self.assertEqual((True, 21, AC_MODE.HEAT.value, True, True),
+                         (row['power'], row['temperature'], row['ac_mode'],
+                          row['comfort'], row['swing_vertical']))
+
+    def test_bad_checksum(self):
+        durations = self.durations.copy()
+        # the first bit of the temperature byte in the first third frame
+        position = decode_states(durations)['position'][0]
+        index = position + 2 + 2 * 8 * 6 + 3
+        durations[index] = (DaikinLIRC.ONE_GAP if durations[index] < 800
+                            else DaikinLIRC.ZERO_GAP)
+        table = decode_states(durations)
+        self.assertEqual([False] + [True] * 299, table['valid'].tolist())
+        self.assertEqual(self.states[1:], to_states(table))
+
+    def test_memory_mapped_captures(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        raw = os.path.join(directory, 'capture.u32')
+        self.durations.tofile(raw)
+        npy = os.path.join(directory, 'capture.npy')
+        np.save(npy, self.durations)
+
+        for path in (raw, npy):
+            capture = load_capture(path)
+            self.assertIsInstance(capture, np.memmap)
+            self.assertEqual(self.states, to_states(decode_states(capture)))
+
+        out, err = io.StringIO(), io.StringIO()
+        with redirect_stdout(out), redirect_stderr(err):
+            self.assertEqual(0, batch_decoder.main([raw]))
+        self.assertEqual(self.states[0].key(),
+                         out.getvalue().splitlines()[0].split()[1])
+        self.assertIn('300 messages, 0 with a bad checksum', err.getvalue())
@@ -0,0 +1,60 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from mock import patch
+
+from daikin import benchmark
+
+
+class TestBenchmark(TestCase):
+    def test_every_stage_runs(self):
+        for sweep in benchmark.SWEEPS:
+            report = benchmark.run(sweep=sweep, number=3, repeat=1)
+            self.assertEqual(sorted(benchmark.STAGES),
+                             sorted(result['stage']
+                                    for result in report['results']))
+            for result in report['results']:
+                self.assertGreater(result['best_us'], 0)
+                self.assertGreaterEqual(result['median_us'],
+                                        result['best_us'])
+        # round trips through JSON
+        self.assertEqual(report, json.loads(json.dumps(report)))
+
+    def test_update_transmits_every_state(self):
+        sent = []
+        with patch.object(benchmark.FakeLIRC, 'send',
+                          lambda lirc, message: sent.append(message.state)):
+            benchmark.run(['update'], number=8, repeat=1)
+        self.assertEqual(benchmark.SWEEPS['default']() * 2, sent)
+
+    def test_compare(self):
+        baseline = {'results': [
+            {'stage': 'state', 'best_us': 10.0},
+            {'stage': 'save', 'best_us': 100.0},
+        ]}
+        report = {'results': [
+            {'stage': 'state', 'best_us': 13.0},
+            {'stage': 'save', 'best_us': 110.0},
+            {'stage': 'load', 'best_us': 50.0},
+        ]}
+        self.assertEqual([('state', 10.0, 13.0)],
+                         benchmark.compare(report, baseline, 0.25))
+        self.assertEqual([], benchmark.compare(report, baseline, 0.5))
+
+    def test_threshold_mode(self):
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        output = os.path.join(workdir, 'results.json')
+        args = ['--stage', 'state', '--number', '3', '--repeat', '1']
+        with patch('sys.stdout'):
+            self.assertEqual(0, benchmark.main(args + ['--output', output]))
+            with open(output) as f:
+                baseline = json.load(f)
+            baseline['results'][0]['best_us'] = 1e-6
+            with open(output, 'w') as f:
+                json.dump(baseline, f)
+            with patch('sys.stderr'):
+                self.assertEqual(1, benchmark.main(args +
+                                                   ['--baseline', output]))
@@ -0,0 +1,175 @@
+import io
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+from unittest import TestCase
+from mock import MagicMock, patch
+
+from daikin import cli
+from daikin.daikin import (AC_MODE, TIMER_MODE, DaikinController,
+                           DaikinLIRC, DaikinState)
+from daikin.units import Unit
+
+ROOT = os.path.join(os.path.dirname(__file__), '..', '..')
+
+# daikin's own imports for status or set, well under what Flask alone takes
+IMPORT_BUDGET = 0.15
+
+
+def write_units_file(directory, *names):
+    units = []
+    for name in names:
+        storage_file = os.path.join(directory, '{}.json'.format(name))
+        with open(storage_file, 'w') as f:
+            json.dump({}, f)
+        units.append({
+            'name': name,
+            'mode': 'device',
+            'device': os.path.join(directory, 'lirc'),
+            'storage_file': storage_file,
+            'store_file': os.path.join(directory, '{}.bin'.format(name)),
+        })
+    path = os.path.join(directory, 'units.json')
+    with open(path, 'w') as f:
+        json.dump({'units': units}, f)
+    return path
+
+
+class TestCli(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.storage_file = os.path.join(self.dir, 'config.json')
+        with open(self.storage_file, 'w') as f:
+            json.dump({}, f)
+        self.lirc = MagicMock(spec=DaikinLIRC)
+        self.controller = DaikinController(storage_file=self.storage_file,
+                                           lirc=self.lirc)
+        self.unit = Unit('livingroom', 'livingroom/ac/', self.controller)
+        patcher = patch('daikin.cli.open_unit', return_value=self.unit)
+        self.open_unit = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_cli(self, *argv):
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.assertEqual(0, cli.main(list(argv)))
+        return stdout.getvalue()
+
+    def assertUsageError(self, *argv):
+        with patch('sys.stderr', new_callable=io.StringIO), \
+                self.assertRaises(SystemExit) as raised:
+            cli.main(list(argv))
+        self.assertEqual(2, raised.exception.code)
+
+    def test_set(self):
+        output = self.run_cli('set', '--mode', 'heat', '--temp', '22',
+                              '--power', 'on')
+        state = DaikinState(power=True, temperature=22, ac_mode=AC_MODE.HEAT)
+        self.assertEqual(state, self.controller.current_state())
+        self.assertEqual(1, self.lirc.send.call_count)
+        self.assertIn('temperature: 22', output)
+
+    def test_set_timer(self):
+        self.run_cli('set', '--timer', 'off', '--timer-minutes', '90')
+        state = self.controller.current_state()
+        self.assertEqual((TIMER_MODE.OFF, 90),
+                         (state.timer, state.timer_duration))
+
+    def test_set_invalid(self):
+        self.assertUsageError('set', '--temp', '40')
+        self.assertUsageError('set', '--mode', 'warm')
+        self.assertUsageError('set', '--power', 'maybe')
+        self.assertUsageError('set')
+        self.lirc.send.assert_not_called()
+
+    def test_status(self):
+        self.controller.update(power=True, temperature=25)
+        self.lirc.reset_mock()
+        data = json.loads(self.run_cli('status', '--json'))
+        self.assertEqual(self.controller.current_state().serialize(), data)
+        self.assertIn('power: True', self.run_cli('status'))
+        self.lirc.send.assert_not_called()
+
+    def test_resend(self):
+        self.controller.update(power=True)
+        self.run_cli('resend')
+        self.assertEqual(2, self.lirc.send.call_count)
+
+    def test_unit(self):
+        self.run_cli('status', '--unit', 'bedroom')
+        self.open_unit.assert_called_once_with('bedroom')
+        self.open_unit.return_value = None
+        self.assertUsageError('status', '--unit', 'kitchen')
+
+
+class TestOpenUnit(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = write_units_file(self.dir, 'livingroom', 'bedroom')
+        patcher = patch('daikin.units.DAIKIN_UNITS_FILE', path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_open_unit(self):
+        self.assertEqual('livingroom', cli.open_unit().name)
+        self.assertEqual('bedroom', cli.open_unit('bedroom').name)
+        self.assertIsNone(cli.open_unit('kitchen'))
+
+
+class TestImports(TestCase):
+    """
+        Runs the command in a fresh interpreter under python -X importtime
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        open(os.path.join(self.dir, 'lirc'), 'w').close()
+        self.env = dict(os.environ,
+                        DAIKIN_UNITS_FILE=write_units_file(self.dir, 'test'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def import_times(self, *argv):
+        """
+        Cumulative import time of each top level package (in seconds) and
+        the modules loaded once the command has run
+        """
+        script = ('import sys; from daikin import cli; '
+                  'cli.main(sys.argv[1:]); print(" ".join(sys.modules))')
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', script] + list(argv),
+            cwd=ROOT, env=self.env, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        times = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            # nested imports are indented under the one that caused them
+            if not name.startswith('  ') and cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative) / 1e6
+        modules = result.stdout.splitlines()[-1].split()
+        return times, modules
+
+    def assertWithinBudget(self, *argv):
+        times, modules = self.import_times(*argv)
+        for heavy in ('flask', 'paho', 'numpy', 'jinja2'):
+            self.assertNotIn(heavy, modules)
+        own = sum(seconds for name, seconds in times.items()
+                  if name.split('.')[0] == 'daikin')
+        self.assertLess(own, IMPORT_BUDGET, sorted(times.items()))
+
+    def test_status(self):
+        self.assertWithinBudget('status')
+
+    def test_set(self):
+        self.assertWithinBudget('set', '--mode', 'heat', '--temp', '22')
@@ -0,0 +1,158 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from mock import patch, call, MagicMock
+
+from daikin.codebook import (DaikinLIRCCodebook, LIRC_RELOAD)
+from daikin.lircd_client import LircdClient
+from daikin.daikin import (AC_MODE, FAN_MODE, LIRC_DYNAMIC_CODE,
+                           TIMER_MODE, DaikinLIRC, DaikinMessage, DaikinState)
+
+
+class TestStateKey(TestCase):
+    def test_key(self):
+        state = DaikinState(power=True, temperature=22, ac_mode=AC_MODE.HEAT)
+        self.assertEqual('on-22-heat-auto-00000', state.key())
+
+    def test_round_trip(self):
+        state = DaikinState(
+            temperature=27,
+            ac_mode=AC_MODE.DRY,
+            fan_mode=FAN_MODE.SILENT,
+            swing_vertical=True,
+            comfort=True,
+            powerful=True,
+        )
+        restored = DaikinState.from_key(state.key())
+        self.assertEqual(state.serialize(), restored.serialize())
+
+    def test_invalid_key(self):
+        with self.assertRaises(ValueError):
+            DaikinState.from_key('up-22-heat-auto-00000')
+
+
+@patch('daikin.codebook.subprocess')
+class TestDaikinLIRCCodebook(TestCase):
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        self.preset = DaikinState(power=True, ac_mode=AC_MODE.HEAT)
+        self.client = MagicMock(spec=LircdClient)
+
+    def tearDown(self):
+        shutil.rmtree(self.config_dir)
+
+    def create_codebook(self, **kwargs):
+        kwargs.setdefault('presets', [self.preset])
+        return DaikinLIRCCodebook(
+            config_dir=self.config_dir, client=self.client, **kwargs)
+
+    def install_config(self, config):
+        with open(os.path.join(self.config_dir, 'daikin-pi.lircd.conf'),
+                  'w') as f:
+            f.write(config)
+
+    def test_raw_code_matches_dynamic_config(self, subprocess):
+        lirc = DaikinLIRC()
+        message = DaikinMessage(self.preset)
+        config = lirc.get_config(message)
+        self.assertIn(lirc.get_raw_code(message, 'dynamic-signal'), config)
+
+    def test_preset_send_is_a_single_send(self, subprocess):
+        codebook = self.create_codebook()
+        self.install_config(codebook.get_codebook_config())
+        codebook = self.create_codebook()
+
+        codebook.send(DaikinMessage(self.preset))
+
+        subprocess.check_output.assert_not_called()
+        self.client.send_once.assert_called_once_with(
+            'daikin-pi', self.preset.key())
+
+    def test_new_state_installs_and_reloads(self, subprocess):
+        codebook = self.create_codebook()
+        state = DaikinState(power=True, temperature=25, ac_mode=AC_MODE.COOL)
+
+        codebook.send(DaikinMessage(state))
+
+        commands = [c[0][0] for c in subprocess.check_output.call_args_list]
+        self.assertEqual(['sudo', 'install'], commands[0][:2])
+        self.assertEqual([
+            'sudo', 'mv', '-f', codebook.staging_path, codebook.config_path
+        ], commands[1])
+        self.assertEqual(LIRC_RELOAD, commands[2])
+        self.client.send_once.assert_called_once_with(
+            'daikin-pi', state.key())
+        self.assertIn(state.key(), codebook)
+        self.assertIn('name {}'.format(state.key()), codebook.installed)
+
+    def test_repeat_state_does_not_reload(self, subprocess):
+        codebook = self.create_codebook()
+        state = DaikinState(power=True, temperature=25, ac_mode=AC_MODE.COOL)
+        codebook.send(DaikinMessage(state))
+        subprocess.reset_mock()
+        self.client.reset_mock()
+
+        codebook.send(DaikinMessage(self.preset))
+        codebook.send(DaikinMessage(state))
+
+        subprocess.check_output.assert_not_called()
+        self.assertEqual([
+            call('daikin-pi', self.preset.key()),
+            call('daikin-pi', state.key()),
+        ], self.client.send_once.call_args_list)
+
+    def test_evicts_least_recently_used(self, subprocess):
+        codebook = self.create_codebook(capacity=2)
+        first, second, third = [
+            DaikinState(power=True, temperature=t) for t in (20, 21, 22)
+        ]
+        codebook.send(DaikinMessage(first))
+        codebook.send(DaikinMessage(second))
+        codebook.send(DaikinMessage(first))
+        codebook.send(DaikinMessage(third))
+
+        self.assertIn(first.key(), codebook)
+        self.assertNotIn(second.key(), codebook)
+        self.assertIn(third.key(), codebook)
+        self.assertIn(self.preset.key(), codebook)
+
+    def test_restores_codes_from_installed_config(self, subprocess):
+        codebook = self.create_codebook()
+        state = DaikinState(power=True, temperature=25, ac_mode=AC_MODE.COOL)
+        codebook.add(state)
+        self.install_config(codebook.get_codebook_config())
+
+        restored = self.create_codebook()
+        restored.send(DaikinMessage(state))
+
+        self.assertIn(state.key(), restored)
+        subprocess.check_output.assert_not_called()
+        self.client.send_once.assert_called_once_with(
+            'daikin-pi', state.key())
+
+    @patch('daikin.daikin.subprocess')
+    def test_timer_states_skip_the_codebook(self, dynamic, subprocess):
+        codebook = self.create_codebook()
+        self.install_config(codebook.get_codebook_config())
+        codebook = self.create_codebook()
+        keys = codebook.keys()
+
+        # the same timer, a minute apart
+        for minutes_left in (90, 89):
+            codebook.send(
+                DaikinMessage(
+                    self.preset.replace(
+                        timer=TIMER_MODE.OFF, timer_duration=minutes_left)))
+
+        subprocess.check_output.assert_not_called()
+        self.assertEqual(keys, codebook.keys())
+        self.assertEqual([
+            call('daikin-pi', LIRC_DYNAMIC_CODE),
+            call('daikin-pi', LIRC_DYNAMIC_CODE),
+        ], self.client.send_once.call_args_list)
+
+        # the dynamic config took the codebook's place
+        codebook.send(DaikinMessage(self.preset))
+        self.assertEqual(LIRC_RELOAD,
+                         subprocess.check_output.call_args_list[-1][0][0])
@@ -0,0 +1,95 @@
+import os
+import subprocess
+import sys
+from unittest import TestCase, skipIf
+
+from daikin.daikin import (AC_MODE, FAN_MODE, DaikinLIRC, DaikinMessage,
+                           DaikinState)
+
+try:
+    from jinja2 import Template
+except ImportError:
+    Template = None
+
+# the template get_config used to render on every call
+JINJA_TEMPLATE = """begin remote
+    name    daikin-pi
+    flags   RAW_CODES
+    eps     30
+    aeps    100
+    gap     34978
+    begin raw_codes
+        name dynamic-signal
+        {{zero}}
+        {{zero}}
+        {{zero}}
+        {{zero}}
+        {{zero}}
+        {{short_gap}}
+        {{frame_header}}
+        {{frame_one}}
+        {{long_gap}}
+        {{frame_header}}
+        {{frame_two}}
+        {{long_gap}}
+        {{frame_header}}
+        {{frame_three}}
+        {{pulse}}
+    end raw_codes
+end remote
+        """
+
+
+def render_jinja_config(lirc, message):
+    return Template(JINJA_TEMPLATE).render(
+        zero=lirc.ZERO,
+        pulse=lirc.PULSE,
+        frame_header=lirc.FRAME_HEADER,
+        short_gap=lirc.SHORT_GAP,
+        long_gap=lirc.LONG_GAP,
+        frame_one=lirc._get_frame_codes(message.frame_one),
+        frame_two=lirc._get_frame_codes(message.frame_two),
+        frame_three=lirc._get_frame_codes(message.frame_three),
+    )
+
+
+@skipIf(Template is None, 'jinja2 is not installed')
+class TestConfigMatchesTemplate(TestCase):
+    def setUp(self):
+        self.lirc = DaikinLIRC()
+
+    def assertMatchesTemplate(self, state):
+        message = DaikinMessage(state)
+        self.assertEqual(
+            render_jinja_config(self.lirc, message).encode('ascii'),
+            self.lirc.get_config(message).encode('ascii'))
+
+    def test_every_mode(self):
+        for ac_mode in AC_MODE:
+            for fan_mode in FAN_MODE:
+                for power in (True, False):
+                    self.assertMatchesTemplate(
+                        DaikinState(power=power,
+                                    temperature=24,
+                                    ac_mode=ac_mode,
+                                    fan_mode=fan_mode))
+
+    def test_every_flag_and_temperature(self):
+        for temperature in range(18, 31):
+            self.assertMatchesTemplate(
+                DaikinState(power=True,
+                            temperature=temperature,
+                            swing_vertical=temperature % 2,
+                            swing_horizontal=temperature % 3,
+                            economy=temperature % 4,
+                            comfort=temperature % 5,
+                            powerful=temperature % 6))
+
+
+class TestConfigImports(TestCase):
+    def test_jinja2_is_not_imported(self):
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, daikin.daikin; print("jinja2" in sys.modules)'
+        ], cwd=os.path.join(os.path.dirname(__file__), '..', '..'))
+        self.assertEqual(b'False', output.strip())
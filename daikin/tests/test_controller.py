@@ -0,0 +1,377 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+from mock import MagicMock, patch
+
+from daikin.daikin import (AC_MODE, TIMER_MODE, DaikinController,
+                           DaikinLIRC, DaikinState)
+
+
+class TestDaikinController(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.storage_file = os.path.join(self.dir, 'config.json')
+        with open(self.storage_file, 'w') as f:
+            json.dump({}, f)
+        self.lirc = MagicMock(spec=DaikinLIRC)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def stored(self):
+        with open(self.storage_file) as f:
+            return json.load(f)
+
+    def test_update_saves_and_transmits(self):
+        controller = DaikinController(storage_file=self.storage_file,
+                                      lirc=self.lirc)
+        controller.update(power=True, temperature=22)
+
+        self.assertTrue(self.stored()['power'])
+        self.assertEqual(22, self.stored()['temperature'])
+        message = self.lirc.send.call_args[0][0]
+        self.assertEqual(22, message.state.temperature)
+
+    def test_update_many_fields_at_once(self):
+        controller = DaikinController(storage_file=self.storage_file,
+                                      lirc=self.lirc)
+        with patch.object(controller, 'save',
+                          wraps=controller.save) as save:
+            controller.update(ac_mode=AC_MODE.HEAT,
+                              temperature=22,
+                              economy=True,
+                              comfort=True)
+
+        save.assert_called_once()
+        self.lirc.send.assert_called_once()
+        state = self.lirc.send.call_args[0][0].state
+        self.assertEqual((AC_MODE.HEAT, 22, True, True),
+                         (state.ac_mode, state.temperature, state.economy,
+                          state.comfort))
+
+    def test_update_is_incremental(self):
+        controller = DaikinController(storage_file=self.storage_file,
+                                      lirc=self.lirc)
+        controller.update(temperature=22)
+        controller.update(ac_mode=AC_MODE.HEAT)
+
+        restored = DaikinController(storage_file=self.storage_file,
+                                    lirc=self.lirc).load()
+        self.assertEqual(22, restored.temperature)
+        self.assertEqual(AC_MODE.HEAT, restored.ac_mode)
+
+    def test_unchanged_state_is_not_transmitted_again(self):
+        controller = DaikinController(storage_file=self.storage_file,
+                                      lirc=self.lirc)
+        controller.update(power=True, temperature=22)
+        # eg. retained messages replayed after a reconnect
+        controller.update(power=True)
+        controller.update(temperature=22)
+
+        self.assertEqual(1, self.lirc.send.call_count)
+        self.assertEqual(1, controller.sent_count)
+        self.assertEqual(2, controller.skipped_count)
+
+    def test_force_resends(self):
+        controller = DaikinController(storage_file=self.storage_file,
+                                      lirc=self.lirc)
+        controller.update(power=True)
+        controller.update(power=True, force=True)
+        controller.resend()
+
+        self.assertEqual(3, self.lirc.send.call_count)
+        self.assertEqual(0, controller.skipped_count)
+
+    def test_change_after_skip_is_sent(self):
+        controller = DaikinController(storage_file=self.storage_file,
+                                      lirc=self.lirc)
+        controller.update(temperature=22)
+        controller.update(temperature=22)
+        controller.update(temperature=23)
+
+        self.assertEqual(2, controller.sent_count)
+        message = self.lirc.send.call_args[0][0]
+        self.assertEqual(23, message.state.temperature)
+
+    def sent(self):
+        return self.lirc.send.call_args[0][0].state
+
+    @patch('daikin.daikin.time.time')
+    def test_arm_timer(self, now):
+        now.return_value = 1000.0
+        controller = DaikinController(storage_file=self.storage_file,
+                                      lirc=self.lirc)
+        controller.arm_timer(TIMER_MODE.ON, 90)
+        self.assertEqual((TIMER_MODE.ON, 90),
+                         (self.sent().timer, self.sent().timer_duration))
+        self.assertFalse(self.sent().power)
+        self.assertEqual(TIMER_MODE.ON.name, self.stored()['timer'])
+
+        # later changes carry the time left instead of restarting the timer
+        now.return_value += 30 * 60 + 1
+        controller.update(temperature=22)
+        self.assertEqual((TIMER_MODE.ON, 60),
+                         (self.sent().timer, self.sent().timer_duration))
+
+        controller.cancel_timer()
+        self.assertEqual(TIMER_MODE.NONE, self.sent().timer)
+        self.assertIsNone(controller.timer_expires)
+
+    @patch('daikin.daikin.time.time')
+    def test_rearming_restarts_the_timer(self, now):
+        now.return_value = 1000.0
+        controller = DaikinController(storage_file=self.storage_file,
+                                      lirc=self.lirc)
+        controller.arm_timer(TIMER_MODE.OFF, 60)
+        now.return_value += 30 * 60
+        controller.arm_timer(TIMER_MODE.OFF, 60)
+        self.assertEqual(1000.0 + 90 * 60, controller.timer_expires)
+        # sent again so the unit restarts it too
+        self.assertEqual(2, self.lirc.send.call_count)
+        self.assertEqual(60, self.sent().timer_duration)
+
+    @patch('daikin.daikin.time.time')
+    def test_replayed_timer_keeps_its_deadline(self, now):
+        # eg. a retained timer/set message
+        now.return_value = 1000.0
+        controller = DaikinController(storage_file=self.storage_file,
+                                      lirc=self.lirc)
+        controller.update(power=True)
+        controller.update(timer=TIMER_MODE.OFF, timer_duration=60)
+        now.return_value += 50 * 60
+        controller.update(timer=TIMER_MODE.OFF, timer_duration=60)
+        self.assertEqual(1000.0 + 60 * 60, controller.timer_expires)
+
+        now.return_value += 20 * 60
+        state = controller.update(temperature=24)
+        self.assertFalse(state.power)
+        self.assertEqual(TIMER_MODE.NONE, state.timer)
+        self.assertEqual(state, self.sent())
+
+    @patch('daikin.daikin.time.time')
+    def test_timer_deadline_is_saved(self, now):
+        now.return_value = 1000.0
+        controller = DaikinController(storage_file=self.storage_file,
+                                      lirc=self.lirc)
+        controller.arm_timer(TIMER_MODE.ON, 30)
+        self.assertEqual(1000.0 + 30 * 60, self.stored()['timer_expires'])
+
+        now.return_value += 10 * 60
+        restarted = DaikinController(storage_file=self.storage_file,
+                                     lirc=self.lirc)
+        restarted.update(temperature=25)
+        self.assertEqual((TIMER_MODE.ON, 20),
+                         (self.sent().timer, self.sent().timer_duration))
+
+    @patch('daikin.daikin.time.time')
+    def test_expired_timer_switched_the_unit(self, now):
+        now.return_value = 1000.0
+        controller = DaikinController(storage_file=self.storage_file,
+                                      lirc=self.lirc)
+        controller.update(power=True)
+        controller.arm_timer(TIMER_MODE.OFF, 60)
+
+        now.return_value += 61 * 60
+        state = controller.update(temperature=24)
+        # the unit turned itself off, sending power on would undo that
+        self.assertFalse(state.power)
+        self.assertEqual(TIMER_MODE.NONE, state.timer)
+        self.assertEqual(state, self.sent())
+
+    def test_state_without_timer_cancels_it(self):
+        controller = DaikinController(storage_file=self.storage_file,
+                                      lirc=self.lirc)
+        controller.arm_timer(TIMER_MODE.ON, 30)
+        controller.set_state(DaikinState(power=True))
+        self.assertEqual(TIMER_MODE.NONE, self.sent().timer)
+        self.assertIsNone(controller.timer_expires)
+
+    def test_sync_takes_the_remote_state_without_sending_it(self):
+        controller = DaikinController(storage_file=self.storage_file,
+                                      lirc=self.lirc)
+        controller.on_transmit = MagicMock()
+        remote = DaikinState(power=True, temperature=24, ac_mode=AC_MODE.COOL)
+        controller.sync(remote)
+
+        self.lirc.send.assert_not_called()
+        controller.on_transmit.assert_called_once_with(remote)
+        self.assertEqual(24, self.stored()['temperature'])
+        # the next change builds on it and the same state isn't resent
+        controller.update(temperature=24)
+        self.lirc.send.assert_not_called()
+        controller.update(temperature=23)
+        self.assertEqual(remote.replace(temperature=23),
+                         self.lirc.send.call_args[0][0].state)
+
+    def test_save_is_atomic(self):
+        controller = DaikinController(storage_file=self.storage_file,
+                                      lirc=self.lirc)
+        controller.save(DaikinState(temperature=22))
+
+        with patch('daikin.daikin.json.dump', side_effect=IOError('crash')):
+            with self.assertRaises(IOError):
+                controller.save(DaikinState(temperature=28))
+
+        # the interrupted write never touched the real file
+        self.assertEqual(22, self.stored()['temperature'])
+        self.assertEqual(22, controller.load().temperature)
+
+    def test_save_syncs_to_disk(self):
+        controller = DaikinController(storage_file=self.storage_file,
+                                      lirc=self.lirc)
+        with patch('daikin.daikin.os.fsync') as fsync:
+            controller.save(DaikinState(temperature=22))
+        self.assertGreaterEqual(fsync.call_count, 1)
+        self.assertEqual(['config.json'], os.listdir(self.dir))
+
+    def test_concurrent_changes_all_count(self):
+        controller = DaikinController(storage_file=self.storage_file,
+                                      lirc=self.lirc)
+        step = lambda current: current.replace(
+            temperature=current.temperature + 1)
+        threads = [threading.Thread(target=controller.change, args=(step, ))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(27, controller.current_state().temperature)
+        self.assertEqual(27, controller.load().temperature)
+
+    def test_save_creates_the_data_dir(self):
+        storage_file = os.path.join(self.dir, 'data', 'config.json')
+        controller = DaikinController(storage_file=storage_file,
+                                      lirc=self.lirc)
+        controller.update(power=True)
+        self.assertTrue(controller.load().power)
+
+
+class TestBackgroundController(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.storage_file = os.path.join(self.dir, 'config.json')
+        with open(self.storage_file, 'w') as f:
+            json.dump({}, f)
+
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.sent = []
+
+        def send(message):
+            self.started.set()
+            self.release.wait(5)
+            self.sent.append(message.state.temperature)
+
+        self.lirc = MagicMock(spec=DaikinLIRC)
+        self.lirc.send.side_effect = send
+        self.controller = DaikinController(storage_file=self.storage_file,
+                                           lirc=self.lirc,
+                                           background=True)
+
+    def tearDown(self):
+        self.release.set()
+        self.controller.stop(5)
+        shutil.rmtree(self.dir)
+
+    def test_update_does_not_wait_for_transmission(self):
+        state = self.controller.update(temperature=25)
+        self.assertEqual(25, state.temperature)
+        self.assertEqual([], self.sent)
+
+        self.release.set()
+        self.assertTrue(self.controller.transmitter.join_pending(5))
+        self.assertEqual([25], self.sent)
+
+    def test_only_latest_pending_state_is_sent(self):
+        for temperature in range(20, 26):
+            self.controller.update(temperature=temperature)
+        self.release.set()
+        self.controller.stop(5)
+
+        # the first state may already be in flight, the rest collapse
+        self.assertEqual(25, self.sent[-1])
+        self.assertLessEqual(len(self.sent), 2)
+        with open(self.storage_file) as f:
+            self.assertEqual(25, json.load(f)['temperature'])
+
+    def test_incremental_updates_use_memory(self):
+        self.controller.update(temperature=22)
+        state = self.controller.update(ac_mode=AC_MODE.COOL)
+        self.assertEqual(22, state.temperature)
+        self.assertEqual(AC_MODE.COOL, state.ac_mode)
+
+    def test_unchanged_state_is_skipped_by_worker(self):
+        self.release.set()
+        self.controller.update(temperature=22)
+        self.assertTrue(self.controller.transmitter.join_pending(5))
+        self.controller.update(temperature=22)
+        self.assertTrue(self.controller.transmitter.join_pending(5))
+        self.controller.resend()
+        self.assertTrue(self.controller.transmitter.join_pending(5))
+
+        self.assertEqual([22, 22], self.sent)
+        self.assertEqual(1, self.controller.skipped_count)
+
+    def test_replaced_resend_is_still_forced(self):
+        self.controller.update(temperature=22)
+        self.assertTrue(self.started.wait(5))
+        # both wait behind the transmission in flight, the unchanged
+        # update replaces the resend without cancelling it
+        self.controller.resend()
+        self.controller.update(temperature=22)
+        self.release.set()
+        self.assertTrue(self.controller.transmitter.join_pending(5))
+
+        self.assertEqual([22, 22], self.sent)
+        self.assertEqual(0, self.controller.skipped_count)
+
+    def test_pending_state_is_not_modified(self):
+        first = self.controller.update(temperature=22)
+        self.controller.update(temperature=28)
+        self.assertEqual(22, first.temperature)
+        self.assertIsInstance(first, DaikinState)
+
+
+class TestWriteBehind(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.storage_file = os.path.join(self.dir, 'config.json')
+        with open(self.storage_file, 'w') as f:
+            json.dump({}, f)
+        self.controller = DaikinController(storage_file=self.storage_file,
+                                           lirc=MagicMock(spec=DaikinLIRC),
+                                           background=True,
+                                           flush_interval=10)
+        self.saves = []
+        save = self.controller.save
+
+        def record(state):
+            self.saves.append(state.temperature)
+            save(state)
+
+        self.controller.persister.target = record
+
+    def tearDown(self):
+        self.controller.stop(5)
+        shutil.rmtree(self.dir)
+
+    def stored(self):
+        with open(self.storage_file) as f:
+            return json.load(f)
+
+    def test_writes_are_batched(self):
+        self.controller.update(temperature=20)
+        self.assertTrue(self.controller.persister.join_pending(5))
+        for temperature in range(21, 28):
+            self.controller.update(temperature=temperature)
+
+        # the first write goes straight out, the rest wait for the interval
+        self.assertEqual(27, self.controller.current_state().temperature)
+        self.assertEqual([20], self.saves)
+
+        self.controller.stop(5)
+        self.assertEqual([20, 27], self.saves)
+        self.assertEqual(27, self.stored()['temperature'])
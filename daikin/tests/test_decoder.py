@@ -0,0 +1,148 @@
+import io
+import os
+import random
+import struct
+from unittest import TestCase
+
+from daikin.daikin import (AC_MODE, FAN_MODE, TIMER_MODE, DaikinLIRC,
+                           DaikinMessage, DaikinState)
+from daikin.decoder import (LIRC_MODE2_PULSE, LIRC_MODE2_TIMEOUT,
+                            DaikinDecoder, read_lirc_device, read_mode2,
+                            state_from_frames)
+
+LIRCD_CONF = os.path.join(os.path.dirname(__file__), '../../daikin.lircd.conf')
+
+STATES = [
+    DaikinState(),
+    DaikinState(power=True, temperature=22, ac_mode=AC_MODE.HEAT),
+    DaikinState(power=True,
+                temperature=25,
+                ac_mode=AC_MODE.COOL,
+                fan_mode=FAN_MODE.FIVE,
+                swing_vertical=True,
+                swing_horizontal=True,
+                economy=True,
+                comfort=True,
+                powerful=True),
+    DaikinState(power=True, ac_mode=AC_MODE.DRY, timer=TIMER_MODE.OFF,
+                timer_duration=300),
+    DaikinState(ac_mode=AC_MODE.FAN, fan_mode=FAN_MODE.SILENT,
+                timer=TIMER_MODE.ON, timer_duration=720),
+]
+
+
+def durations(state):
+    return list(DaikinLIRC().get_pulse_train(DaikinMessage(state)))
+
+
+def mode2_capture(states, jitter=0.15, seed=0):
+    """
+    What mode2 prints for the states sent one after the other, receivers
+    stretch marks and shorten spaces, plus some noise
+    """
+    rng = random.Random(seed)
+    lines = ['Using driver default on device /dev/lirc1', 'space 16777215']
+    for state in states:
+        pulse = True
+        for duration in durations(state):
+            if pulse:
+                duration *= 1 + rng.uniform(0, jitter)
+            else:
+                duration *= 1 - rng.uniform(0, jitter)
+            lines.append('{} {}'.format('pulse' if pulse else 'space',
+                                        int(duration)))
+            pulse = not pulse
+        lines.append('timeout 130000')
+    return lines
+
+
+class TestDaikinDecoder(TestCase):
+    def test_lircd_conf(self):
+        with open(LIRCD_CONF) as f:
+            raw_code = f.read().split('name test-signal')[1]
+        decoder = DaikinDecoder()
+        states = list(
+            decoder.feed_durations(
+                int(value)
+                for value in raw_code.split('end raw_codes')[0].split()))
+
+        self.assertEqual([
+            DaikinState(power=True, temperature=20, ac_mode=AC_MODE.HEAT)
+        ], states)
+        self.assertEqual((3, 0), (decoder.frames, decoder.errors))
+
+    def test_round_trip(self):
+        decoder = DaikinDecoder()
+        step = DaikinState.STATE_COUNT // 500
+        for packed in range(0, DaikinState.STATE_COUNT, step):
+            state = DaikinState.unpack(packed)
+            self.assertEqual([state],
+                             list(decoder.feed_durations(durations(state))))
+        self.assertEqual(0, decoder.errors)
+
+    def test_mode2_capture(self):
+        decoder = DaikinDecoder()
+        states = list(decoder.feed_all(read_mode2(mode2_capture(STATES))))
+        self.assertEqual(STATES, states)
+        self.assertEqual(0, decoder.errors)
+
+    def test_out_of_tolerance(self):
+        decoder = DaikinDecoder()
+        train = durations(STATES[1])
+        # a one bit's space in the third frame, stretched past one bit and
+        # short of a gap
+        index = len(train) - 20
+        while train[index] != DaikinLIRC.ONE_GAP:
+            index -= 2
+        train[index] = 2000
+        self.assertEqual([], list(decoder.feed_durations(train)))
+        self.assertEqual(1, decoder.errors)
+        # and picks up again with the next message
+        self.assertEqual([STATES[2]],
+                         list(decoder.feed_durations(durations(STATES[2]))))
+
+    def test_bad_checksum(self):
+        decoder = DaikinDecoder()
+        frame = bytearray(DaikinMessage(STATES[1]).frame_three)
+        frame[6] += 2
+        lirc = DaikinLIRC()
+        train = [lirc.FRAME_HEADER_PULSE, lirc.FRAME_HEADER_GAP] + [
+            duration for value in frame for duration in lirc.byte_table[value]
+        ]
+        self.assertEqual([], list(decoder.feed_durations(train)))
+        self.assertEqual(1, decoder.errors)
+
+    def test_noise(self):
+        rng = random.Random(1)
+        decoder = DaikinDecoder()
+        noise = [rng.choice([430, 1320, 3440, 1720, 9000, 200])
+                 for _ in range(5000)]
+        list(decoder.feed_durations(noise + [25000]))
+        # never holds more than a frame
+        self.assertLessEqual(len(decoder.frame), 19)
+        self.assertEqual([STATES[3]],
+                         list(decoder.feed_durations(durations(STATES[3]))))
+
+    def test_missing_first_frame(self):
+        frame_three = bytes(DaikinMessage(STATES[2]).frame_three)
+        self.assertFalse(state_from_frames(frame_three).comfort)
+        with self.assertRaises(ValueError):
+            state_from_frames(bytes([0] * 5 + [0x10] + [0] * 13))
+
+
+class TestReaders(TestCase):
+    def test_read_mode2(self):
+        self.assertEqual([(True, 430), (False, 1320), (False, 120000)],
+                         list(
+                             read_mode2([
+                                 'Using driver devinput', 'pulse 430',
+                                 'space 1320', 'timeout 120000', 'pulse',
+                             ])))
+
+    def test_read_lirc_device(self):
+        values = [LIRC_MODE2_PULSE | 3440, 1720, LIRC_MODE2_PULSE | 430,
+                  LIRC_MODE2_TIMEOUT | 125000, 0x02000000 | 38000]
+        data = io.BytesIO(struct.pack('{}I'.format(len(values)), *values))
+        self.assertEqual([(True, 3440), (False, 1720), (True, 430),
+                          (False, 125000)],
+                         list(read_lirc_device(data, chunk_size=2)))
@@ -0,0 +1,108 @@
+import io
+import json
+import os
+import shutil
+import struct
+import tempfile
+from contextlib import redirect_stdout
+from unittest import TestCase, skipIf
+from mock import MagicMock
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from daikin import frame_table
+from daikin.daikin import (AC_MODE, TIMER_MODE, DaikinController,
+                           DaikinLIRC, DaikinMessage, DaikinState)
+from daikin.frame_table import (FORMAT_VERSION, HEADER, MAGIC,
+                                TABLE_STATE_COUNT, FrameTable, build,
+                                encode_packed, encode_record,
+                                load_frame_table)
+
+
+@skipIf(np is None, 'numpy is not installed')
+class TestFrameTable(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'frames.bin')
+
+    def open(self):
+        table = FrameTable(build(self.path))
+        self.addCleanup(table.close)
+        return table
+
+    def test_encode_packed_matches_the_scalar_encoder(self):
+        # every state without a timer is checked by test_verify
+        packed = np.arange(0, DaikinState.STATE_COUNT, 7919)
+        for value, record in zip(packed, encode_packed(packed)):
+            state = DaikinState.unpack(int(value))
+            self.assertEqual(encode_record(state), bytes(record),
+                             state.key())
+
+    def test_verify(self):
+        table = self.open()
+        self.assertEqual(TABLE_STATE_COUNT, len(table))
+        self.assertEqual([], table.verify())
+
+    def test_message(self):
+        table = self.open()
+        state = DaikinState(power=True, temperature=22, ac_mode=AC_MODE.HEAT,
+                            comfort=True)
+        message = table.message(state)
+        self.assertIsInstance(message.buffer, memoryview)
+        expected = DaikinMessage(state)
+        for name in ('frame_one', 'frame_two', 'frame_three'):
+            self.assertEqual(bytes(getattr(expected, name)),
+                             getattr(message, name).tobytes())
+        lirc = DaikinLIRC()
+        self.assertEqual(lirc.get_config(expected), lirc.get_config(message))
+
+        timer = state.replace(timer=TIMER_MODE.OFF, timer_duration=60)
+        self.assertNotIn(timer, table)
+        self.assertIsInstance(table.message(timer).buffer, bytes)
+
+    def test_rejects_other_files(self):
+        build(self.path, count=4)
+        with open(self.path, 'r+b') as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION + 1, 35, 4))
+        with self.assertRaises(ValueError):
+            FrameTable(self.path)
+        self.assertIsNone(load_frame_table(self.path))
+
+        with open(self.path, 'r+b') as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, 35, 5))
+        with self.assertRaises(ValueError):
+            FrameTable(self.path)
+
+        with open(self.path, 'wb') as f:
+            f.write(struct.pack('<4sHHI', b'DKS1', 1, 35, 0))
+        with self.assertRaises(ValueError):
+            FrameTable(self.path)
+
+    def test_load_frame_table(self):
+        self.assertIsNone(load_frame_table(self.path))
+        build(self.path, count=16)
+        table = load_frame_table(self.path)
+        self.assertEqual(16, len(table))
+        self.assertIs(table, load_frame_table(self.path))
+
+    def test_controller_sends_table_messages(self):
+        storage_file = os.path.join(self.dir, 'config.json')
+        with open(storage_file, 'w') as f:
+            json.dump({}, f)
+        lirc = MagicMock(spec=DaikinLIRC)
+        controller = DaikinController(storage_file=storage_file, lirc=lirc,
+                                      frame_table=self.open())
+        controller.update(power=True, temperature=24)
+        message = lirc.send.call_args[0][0]
+        self.assertIsInstance(message.buffer, memoryview)
+        self.assertEqual(24, message.state.temperature)
+
+    def test_main(self):
+        out = io.StringIO()
+        with redirect_stdout(out):
+            self.assertEqual(0, frame_table.main(['build', self.path]))
+        self.assertIn('29120 states, 0 mismatched', out.getvalue())
@@ -0,0 +1,223 @@
+import json
+import socket
+import shutil
+import tempfile
+import os
+from unittest import TestCase, skipUnless
+from mock import patch, MagicMock
+import paho.mqtt.client as mqtt
+
+from daikin import mqtt_service
+from daikin.daikin import (AC_MODE, FAN_MODE, DaikinController, DaikinLIRC,
+                           DaikinState)
+from daikin.home_assistant import StatePublisher, state_payloads
+from daikin.units import Unit, UnitRegistry
+from daikin.worker import LatestWinsWorker
+
+COMMAND_TOPICS = {
+    'power': 'power/set',
+    'mode': 'mode/set',
+    'temperature': 'temperature/set',
+    'fan': 'fan/set',
+    'swing': 'swing/set',
+}
+
+
+def published(client):
+    return [(c[0][0], c[0][1]) for c in client.publish.call_args_list]
+
+
+class TestStatePayloads(TestCase):
+    def test_payloads(self):
+        state = DaikinState(power=True,
+                            temperature=22,
+                            ac_mode=AC_MODE.FAN,
+                            fan_mode=FAN_MODE.THREE,
+                            swing_vertical=True)
+        self.assertEqual({
+            'power/state': 'ON',
+            'mode/state': 'fan_only',
+            'temperature/state': '22',
+            'fan/state': 'medium',
+            'swing/state': 'vertical',
+        }, state_payloads(state))
+
+    def test_off_is_a_mode(self):
+        state = DaikinState(power=False, ac_mode=AC_MODE.HEAT)
+        self.assertEqual('off', state_payloads(state)['mode/state'])
+
+
+class TestStatePublisher(TestCase):
+    def setUp(self):
+        self.client = MagicMock(spec=mqtt.Client)
+        self.client.socket.return_value = None
+        self.client.publish.return_value = mqtt.MQTTMessageInfo(1)
+        self.publisher = StatePublisher(self.client, 'bedroom',
+                                        'bedroom/ac/', COMMAND_TOPICS)
+
+    def test_first_publish_sends_everything(self):
+        self.assertEqual(5, self.publisher.publish(DaikinState()))
+        self.client.publish.assert_any_call('bedroom/ac/temperature/state',
+                                            '19',
+                                            retain=True)
+        for args in self.client.publish.call_args_list:
+            self.assertTrue(args[1]['retain'])
+
+    def test_only_changes_are_sent(self):
+        state = DaikinState(power=True, ac_mode=AC_MODE.HEAT)
+        self.publisher.publish(state)
+        self.client.publish.reset_mock()
+
+        self.assertEqual(
+            1, self.publisher.publish(state.replace(temperature=23)))
+        self.assertEqual([('bedroom/ac/temperature/state', '23')],
+                         published(self.client))
+
+        self.client.publish.reset_mock()
+        self.assertEqual(0, self.publisher.publish(
+            state.replace(temperature=23)))
+        self.client.publish.assert_not_called()
+
+    def test_full_publish(self):
+        self.publisher.publish(DaikinState())
+        self.client.publish.reset_mock()
+        self.assertEqual(5, self.publisher.publish(DaikinState(), full=True))
+
+    def test_failed_publishes_are_sent_again(self):
+        failed = mqtt.MQTTMessageInfo(1)
+        failed.rc = mqtt.MQTT_ERR_NO_CONN
+        self.client.publish.side_effect = lambda topic, *args, **kwargs: (
+            failed if topic == 'bedroom/ac/fan/state'
+            else mqtt.MQTTMessageInfo(1))
+        self.assertEqual(4, self.publisher.publish(DaikinState()))
+
+        self.client.publish.side_effect = None
+        self.client.publish.reset_mock()
+        self.assertEqual(1, self.publisher.publish(DaikinState()))
+        self.assertEqual([('bedroom/ac/fan/state', 'auto')],
+                         published(self.client))
+
+    def test_topics(self):
+        self.assertIn('bedroom/ac/mode/state', self.publisher.topics)
+        self.assertNotIn('bedroom/ac/mode/set', self.publisher.topics)
+
+    def test_discovery(self):
+        self.publisher.publish_discovery()
+        topic, payload = published(self.client)[0]
+        self.assertEqual('homeassistant/climate/daikin-pi-bedroom/config',
+                         topic)
+        config = json.loads(payload)
+        self.assertEqual('bedroom/ac/mode/set', config['mode_command_topic'])
+        self.assertEqual('bedroom/ac/mode/state', config['mode_state_topic'])
+        self.assertIn('off', config['modes'])
+
+    @skipUnless(hasattr(socket, 'TCP_CORK'), 'TCP_CORK is linux only')
+    def test_batch_is_corked(self):
+        sock = MagicMock()
+        self.client.socket.return_value = sock
+        events = []
+        sock.setsockopt.side_effect = lambda *args: events.append(args[2])
+
+        def publish(*args, **kwargs):
+            events.append('publish')
+            return mqtt.MQTTMessageInfo(1)
+
+        self.client.publish.side_effect = publish
+        self.publisher.cork = True
+        self.publisher.publish(DaikinState())
+
+        self.assertEqual([1] + ['publish'] * 5 + [0], events)
+        sock.setsockopt.assert_called_with(socket.IPPROTO_TCP,
+                                           socket.TCP_CORK, 0)
+
+    def test_not_corked_from_other_threads(self):
+        # paho's network thread may be writing to the socket meanwhile
+        sock = MagicMock()
+        self.client.socket.return_value = sock
+        self.publisher.publish(DaikinState())
+        sock.setsockopt.assert_not_called()
+        self.client.loop_write.assert_not_called()
+
+
+class TestControllerPublishes(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.storage_file = os.path.join(self.dir, 'config.json')
+        with open(self.storage_file, 'w') as f:
+            json.dump(DaikinState().serialize(), f)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_publishes_once_per_transmission(self):
+        controller = DaikinController(storage_file=self.storage_file,
+                                      lirc=MagicMock(spec=DaikinLIRC))
+        on_transmit = MagicMock()
+        controller.on_transmit = on_transmit
+
+        state = controller.update(power=True)
+        controller.update(power=True)
+
+        on_transmit.assert_called_once_with(state)
+
+
+class TestOwnMessages(TestCase):
+    def setUp(self):
+        self.client = MagicMock(spec=mqtt.Client)
+        self.client.socket.return_value = None
+        controller = MagicMock(spec=DaikinController)
+        self.unit = Unit('livingroom', 'livingroom/ac/', controller)
+        patcher = patch('daikin.mqtt_service.registry',
+                        UnitRegistry([self.unit]))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        mqtt_service.attach_publishers(self.client)
+
+    def message(self, topic, payload):
+        msg = MagicMock()
+        msg.topic = topic
+        msg.payload = payload.encode('utf-8')
+        topics = []
+        with patch('daikin.mqtt_service.MQTT_TOPICS', topics, create=True), \
+                patch('daikin.mqtt_service.write_topics'), \
+                patch('daikin.mqtt_service.logger') as logger:
+            mqtt_service.on_message(self.client, None, msg)
+        return topics, logger
+
+    def test_own_state_is_ignored(self):
+        topics, logger = self.message('livingroom/ac/mode/state', 'heat')
+        self.assertEqual([], topics)
+        logger.warning.assert_not_called()
+        self.unit.controller.update.assert_not_called()
+
+    def test_commands_still_handled(self):
+        self.message('livingroom/ac/mode/set', 'off')
+        self.unit.controller.update.assert_called_once_with(power=False)
+
+    def test_on_connect_publishes_state(self):
+        self.unit.controller.current_state.return_value = DaikinState()
+        self.unit.controller.sent_count = 0
+        self.unit.controller.skipped_count = 0
+        mqtt_service.on_connect(self.client, None, {}, 0)
+
+        topics = [topic for topic, _ in published(self.client)]
+        self.assertIn('homeassistant/climate/daikin-pi-livingroom/config',
+                      topics)
+        self.assertIn('livingroom/ac/power/state', topics)
+        self.assertEqual(self.unit.publisher.publish,
+                         self.unit.controller.on_transmit)
+
+    def test_on_connect_hands_republishing_to_a_worker(self):
+        self.unit.controller.current_state.return_value = DaikinState()
+        self.unit.controller.sent_count = 0
+        self.unit.controller.skipped_count = 0
+        republisher = LatestWinsWorker(mqtt_service.republish)
+        with patch('daikin.mqtt_service.republisher', republisher):
+            mqtt_service.on_connect(self.client, None, {}, 0)
+            # paho's thread only subscribed
+            self.client.publish.assert_not_called()
+            self.client.subscribe.assert_called_once_with('livingroom/ac/#')
+            republisher.start()
+            republisher.stop(5)
+        self.assertIn('livingroom/ac/power/state',
+                      [topic for topic, _ in published(self.client)])
@@ -0,0 +1,60 @@
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from unittest import TestCase
+
+from daikin.daikin import AC_MODE, DaikinLIRC, DaikinMessage, DaikinState
+from daikin.lirc_device import DaikinLIRCDevice
+
+
+def config_durations(config):
+    # every number in the raw code, in order
+    lines = config.split('name dynamic-signal')[1].split('end raw_codes')[0]
+    return [int(value) for value in lines.split()]
+
+
+class TestDaikinLIRCDevice(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'lirc0')
+        self.lirc = DaikinLIRCDevice(device=self.path)
+        self.message = DaikinMessage(
+            DaikinState(power=True, temperature=22, ac_mode=AC_MODE.HEAT))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_durations_match_config(self):
+        config = DaikinLIRC().get_config(self.message)
+        durations = self.lirc.get_durations(self.message)
+        self.assertEqual(config_durations(config), durations)
+        # pulse/space pairs ending on a pulse
+        self.assertEqual(1, len(durations) % 2)
+
+    def test_write_to_file(self):
+        open(self.path, 'w').close()
+        self.lirc.send(self.message)
+
+        with open(self.path, 'rb') as f:
+            written = f.read()
+
+        durations = self.lirc.get_durations(self.message)
+        self.assertEqual(
+            struct.pack('{}I'.format(len(durations)), *durations), written)
+
+    def test_write_to_fifo(self):
+        os.mkfifo(self.path)
+        received = []
+
+        def read():
+            with open(self.path, 'rb') as fifo:
+                received.append(fifo.read())
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        self.lirc.send(self.message)
+        reader.join(5)
+
+        self.assertEqual([self.lirc.get_buffer(self.message)], received)
@@ -0,0 +1,144 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from unittest import TestCase
+
+from daikin.daikin import DaikinLIRC
+from daikin.lircd_client import LircdClient, LircdError
+
+
+class FakeLircd:
+    """
+        A minimal lircd that records the commands it receives
+    """
+
+    def __init__(self, path, codes=('dynamic-signal', )):
+        self.path = path
+        self.codes = codes
+        self.commands = []
+        self.connections = 0
+        # replies to send before answering the next command
+        self.broadcasts = []
+        # close the connection after this many commands
+        self.hang_up_after = None
+        self.hung_up = threading.Event()
+        # leave this many commands unanswered
+        self.unanswered = 0
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(5)
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown(socket.SHUT_RDWR)
+        self.server.close()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            self.handle(conn)
+
+    def handle(self, conn):
+        handled = 0
+        with conn, conn.makefile('rb') as lines:
+            for line in lines:
+                command = line.decode('ascii').strip()
+                self.commands.append(command)
+                if self.unanswered:
+                    self.unanswered -= 1
+                    continue
+                conn.sendall(''.join(self.broadcasts).encode('ascii'))
+                self.broadcasts = []
+                conn.sendall(self.reply(command).encode('ascii'))
+                handled += 1
+                if handled == self.hang_up_after:
+                    break
+        if handled == self.hang_up_after:
+            self.hung_up.set()
+
+    def reply(self, command):
+        words = command.split()
+        if words[0] == 'VERSION':
+            return 'BEGIN\n{}\nSUCCESS\nDATA\n1\n0.9.4\nEND\n'.format(command)
+        if words[0] == 'SEND_ONCE' and words[2] in self.codes:
+            return 'BEGIN\n{}\nSUCCESS\nEND\n'.format(command)
+        return ('BEGIN\n{}\nERROR\nDATA\n1\n'
+                'unknown command: "{}"\nEND\n').format(command, words[2])
+
+
+class TestLircdClient(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'lircd')
+        self.lircd = FakeLircd(self.path)
+        self.client = LircdClient(path=self.path, timeout=2)
+
+    def tearDown(self):
+        self.client.close()
+        self.lircd.close()
+        shutil.rmtree(self.dir)
+
+    def test_send_once(self):
+        self.client.send_once('daikin-pi', 'dynamic-signal')
+        self.assertEqual(['SEND_ONCE daikin-pi dynamic-signal'],
+                         self.lircd.commands)
+
+    def test_reply_data(self):
+        self.assertEqual('0.9.4', self.client.version())
+
+    def test_error_reply(self):
+        with self.assertRaises(LircdError) as error:
+            self.client.send_once('daikin-pi', 'missing')
+        self.assertIn('unknown command', str(error.exception))
+
+    def test_connection_is_kept_open(self):
+        for _ in range(3):
+            self.client.send_once('daikin-pi', 'dynamic-signal')
+        self.assertEqual(3, len(self.lircd.commands))
+        self.assertEqual(1, self.lircd.connections)
+
+    def test_skips_broadcasts(self):
+        self.lircd.broadcasts = [
+            'BEGIN\nSIGHUP\nEND\n',
+            '0000000000f40bf0 00 KEY_UP livingroom\n',
+        ]
+        self.client.send_once('daikin-pi', 'dynamic-signal')
+        self.assertEqual(['SEND_ONCE daikin-pi dynamic-signal'],
+                         self.lircd.commands)
+
+    def test_reconnects_when_lircd_goes_away(self):
+        self.lircd.hang_up_after = 1
+        self.client.send_once('daikin-pi', 'dynamic-signal')
+        self.assertTrue(self.lircd.hung_up.wait(2))
+        self.client.send_once('daikin-pi', 'dynamic-signal')
+        self.assertEqual(2, self.lircd.connections)
+        self.assertEqual(['SEND_ONCE daikin-pi dynamic-signal'] * 2,
+                         self.lircd.commands)
+
+    def test_written_command_is_not_sent_again(self):
+        self.client.timeout = 0.2
+        self.lircd.unanswered = 1
+        with self.assertRaises(socket.timeout):
+            self.client.send_once('daikin-pi', 'dynamic-signal')
+        self.assertEqual(['SEND_ONCE daikin-pi dynamic-signal'],
+                         self.lircd.commands)
+
+        # the next command starts on a fresh connection
+        self.client.send_once('daikin-pi', 'dynamic-signal')
+        self.assertEqual(2, len(self.lircd.commands))
+        self.assertEqual(2, self.lircd.connections)
+
+    def test_lirc_sends_through_client(self):
+        lirc = DaikinLIRC(client=self.client)
+        lirc.send_once('dynamic-signal')
+        self.assertEqual(['SEND_ONCE daikin-pi dynamic-signal'],
+                         self.lircd.commands)
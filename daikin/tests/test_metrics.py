@@ -0,0 +1,118 @@
+import json
+import os
+import shutil
+import tempfile
+from urllib.request import urlopen
+from urllib.error import HTTPError
+from unittest import TestCase
+from mock import MagicMock
+
+from daikin.daikin import AC_MODE, DaikinController, DaikinState
+from daikin.metrics import (CONTENT_TYPE, STAGE_SECONDS, TRANSMISSIONS,
+                            Counter, Gauge, Histogram, Registry,
+                            start_exporter)
+from daikin.worker import CoalescingWorker
+
+
+class TestMetrics(TestCase):
+    def test_counter(self):
+        counter = Counter('sent_total', 'Sent', ['result'])
+        counter.inc('ok')
+        counter.inc('ok', amount=2)
+        counter.inc('failed')
+        self.assertEqual(3, counter.value('ok'))
+        self.assertEqual([
+            '# HELP sent_total Sent',
+            '# TYPE sent_total counter',
+            'sent_total{result="failed"} 1',
+            'sent_total{result="ok"} 3',
+        ], counter.render())
+        with self.assertRaises(ValueError):
+            counter.inc()
+
+    def test_gauge_function(self):
+        gauge = Gauge('depth', 'Depth', ['queue'])
+        gauge.set(2, 'a')
+        items = [1, 2, 3]
+        gauge.set_function(lambda: len(items), 'b')
+        items.append(4)
+        self.assertEqual(['depth{queue="a"} 2', 'depth{queue="b"} 4'],
+                         gauge.render()[2:])
+
+    def test_histogram(self):
+        histogram = Histogram('seconds', 'Seconds', buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value)
+        self.assertEqual([
+            'seconds_bucket{le="0.1"} 2',
+            'seconds_bucket{le="1.0"} 3',
+            'seconds_bucket{le="+Inf"} 4',
+            'seconds_sum 3.65',
+            'seconds_count 4',
+        ], histogram.render()[2:])
+        with histogram.time():
+            pass
+        self.assertEqual(5, histogram.count())
+
+    def test_escapes_label_values(self):
+        counter = Counter('messages_total', 'Messages', ['topic'])
+        counter.inc('a"b\\c')
+        self.assertEqual('messages_total{topic="a\\"b\\\\c"} 1',
+                         counter.render()[-1])
+
+    def test_worker_depth(self):
+        worker = CoalescingWorker(MagicMock())
+        worker.submit(power=True, temperature=22)
+        self.assertEqual(2, worker.depth())
+
+
+class TestInstrumentation(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        storage_file = os.path.join(self.dir, 'config.json')
+        with open(storage_file, 'w') as f:
+            json.dump({}, f)
+        self.lirc = MagicMock()
+        self.controller = DaikinController(storage_file=storage_file,
+                                           lirc=self.lirc)
+
+    def test_set_state(self):
+        stages = ('set_state', 'save', 'transmit')
+        before = [STAGE_SECONDS.count(stage) for stage in stages]
+        sent = TRANSMISSIONS.value('sent')
+        skipped = TRANSMISSIONS.value('skipped')
+        state = DaikinState(power=True, temperature=22, ac_mode=AC_MODE.HEAT)
+
+        self.controller.set_state(state)
+        self.controller.set_state(state)
+
+        # the repeat is neither saved nor sent
+        self.assertEqual([before[0] + 2, before[1] + 1, before[2] + 1],
+                         [STAGE_SECONDS.count(stage) for stage in stages])
+        self.assertEqual(sent + 1, TRANSMISSIONS.value('sent'))
+        self.assertEqual(skipped + 1, TRANSMISSIONS.value('skipped'))
+
+    def test_failed(self):
+        failed = TRANSMISSIONS.value('failed')
+        self.lirc.send.side_effect = OSError('lircd')
+        with self.assertRaises(OSError):
+            self.controller.transmit(DaikinState(power=True))
+        self.assertEqual(failed + 1, TRANSMISSIONS.value('failed'))
+
+
+class TestExporter(TestCase):
+    def test_serves_metrics(self):
+        registry = Registry()
+        registry.register(Counter('up_total', 'Up')).inc()
+        server = start_exporter(0, host='127.0.0.1', registry=registry)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+        with urlopen(url + '/metrics') as response:
+            self.assertEqual(CONTENT_TYPE, response.headers['Content-Type'])
+            self.assertEqual(registry.render(),
+                             response.read().decode('utf-8'))
+        with self.assertRaises(HTTPError):
+            urlopen(url + '/other')
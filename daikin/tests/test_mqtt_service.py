@@ -1,77 +1,165 @@
+import os
+import shutil
+import tempfile
 from unittest import TestCase
 from mock import patch, MagicMock
 
+from daikin import mqtt_service
 from daikin.mqtt_service import (
     set_mode,
     set_fan,
     set_temperature,
     set_swing,
+    set_power,
+    set_state,
+    set_timer,
+    resend,
 )
 
-from daikin.daikin import AC_MODE, FAN_MODE, DaikinController
+from daikin.daikin import AC_MODE, FAN_MODE, TIMER_MODE, DaikinController
+from daikin.units import Unit, UnitRegistry
 
 
-@patch('daikin.mqtt_service.DaikinController')
-class TestMQTTDaikinSetters(TestCase):
-    def test_set_temperature(self, daikin):
-        dmock = MagicMock(spec=DaikinController)
-        daikin.return_value = dmock
+class UnitTestCase(TestCase):
+    """
+        Runs with a single unit, as the service does without a units file
+    """
+
+    def setUp(self):
+        self.controller = MagicMock(spec=DaikinController)
+        self.unit = Unit('livingroom', 'livingroom/ac/', self.controller)
+        patcher = patch('daikin.mqtt_service.registry',
+                        UnitRegistry([self.unit]))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestMQTTDaikinSetters(UnitTestCase):
+    def test_set_temperature(self):
         set_temperature(20)
-        dmock.update.assert_called_with(temperature=20)
+        self.controller.update.assert_called_with(temperature=20)
         set_temperature(18)
-        dmock.update.assert_called_with(temperature=18)
+        self.controller.update.assert_called_with(temperature=18)
         set_temperature(30)
-        dmock.update.assert_called_with(temperature=30)
-
-    def test_set_power(self, daikin):
-        dmock = MagicMock(spec=DaikinController)
-        daikin.return_value = dmock
+        self.controller.update.assert_called_with(temperature=30)
 
+    def test_set_power(self):
         set_power('on')
-        dmock.update.assert_called_with(power=True)
+        self.controller.update.assert_called_with(power=True)
         set_power('off')
-        dmock.update.assert_called_with(power=False)
-
-    def test_set_mode(self, daikin):
-        dmock = MagicMock(spec=DaikinController)
-        daikin.return_value = dmock
+        self.controller.update.assert_called_with(power=False)
 
+    def test_set_mode(self):
         set_mode('auto')
-        dmock.update.assert_called_with(ac_mode=AC_MODE.AUTO)
+        self.controller.update.assert_called_with(ac_mode=AC_MODE.AUTO)
         set_mode('cool')
-        dmock.update.assert_called_with(ac_mode=AC_MODE.COOL)
+        self.controller.update.assert_called_with(ac_mode=AC_MODE.COOL)
         set_mode('heat')
-        dmock.update.assert_called_with(ac_mode=AC_MODE.HEAT)
+        self.controller.update.assert_called_with(ac_mode=AC_MODE.HEAT)
         set_mode('fan_only')
-        dmock.update.assert_called_with(ac_mode=AC_MODE.FAN)
+        self.controller.update.assert_called_with(ac_mode=AC_MODE.FAN)
         set_mode('dry')
-        dmock.update.assert_called_with(ac_mode=AC_MODE.DRY)
+        self.controller.update.assert_called_with(ac_mode=AC_MODE.DRY)
 
-    def test_set_fan(self, daikin):
-        dmock = MagicMock(spec=DaikinController)
-        daikin.return_value = dmock
+    def test_set_fan(self):
         set_fan('auto')
-        dmock.update.assert_called_with(fan_mode=FAN_MODE.AUTO)
+        self.controller.update.assert_called_with(fan_mode=FAN_MODE.AUTO)
         set_fan('low')
-        dmock.update.assert_called_with(fan_mode=FAN_MODE.ONE)
+        self.controller.update.assert_called_with(fan_mode=FAN_MODE.ONE)
         set_fan('medium')
-        dmock.update.assert_called_with(fan_mode=FAN_MODE.THREE)
+        self.controller.update.assert_called_with(fan_mode=FAN_MODE.THREE)
         set_fan('high')
-        dmock.update.assert_called_with(fan_mode=FAN_MODE.FIVE)
-
-    def test_set_swing(self, daikin):
-        dmock = MagicMock(spec=DaikinController)
-        daikin.return_value = dmock
+        self.controller.update.assert_called_with(fan_mode=FAN_MODE.FIVE)
 
+    def test_set_swing(self):
         set_swing('both')
-        dmock.update.assert_called_with(swing_vertical=True,
-                                        swing_horizontal=True)
+        self.controller.update.assert_called_with(swing_vertical=True,
+                                                   swing_horizontal=True)
         set_swing('vertical'),
-        dmock.update.assert_called_with(swing_vertical=True,
-                                        swing_horizontal=False)
+        self.controller.update.assert_called_with(swing_vertical=True,
+                                                   swing_horizontal=False)
         set_swing('horizontal'),
-        dmock.update.assert_called_with(swing_vertical=False,
-                                        swing_horizontal=True)
+        self.controller.update.assert_called_with(swing_vertical=False,
+                                                   swing_horizontal=True)
         set_swing('off'),
-        dmock.update.assert_called_with(swing_vertical=False,
-                                        swing_horizontal=False)
+        self.controller.update.assert_called_with(swing_vertical=False,
+                                                   swing_horizontal=False)
+
+    def test_set_state(self):
+        set_state('{"ac_mode": "cool", "temperature": 24, "fan_mode": "five",'
+                  ' "swing_vertical": true}')
+        self.controller.update.assert_called_once_with(ac_mode=AC_MODE.COOL,
+                                                        temperature=24,
+                                                        fan_mode=FAN_MODE.FIVE,
+                                                        swing_vertical=True)
+
+    def test_set_state_invalid(self):
+        set_state('not json')
+        set_state('{"temperature": 50}')
+        self.controller.update.assert_not_called()
+
+    def test_set_timer(self):
+        set_timer('off 90')
+        self.controller.update.assert_called_with(timer=TIMER_MODE.OFF,
+                                                   timer_duration=90)
+        set_timer('cancel')
+        self.controller.update.assert_called_with(timer=TIMER_MODE.NONE)
+
+    def test_set_timer_invalid(self):
+        for value in ['soon', 'off', 'on 0', 'on 721', 'later 30', 'on x']:
+            set_timer(value)
+        self.controller.update.assert_not_called()
+
+    def test_resend(self):
+        resend()
+        self.controller.update.assert_called_with(force=True)
+
+
+class TestMQTTCoalescing(UnitTestCase):
+    def test_burst_is_sent_once(self):
+        self.unit.start_coalescing(window=0.05, max_delay=1.0)
+        set_mode('heat')
+        set_temperature('22.0')
+        set_fan('auto')
+        self.controller.update.assert_not_called()
+        self.unit.coalescer.stop(5)
+
+        self.controller.update.assert_called_once_with(ac_mode=AC_MODE.HEAT,
+                                                        temperature=22,
+                                                        fan_mode=FAN_MODE.AUTO)
+
+
+class TestDefaultRegistry(TestCase):
+    def test_single_unit_is_created_once(self):
+        unit = Unit('default', 'livingroom/ac/',
+                    MagicMock(spec=DaikinController))
+        with patch('daikin.mqtt_service.registry', None), \
+                patch('daikin.mqtt_service.create_unit',
+                      return_value=unit) as create_unit:
+            set_power('on')
+            set_mode('heat')
+            self.assertEqual(['livingroom/ac/#'],
+                             mqtt_service.get_registry().subscriptions())
+        create_unit.assert_called_once()
+        self.assertEqual(2, unit.controller.update.call_count)
+
+
+class TestTopicsList(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.topics_file = os.path.join(self.dir, 'data', 'topics')
+        patcher = patch('daikin.mqtt_service.TOPICS_LIST_FILE',
+                        self.topics_file)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_starts_from_the_packaged_list(self):
+        self.assertIn('livingroom/ac/mode/set', mqtt_service.load_topics())
+
+    def test_written_to_the_data_dir(self):
+        mqtt_service.write_topics(['bedroom/ac/mode/set'])
+        self.assertTrue(os.path.exists(self.topics_file))
+        self.assertEqual(['bedroom/ac/mode/set'], mqtt_service.load_topics())
@@ -0,0 +1,59 @@
+from unittest import TestCase
+
+from daikin.daikin import AC_MODE, DaikinLIRC, DaikinMessage, DaikinState
+from daikin.pulses import PulseTrain, lsb_byte_table
+
+
+class TestByteTable(TestCase):
+    def test_every_byte_is_lsb_first(self):
+        table = lsb_byte_table(430, 430, 1320)
+        self.assertEqual(256, len(table))
+        for value, durations in enumerate(table):
+            bits = ''.join('1' if space == 1320 else '0'
+                           for space in durations[1::2])
+            self.assertEqual('{0:08b}'.format(value)[::-1], bits)
+            self.assertEqual([430] * 8, list(durations[::2]))
+
+    def test_tables_are_shared(self):
+        self.assertIs(lsb_byte_table(430, 430, 1320),
+                      lsb_byte_table(430, 430, 1320))
+
+
+class TestPulseTrain(TestCase):
+    def setUp(self):
+        self.lirc = DaikinLIRC()
+        self.message = DaikinMessage(
+            DaikinState(power=True, temperature=22, ac_mode=AC_MODE.HEAT))
+
+    def test_frame_codes_match_per_bit_strings(self):
+        lirc = self.lirc
+        for frame in [self.message.frame_one, self.message.frame_three,
+                      list(range(256))]:
+            binary = ''.join(['{0:08b}'.format(item)[::-1] for item in frame])
+            expected = '\n        '.join(
+                [lirc.ONE if digit == '1' else lirc.ZERO for digit in binary])
+            self.assertEqual(expected, lirc._get_frame_codes(frame))
+
+    def test_lircd_lines(self):
+        train = PulseTrain([430, 430, 430, 1320, 430])
+        self.assertEqual(['430 430', '430 1320', '430'], train.lircd_lines())
+
+    def test_memoryview_is_zero_copy(self):
+        train = PulseTrain([430, 1320, 430])
+        view = train.memoryview()
+        self.assertEqual(train.tobytes(), view.tobytes())
+        self.assertEqual(3 * train.durations.itemsize, len(view))
+        train.durations[0] = 3440
+        self.assertEqual(train.tobytes(), view.tobytes())
+        view.release()
+
+    def test_waveform(self):
+        train = PulseTrain([3440, 1720, 430])
+        self.assertEqual([(1, 3440), (0, 1720), (1, 430)], train.waveform())
+
+    def test_message_train(self):
+        train = self.lirc.get_pulse_train(self.message)
+        # preamble, three headers, two gaps, 35 bytes of bits, final mark
+        self.assertEqual(12 + 3 * 2 + 2 * 2 + 35 * 16 + 1, len(train))
+        self.assertEqual(train, PulseTrain(self.lirc.get_durations(
+            self.message)))
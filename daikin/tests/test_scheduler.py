@@ -0,0 +1,247 @@
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+from datetime import datetime
+from unittest import TestCase
+from mock import MagicMock, patch
+
+from daikin.daikin import AC_MODE
+from daikin.scheduler import (CronExpression, ScheduleEntry, Scheduler,
+                              parse_time)
+
+
+def timestamp(*args):
+    return datetime(*args).timestamp()
+
+
+class TestCronExpression(TestCase):
+    def next_after(self, text, *args):
+        after = CronExpression(text).next_after(timestamp(*args))
+        return datetime.fromtimestamp(after)
+
+    def test_every_minute(self):
+        self.assertEqual(datetime(2026, 10, 18, 12, 1),
+                         self.next_after('* * * * *', 2026, 10, 18, 12, 0, 30))
+
+    def test_daily(self):
+        self.assertEqual(datetime(2026, 10, 19, 6, 30),
+                         self.next_after('30 6 * * *', 2026, 10, 18, 6, 30))
+        self.assertEqual(datetime(2026, 10, 18, 6, 30),
+                         self.next_after('30 6 * * *', 2026, 10, 18, 6, 29))
+
+    def test_weekdays(self):
+        # 2026-10-17 is a Saturday
+        self.assertEqual(datetime(2026, 10, 19, 6, 30),
+                         self.next_after('30 6 * * 1-5', 2026, 10, 17, 7, 0))
+        self.assertEqual(datetime(2026, 10, 18, 9, 0),
+                         self.next_after('0 9 * * 0', 2026, 10, 17, 9, 0))
+        self.assertEqual(datetime(2026, 10, 18, 9, 0),
+                         self.next_after('0 9 * * 7', 2026, 10, 17, 9, 0))
+
+    def test_steps_lists_and_ranges(self):
+        self.assertEqual(datetime(2026, 10, 18, 12, 45),
+                         self.next_after('*/15 * * * *', 2026, 10, 18, 12, 31))
+        self.assertEqual(datetime(2026, 10, 18, 14, 5),
+                         self.next_after('5 8-18/2 * * *', 2026, 10, 18, 12,
+                                         5))
+        self.assertEqual(datetime(2026, 10, 18, 22, 0),
+                         self.next_after('0 7,22 * * *', 2026, 10, 18, 7, 0))
+
+    def test_months(self):
+        self.assertEqual(datetime(2027, 1, 1, 0, 0),
+                         self.next_after('0 0 1 1 *', 2026, 10, 18, 12, 0))
+
+    def test_day_or_weekday(self):
+        # the 1st, or any Monday, like cron
+        self.assertEqual(datetime(2026, 10, 19, 8, 0),
+                         self.next_after('0 8 1 * 1', 2026, 10, 18, 12, 0))
+        self.assertEqual(datetime(2026, 11, 1, 8, 0),
+                         self.next_after('0 8 1 * 1', 2026, 10, 26, 12, 0))
+
+    def test_invalid(self):
+        for text in ['* * * *', '60 * * * *', '* 24 * * *', '*/0 * * * *',
+                     '5-1 * * * *', 'a * * * *', '* * 0 * *']:
+            with self.assertRaises(ValueError):
+                CronExpression(text)
+        with self.assertRaises(ValueError):
+            CronExpression('0 0 31 2 *').next_after(0)
+
+
+class TestScheduleEntry(TestCase):
+    def test_round_trip(self):
+        entry = ScheduleEntry('morning', {
+            'power': True,
+            'ac_mode': 'heat'
+        },
+                              unit='livingroom',
+                              cron='30 6 * * 1-5',
+                              last_run=100.0)
+        restored = ScheduleEntry.deserialize(entry.serialize())
+        self.assertEqual(entry.serialize(), restored.serialize())
+        self.assertEqual({'power': True, 'ac_mode': AC_MODE.HEAT},
+                         restored.values)
+
+    def test_at(self):
+        entry = ScheduleEntry('once', {'power': False},
+                              at='2026-10-18T23:30')
+        self.assertEqual(timestamp(2026, 10, 18, 23, 30), entry.at)
+        self.assertEqual(entry.at, entry.next_due(0))
+        self.assertEqual(1000.0, parse_time(1000))
+
+    def test_invalid(self):
+        for data in [
+            {'id': 'a', 'changes': {'power': True}},
+            {'id': 'a', 'changes': {'power': True}, 'cron': '* * * * *',
+             'at': 1},
+            {'id': 'a', 'changes': {'power': 'on'}, 'at': 1},
+            {'id': 'a', 'changes': {'power': True}, 'at': 'tomorrow'},
+            {'id': 'a', 'changes': {'power': True}, 'cron': 5},
+            {'changes': {'power': True}, 'at': 1},
+        ]:
+            with self.assertRaises(ValueError):
+                ScheduleEntry.deserialize(data)
+
+
+class TestScheduler(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'schedule.json')
+        self.now = timestamp(2026, 10, 18, 12, 0)
+        self.dispatch = MagicMock()
+
+    def write(self, entries):
+        with open(self.path, 'w') as f:
+            json.dump({'entries': entries}, f)
+
+    def stored(self, scheduler):
+        scheduler.flush()
+        with open(self.path) as f:
+            return {entry['id']: entry for entry in json.load(f)['entries']}
+
+    def load(self, **kwargs):
+        scheduler = Scheduler.load(self.dispatch,
+                                   self.path,
+                                   clock=lambda: self.now,
+                                   flush_interval=0,
+                                   **kwargs)
+        self.addCleanup(scheduler.stop)
+        return scheduler
+
+    def test_catches_up_on_the_latest_missed_run(self):
+        self.write([{
+            'id': 'hourly',
+            'cron': '0 * * * *',
+            'changes': {'temperature': 22},
+            'last_run': self.now - 2 * 86400,
+        }])
+        scheduler = self.load(catch_up=6 * 3600)
+        scheduler.catch_up_missed()
+
+        self.dispatch.assert_called_once_with(None, {'temperature': 22})
+        self.assertEqual(self.now,
+                         self.stored(scheduler)['hourly']['last_run'])
+        self.assertEqual(timestamp(2026, 10, 18, 13, 0),
+                         scheduler.next_due()[0])
+
+    def test_catch_up_runs_in_order(self):
+        self.write([
+            {'id': 'off', 'at': self.now - 60, 'changes': {'power': False}},
+            {'id': 'on', 'at': self.now - 120, 'changes': {'power': True}},
+            {'id': 'stale', 'at': self.now - 86400,
+             'changes': {'power': True}},
+            {'id': 'later', 'at': self.now + 60, 'unit': 'bedroom',
+             'changes': {'power': True}},
+        ])
+        scheduler = self.load(catch_up=3600)
+        scheduler.catch_up_missed()
+
+        self.assertEqual([((None, {'power': True}), ),
+                          ((None, {'power': False}), )],
+                         [call[0:1] for call in self.dispatch.call_args_list])
+        # one-shots are gone once run, or when too old to catch up
+        self.assertEqual(['later'], list(self.stored(scheduler)))
+        self.assertEqual((self.now + 60, 'later'),
+                         (scheduler.next_due()[0], scheduler.next_due()[1].id))
+
+    def test_new_cron_entries_start_from_now(self):
+        self.write([{
+            'id': 'a',
+            'cron': '* * * * *',
+            'changes': {'power': True}
+        }])
+        scheduler = self.load()
+        scheduler.catch_up_missed()
+        self.dispatch.assert_not_called()
+        self.assertEqual(self.now + 60, scheduler.next_due()[0])
+
+    def test_add_and_remove_persist(self):
+        scheduler = self.load()
+        scheduler.add(
+            ScheduleEntry('a', {'power': True}, cron='0 7 * * *'))
+        self.assertEqual('0 7 * * *', self.stored(scheduler)['a']['cron'])
+        self.assertEqual(timestamp(2026, 10, 19, 7, 0),
+                         scheduler.next_due()[0])
+
+        scheduler.add(ScheduleEntry('a', {'power': False}, at=self.now + 5))
+        self.assertEqual(self.now + 5, scheduler.next_due()[0])
+        self.assertEqual(1, len(list(scheduler)))
+
+        scheduler.remove('a')
+        self.assertEqual({}, self.stored(scheduler))
+        self.assertIsNone(scheduler.next_due())
+        self.assertIsNone(scheduler.remove('a'))
+
+    def test_due_entries_come_out_in_order(self):
+        scheduler = self.load()
+        times = [self.now + random.randint(1, 86400) for _ in range(2000)]
+        for index, due in enumerate(times):
+            scheduler.add(
+                ScheduleEntry(index, {'power': index % 2 == 0}, at=due))
+
+        self.now += 86400
+        entries = scheduler._take()
+        self.assertEqual(sorted(times), [entry.due for entry in entries])
+
+    def test_runs_due_entries_on_its_thread(self):
+        ran = threading.Event()
+        scheduler = Scheduler(lambda unit, values: ran.set(),
+                              self.path,
+                              flush_interval=0)
+        scheduler.start()
+        self.addCleanup(scheduler.stop)
+        scheduler.add(
+            ScheduleEntry('soon', {'power': True},
+                          at=scheduler.clock() + 0.05))
+
+        self.assertTrue(ran.wait(5))
+        scheduler.stop()
+        self.assertEqual({}, self.stored(scheduler))
+
+    def test_sleeps_until_the_next_entry(self):
+        scheduler = self.load()
+        scheduler.add(ScheduleEntry('a', {'power': True}, at=self.now + 90))
+
+        def wait(timeout=None):
+            scheduler.stopping = True
+
+        with patch.object(scheduler.condition, 'wait',
+                          side_effect=wait) as condition_wait:
+            self.assertIsNone(scheduler._take())
+        condition_wait.assert_called_once_with(90)
+
+    def test_failed_dispatch_still_reschedules(self):
+        self.dispatch.side_effect = KeyError('bedroom')
+        scheduler = self.load()
+        scheduler.add(
+            ScheduleEntry('a', {'power': True}, unit='bedroom',
+                          cron='0 * * * *'))
+        self.now = timestamp(2026, 10, 18, 13, 0)
+        entries = scheduler._take()
+        scheduler._run(entries[0])
+        scheduler._finish(entries)
+        self.assertEqual(timestamp(2026, 10, 18, 14, 0),
+                         scheduler.next_due()[0])
@@ -0,0 +1,207 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+from mock import patch, MagicMock
+
+from daikin import server
+from daikin.scheduler import Scheduler
+from daikin.daikin import (AC_MODE, FAN_MODE, TIMER_MODE, DaikinController,
+                           DaikinLIRC, DaikinState)
+
+
+class TestPatchState(TestCase):
+    def setUp(self):
+        self.controller = MagicMock(spec=DaikinController)
+        patcher = patch('daikin.server.controller', self.controller)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = server.app.test_client()
+
+    def patch(self, data):
+        return self.client.patch('/state',
+                                 data=json.dumps(data),
+                                 content_type='application/json')
+
+    def test_patch(self):
+        state = DaikinState(power=True, temperature=22, ac_mode=AC_MODE.HEAT)
+        self.controller.update.return_value = state
+
+        response = self.patch({
+            'power': True,
+            'ac_mode': 'heat',
+            'temperature': 22,
+            'fan_mode': 'auto',
+            'swing_vertical': True,
+            'swing_horizontal': True,
+        })
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(state.serialize(), response.get_json())
+        self.controller.update.assert_called_once_with(
+            power=True,
+            ac_mode=AC_MODE.HEAT,
+            temperature=22,
+            fan_mode=FAN_MODE.AUTO,
+            swing_vertical=True,
+            swing_horizontal=True)
+
+    def test_invalid(self):
+        for data in [{'temperature': 40}, {'mode': 'heat'}, 'heat', {}]:
+            response = self.patch(data)
+            self.assertEqual(400, response.status_code)
+            self.assertIn('message', response.get_json())
+        response = self.client.patch('/state', data='{not json')
+        self.assertEqual(400, response.status_code)
+        self.controller.update.assert_not_called()
+
+    def test_get_state(self):
+        state = DaikinState(economy=True)
+        self.controller.current_state.return_value = state
+        self.assertEqual(state.serialize(),
+                         self.client.get('/state').get_json())
+
+
+class TestStateControls(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        storage_file = os.path.join(self.dir, 'config.json')
+        with open(storage_file, 'w') as f:
+            json.dump(DaikinState(temperature=18).serialize(), f)
+        self.controller = DaikinController(
+            storage_file=storage_file,
+            store_file=os.path.join(self.dir, 'state.bin'),
+            lirc=MagicMock(spec=DaikinLIRC))
+        patcher = patch('daikin.server.controller', self.controller)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = server.app.test_client()
+
+    def test_concurrent_increases_all_count(self):
+        barrier = threading.Barrier(8, timeout=5)
+        statuses = []
+
+        def increase():
+            client = server.app.test_client()
+            barrier.wait()
+            statuses.append(
+                client.post('/temperature/increase').status_code)
+
+        threads = [threading.Thread(target=increase) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual([200] * 8, statuses)
+        self.assertEqual(26, self.controller.current_state().temperature)
+
+    def test_controls(self):
+        self.assertEqual(200, self.client.post('/power/on').status_code)
+        self.assertEqual(200, self.client.post('/ac_mode/heat').status_code)
+        self.assertEqual(200,
+                         self.client.post('/temperature/22').status_code)
+        self.client.post('/temperature/decrease')
+        self.assertEqual(
+            DaikinState(power=True, temperature=21, ac_mode=AC_MODE.HEAT),
+            self.controller.current_state())
+        self.assertEqual(400, self.client.post('/ac_mode/warm').status_code)
+        self.assertEqual(400, self.client.post('/power/maybe').status_code)
+
+
+class TestTimer(TestCase):
+    def setUp(self):
+        self.controller = MagicMock(spec=DaikinController)
+        patcher = patch('daikin.server.controller', self.controller)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = server.app.test_client()
+
+    def test_arm(self):
+        state = DaikinState(timer=TIMER_MODE.ON, timer_duration=90)
+        self.controller.arm_timer.return_value = state
+        response = self.client.post('/timer/on/90')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(state.serialize(), response.get_json())
+        self.controller.arm_timer.assert_called_once_with(TIMER_MODE.ON, 90)
+
+    def test_cancel(self):
+        self.controller.cancel_timer.return_value = DaikinState()
+        self.assertEqual(200, self.client.delete('/timer').status_code)
+        self.controller.cancel_timer.assert_called_once_with()
+
+    def test_invalid(self):
+        for path in ['/timer/later/60', '/timer/off/0', '/timer/off/721']:
+            self.assertEqual(400, self.client.post(path).status_code)
+        self.controller.arm_timer.assert_not_called()
+
+
+class TestSchedule(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.scheduler = Scheduler(MagicMock(),
+                                   os.path.join(self.dir, 'schedule.json'),
+                                   flush_interval=0)
+        self.addCleanup(self.scheduler.stop)
+        patcher = patch('daikin.server.scheduler', self.scheduler)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = server.app.test_client()
+
+    def put(self, id, data):
+        return self.client.put('/schedule/{}'.format(id),
+                               data=json.dumps(data),
+                               content_type='application/json')
+
+    def test_put_and_delete(self):
+        response = self.put('morning', {
+            'cron': '30 6 * * 1-5',
+            'changes': {'power': True, 'ac_mode': 'heat'}
+        })
+        self.assertEqual(200, response.status_code)
+        [entry] = self.client.get('/schedule').get_json()['entries']
+        self.assertEqual(('morning', '30 6 * * 1-5'),
+                         (entry['id'], entry['cron']))
+        self.assertEqual(self.scheduler.next_due()[0], entry['next_due'])
+
+        self.assertEqual(200, self.client.delete('/schedule/morning')
+                         .status_code)
+        self.assertEqual([],
+                         self.client.get('/schedule').get_json()['entries'])
+        self.assertEqual(404, self.client.delete('/schedule/morning')
+                         .status_code)
+
+    def test_invalid(self):
+        for data in [{'cron': '* *', 'changes': {'power': True}},
+                     {'at': 'soon', 'changes': {'power': True}},
+                     {'at': 1, 'changes': {'temperature': 99}}, 'x']:
+            self.assertEqual(400, self.put('a', data).status_code)
+        self.assertEqual([], list(self.scheduler))
+
+    def test_not_enabled(self):
+        with patch('daikin.server.scheduler', None):
+            self.assertEqual(404, self.client.get('/schedule').status_code)
+
+
+class TestMetrics(TestCase):
+    def test_metrics(self):
+        response = server.app.test_client().get('/metrics')
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        self.assertIn('# TYPE daikin_stage_seconds histogram',
+                      response.get_data(as_text=True))
+
+
+class TestCorrelationId(TestCase):
+    def test_correlation_id(self):
+        client = server.app.test_client()
+        response = client.get('/metrics',
+                              headers={'X-Correlation-ID': 'abc'})
+        self.assertEqual('abc', response.headers['X-Correlation-ID'])
+        self.assertEqual(16,
+                         len(client.get('/metrics').headers[
+                             'X-Correlation-ID']))
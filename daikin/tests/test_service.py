@@ -0,0 +1,316 @@
+import asyncio
+import struct
+import threading
+from unittest import TestCase
+from mock import patch, MagicMock
+import paho.mqtt.client as mqtt
+
+from daikin import mqtt_service, server
+from daikin.aio import AsyncioMQTT, WSGIServer
+from daikin.daikin import AC_MODE, DaikinController, DaikinState
+from daikin.home_assistant import StatePublisher
+from daikin.service import DaikinService
+from daikin.units import Unit, UnitRegistry
+
+
+def echo_app(environ, start_response):
+    body = environ['wsgi.input'].read()
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [
+        environ['REQUEST_METHOD'].encode(), b' ',
+        environ['PATH_INFO'].encode(), b' ',
+        environ['QUERY_STRING'].encode(), b' ', body
+    ]
+
+
+async def request(port, lines, body=b''):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    responses = []
+    for line in lines:
+        writer.write(line.encode() + b'\r\n')
+        writer.write('Content-Length: {}\r\n\r\n'.format(len(body)).encode())
+        writer.write(body)
+        await writer.drain()
+        responses.append(await read_response(reader))
+    writer.close()
+    return responses
+
+
+async def read_response(reader):
+    status = (await reader.readline()).decode().split(' ', 1)[1].strip()
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode()
+        if line == '\r\n':
+            break
+        name, value = line.split(':', 1)
+        headers[name.lower()] = value.strip()
+    body = await reader.readexactly(int(headers['content-length']))
+    return status, headers, body
+
+
+class FakeBroker:
+    """
+        Just enough MQTT 3.1.1 to accept a connection, acknowledge
+        subscriptions and record publishes
+    """
+
+    def __init__(self):
+        self.published = []
+        self.subscribed = []
+        self.received = asyncio.Event()
+        self.writer = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def send_publish(self, topic, payload):
+        topic = topic.encode()
+        body = struct.pack('!H', len(topic)) + topic + payload
+        self.writer.write(bytes([0x30, len(body)]) + body)
+
+    async def handle(self, reader, writer):
+        self.writer = writer
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+                length, shift = 0, 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length |= (byte & 0x7f) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length)
+                kind = header & 0xf0
+                if kind == 0x10:
+                    writer.write(b'\x20\x02\x00\x00')
+                elif kind == 0x80:
+                    self.subscribed.append(body[4:-1].decode())
+                    writer.write(b'\x90\x03' + body[:2] + b'\x00')
+                elif kind == 0x30:
+                    size = struct.unpack('!H', body[:2])[0]
+                    self.published.append(
+                        (body[2:2 + size].decode(), body[2 + size:].decode(),
+                         bool(header & 0x01)))
+                    self.received.set()
+                elif kind == 0xc0:
+                    writer.write(b'\xd0\x00')
+                elif kind == 0xe0:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def wait_for(condition, timeout=5):
+    deadline = asyncio.get_event_loop().time() + timeout
+    while not condition():
+        if asyncio.get_event_loop().time() > deadline:
+            raise AssertionError('Timed out')
+        await asyncio.sleep(0.01)
+
+
+class LoopTestCase(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(
+            asyncio.wait_for(coroutine, 10))
+
+
+class TestWSGIServer(LoopTestCase):
+    def serve(self, app, lines, body=b''):
+        async def run():
+            http = WSGIServer(app, '127.0.0.1', 0)
+            await http.start()
+            try:
+                return await request(http.port, lines, body)
+            finally:
+                await http.stop()
+
+        return self.run_async(run())
+
+    def test_request(self):
+        [(status, headers, body)] = self.serve(
+            echo_app, ['POST /temperature/22?unit=bedroom HTTP/1.1'],
+            b'{"a": 1}')
+        self.assertEqual('200 OK', status)
+        self.assertEqual('text/plain', headers['content-type'])
+        self.assertEqual(b'POST /temperature/22 unit=bedroom {"a": 1}',
+                         body)
+
+    def test_keep_alive(self):
+        responses = self.serve(echo_app, [
+            'POST /heat/22 HTTP/1.1',
+            'POST /cool/25 HTTP/1.1',
+        ])
+        self.assertEqual([b'POST /heat/22  ', b'POST /cool/25  '],
+                         [body for _, _, body in responses])
+        self.assertEqual('keep-alive', responses[0][1]['connection'])
+
+    def serve_raw(self, data):
+        """
+        Sends data as is and returns everything the server writes back
+        before closing the connection
+        """
+        async def run():
+            http = WSGIServer(echo_app, '127.0.0.1', 0)
+            await http.start()
+            try:
+                reader, writer = await asyncio.open_connection(
+                    '127.0.0.1', http.port)
+                writer.write(data)
+                response = await reader.read()
+                writer.close()
+                return response
+            finally:
+                await http.stop()
+
+        return self.run_async(run())
+
+    def test_rejects_chunked_requests(self):
+        response = self.serve_raw(
+            b'POST /heat/22 HTTP/1.1\r\nTransfer-Encoding: chunked\r\n'
+            b'\r\n4\r\nGET \r\n0\r\n\r\n')
+        self.assertTrue(response.startswith(b'HTTP/1.1 501 Not Implemented'))
+        self.assertIn(b'Connection: close', response)
+        # the body wasn't taken for another request
+        self.assertEqual(1, response.count(b'HTTP/1.1'))
+
+    def test_header_timeout(self):
+        with patch('daikin.aio.HTTP_HEADER_TIMEOUT', 0.1):
+            response = self.serve_raw(b'GET / HTTP/1.1\r\nHost: a')
+        self.assertTrue(response.startswith(b'HTTP/1.1 408 Request Timeout'))
+
+    def test_body_timeout(self):
+        with patch('daikin.aio.HTTP_BODY_TIMEOUT', 0.1):
+            response = self.serve_raw(
+                b'POST / HTTP/1.1\r\nContent-Length: 1000\r\n\r\n{')
+        self.assertTrue(response.startswith(b'HTTP/1.1 408 Request Timeout'))
+
+    def test_too_many_headers(self):
+        with patch('daikin.aio.HTTP_MAX_HEADERS', 3):
+            response = self.serve_raw(
+                b'GET / HTTP/1.1\r\n' + b'X-A: 1\r\n' * 4 + b'\r\n')
+        self.assertTrue(response.startswith(b'HTTP/1.1 400 Bad Request'))
+        self.assertEqual(1, response.count(b'HTTP/1.1'))
+
+    def test_app_errors(self):
+        def broken_app(environ, start_response):
+            raise ValueError('broken')
+
+        [(status, _, _)] = self.serve(broken_app, ['GET / HTTP/1.1'])
+        self.assertEqual('500 Internal Server Error', status)
+
+    def test_flask_app(self):
+        controller = MagicMock(spec=DaikinController)
+        with patch('daikin.server.controller', controller):
+            [(status, _, body)] = self.serve(server.app,
+                                             ['POST /heat/23 HTTP/1.1'])
+        self.assertEqual('200 OK', status)
+        self.assertEqual(b'OK', body)
+        controller.set_state.assert_called_once_with(
+            DaikinState(power=True, temperature=23, ac_mode=AC_MODE.HEAT))
+
+
+class TestAsyncioMQTT(LoopTestCase):
+    def test_connects_and_publishes_from_other_threads(self):
+        async def run():
+            broker = FakeBroker()
+            await broker.start()
+            connected = asyncio.Event()
+            client = mqtt.Client('test')
+            client.on_connect = lambda *args: connected.set()
+            helper = AsyncioMQTT(client, asyncio.get_event_loop())
+            task = asyncio.ensure_future(helper.run('127.0.0.1', broker.port))
+            await connected.wait()
+
+            thread = threading.Thread(
+                target=lambda: helper.call_soon(client.publish, 'a/b', 'c'))
+            thread.start()
+            thread.join()
+            await broker.received.wait()
+
+            helper.stop()
+            await task
+            await broker.stop()
+            return broker.published
+
+        self.assertEqual([('a/b', 'c', False)], self.run_async(run()))
+
+
+class TestDaikinService(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.controller = DaikinController(lirc=MagicMock(),
+                                           autosave=False,
+                                           background=True)
+        self.controller.state = DaikinState()
+        self.unit = Unit('livingroom', 'livingroom/ac/', self.controller)
+        self.registry = UnitRegistry([self.unit])
+        for name in ('registry', 'topics_writer', 'MQTT_TOPICS'):
+            patcher = patch('daikin.mqtt_service.{}'.format(name),
+                            [] if name == 'MQTT_TOPICS' else None,
+                            create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch('daikin.server.controller', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(patch.stopall)
+        patch('daikin.mqtt_service.write_topics').start()
+
+    def test_http_and_mqtt_share_the_controller(self):
+        async def run():
+            broker = FakeBroker()
+            await broker.start()
+            service = DaikinService(self.registry, '127.0.0.1', 0,
+                                    '127.0.0.1', broker.port)
+            await service.start()
+            self.assertIs(self.controller, server.controller)
+            await wait_for(lambda: broker.subscribed)
+
+            # the web server changes the state, the MQTT side publishes it
+            await request(service.http.port, ['POST /heat/23 HTTP/1.1'])
+            await wait_for(lambda: ('livingroom/ac/temperature/state', '23',
+                                    True) in broker.published)
+
+            # an MQTT command changes the state the web server sees
+            broker.send_publish('livingroom/ac/temperature/set', b'25')
+            await wait_for(
+                lambda: self.controller.current_state().temperature == 25)
+
+            service.stop()
+            await service.close()
+            await broker.stop()
+            return broker.subscribed
+
+        self.assertEqual(['livingroom/ac/#'], self.run_async(run()))
+        self.assertIsInstance(self.unit.publisher, StatePublisher)
+        # publishing on the client's loop, so batches can be corked
+        self.assertTrue(self.unit.publisher.cork)
+
+    def test_close_before_starting(self):
+        service = DaikinService(self.registry, '127.0.0.1', 0)
+        self.run_async(service.close())
+        self.assertIsNone(service.mqtt_task)
+
+    def test_scheduled_changes(self):
+        service = DaikinService(self.registry)
+        service.run_scheduled('livingroom', {'temperature': 26})
+        service.run_scheduled(None, {'power': True})
+        service.run_scheduled('attic', {'power': False})
+        self.assertEqual(
+            DaikinState(power=True, temperature=26),
+            self.controller.current_state())
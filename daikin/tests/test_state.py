@@ -1,5 +1,7 @@
+import random
 from unittest import TestCase
-from daikin.daikin import DaikinMessage, DaikinState
+from daikin.daikin import (AC_MODE, FAN_MODE, TIMER_MODE, DaikinMessage,
+                           DaikinState)
 
 
 def get_hex(frame):
@@ -37,7 +39,7 @@ class TestDaikinMessage(TestCase):
         self.assertFrameData(expected, self.message.frame_one)
 
     def test_frame_one_comfort_on(self):
-        self.state.comfort = True
+        self.message = DaikinMessage(self.state.replace(comfort=True))
         expected = [
             '0xc5',
             '0x0',
@@ -56,9 +58,221 @@ class TestDaikinMessage(TestCase):
         ]
         self.assertFrameData(expected, self.message.frame_three)
 
+    def test_frame_three_on_timer(self):
+        message = DaikinMessage(
+            self.state.replace(timer=TIMER_MODE.ON, timer_duration=60))
+        expected = [
+            '0x11', '0xda', '0x27', '0x0', '0x0', '0xa', '0x26', '0x0', '0xa0',
+            '0x0', '0x3c', '0x0', '0x60', '0x0', '0x0', '0xc1', '0x80', '0x0',
+            '0xbf'
+        ]
+        self.assertEqual(expected, get_hex(message.frame_three))
+
+    def test_frame_three_off_timer(self):
+        message = DaikinMessage(
+            self.state.replace(power=True,
+                               timer=TIMER_MODE.OFF,
+                               timer_duration=60))
+        expected = [
+            '0x11', '0xda', '0x27', '0x0', '0x0', '0xd', '0x26', '0x0', '0xa0',
+            '0x0', '0x0', '0xc6', '0x3', '0x0', '0x0', '0xc1', '0x80', '0x0',
+            '0xef'
+        ]
+        self.assertEqual(expected, get_hex(message.frame_three))
+
+    def test_frame_three_long_timers(self):
+        # more than a byte of minutes spills into the shared TIMER_B byte
+        off = DaikinMessage(
+            self.state.replace(timer=TIMER_MODE.OFF, timer_duration=300))
+        self.assertFrameData(
+            ['0x0', '0xc', '0x26', '0x0', '0xa0', '0x0', '0x0', '0xc6', '0x12',
+             '0x0', '0x0', '0xc1', '0x80', '0x0'], off.frame_three)
+        on = DaikinMessage(
+            self.state.replace(timer=TIMER_MODE.ON, timer_duration=720))
+        self.assertFrameData(
+            ['0x0', '0xa', '0x26', '0x0', '0xa0', '0x0', '0xd0', '0x2', '0x60',
+             '0x0', '0x0', '0xc1', '0x80', '0x0'], on.frame_three)
+
     def test_bin_string(self):
         self.assertEqual(8, len(self.message.frame_one))
         self.assertEqual(
             '0001000111011010001001110000000011000101000000000000000011010111',
             "".join(
                 [bin(item)[2:].zfill(8) for item in self.message.frame_one]))
+
+    def test_frames_are_read_only_views(self):
+        self.assertEqual(35, len(self.message.buffer))
+        self.assertEqual(
+            self.message.buffer,
+            bytes(self.message.frame_one) + bytes(self.message.frame_two) +
+            bytes(self.message.frame_three))
+        with self.assertRaises(TypeError):
+            self.message.frame_three[5] = 0
+
+    def test_with_state_matches_encoding(self):
+        rng = random.Random(0)
+        message = self.message
+        for _ in range(500):
+            state = DaikinState.unpack(
+                rng.randrange(DaikinState.STATE_COUNT))
+            message = message.with_state(state)
+            self.assertEqual(DaikinMessage(state).buffer, message.buffer)
+
+    def test_with_same_state_shares_buffer(self):
+        message = self.message.with_state(DaikinState())
+        self.assertIs(self.message.buffer, message.buffer)
+
+    def test_replace(self):
+        message = self.message.replace(temperature=25, comfort=True)
+        self.assertEqual(25, message.state.temperature)
+        self.assertEqual(
+            DaikinMessage(self.state.replace(temperature=25,
+                                             comfort=True)).buffer,
+            message.buffer)
+
+
+class TestDaikinState(TestCase):
+    def test_immutable(self):
+        state = DaikinState()
+        with self.assertRaises(AttributeError):
+            state.power = True
+        with self.assertRaises(AttributeError):
+            state.anything = True
+
+    def test_replace(self):
+        state = DaikinState(temperature=22)
+        changed = state.replace(power=True, ac_mode=AC_MODE.COOL)
+        self.assertFalse(state.power)
+        self.assertTrue(changed.power)
+        self.assertEqual(22, changed.temperature)
+        self.assertEqual(AC_MODE.COOL, changed.ac_mode)
+
+    def test_clamps_values(self):
+        self.assertEqual(18, DaikinState(temperature=5).temperature)
+        self.assertEqual(30, DaikinState(temperature=45).temperature)
+        self.assertEqual(30, DaikinState().replace(temperature=31).temperature)
+        self.assertEqual(AC_MODE.AUTO, DaikinState(ac_mode='heat').ac_mode)
+
+    def test_value_equality(self):
+        first = DaikinState(power=True, temperature=22, economy=True)
+        second = DaikinState(power=1, temperature=22, economy=1)
+        self.assertEqual(first, second)
+        self.assertEqual(hash(first), hash(second))
+        self.assertNotEqual(first, second.replace(economy=False))
+        self.assertEqual(1, len({first, second}))
+
+    def test_pack_round_trip(self):
+        self.assertEqual((1 + 2 * 720) * 2 * 13 * 5 * 7 * 2**5,
+                         DaikinState.STATE_COUNT)
+        # every state without a timer, then a sample of the timers
+        settings = 2 * 13 * 5 * 7 * 2**5
+        seen = set()
+        for packed in range(settings):
+            state = DaikinState.unpack(packed)
+            self.assertEqual(TIMER_MODE.NONE, state.timer)
+            self.assertEqual(packed, state.pack())
+            seen.add(state)
+        for packed in range(settings, DaikinState.STATE_COUNT, 997):
+            state = DaikinState.unpack(packed)
+            self.assertEqual(packed, state.pack())
+            seen.add(state)
+        self.assertEqual(settings + len(
+            range(settings, DaikinState.STATE_COUNT, 997)), len(seen))
+
+    def test_pack_without_timer_is_unchanged(self):
+        # packed states stored before timers existed still mean the same
+        self.assertEqual(1120, DaikinState().pack())
+        self.assertEqual(
+            DaikinState(power=True, temperature=22, ac_mode=AC_MODE.HEAT),
+            DaikinState.unpack(19712))
+
+    def test_timer(self):
+        state = DaikinState(timer=TIMER_MODE.OFF, timer_duration=90)
+        self.assertEqual((TIMER_MODE.OFF, 90),
+                         (state.timer, state.timer_duration))
+        self.assertEqual(state, DaikinState.unpack(state.pack()))
+        self.assertEqual(state, DaikinState.from_key(state.key()))
+        self.assertEqual('off-19-auto-auto-00000-off90', state.key())
+        self.assertEqual(state, DaikinState.deserialize(state.serialize()))
+        self.assertEqual(
+            0, state.replace(timer=TIMER_MODE.NONE).timer_duration)
+        self.assertEqual(
+            720,
+            DaikinState(timer=TIMER_MODE.ON, timer_duration=9000)
+            .timer_duration)
+
+    def test_deserialize_without_timer(self):
+        data = DaikinState(power=True).serialize()
+        del data['timer'], data['timer_duration']
+        state = DaikinState.deserialize(data)
+        self.assertTrue(state.power)
+        self.assertEqual(TIMER_MODE.NONE, state.timer)
+
+    def test_pack_is_lossless(self):
+        state = DaikinState(power=True,
+                            temperature=27,
+                            ac_mode=AC_MODE.DRY,
+                            fan_mode=FAN_MODE.SILENT,
+                            swing_horizontal=True,
+                            comfort=True,
+                            powerful=True)
+        restored = DaikinState.unpack(state.pack())
+        self.assertEqual(state.serialize(), restored.serialize())
+
+    def test_bytes(self):
+        state = DaikinState(power=True, temperature=30, fan_mode=FAN_MODE.FIVE)
+        data = state.to_bytes()
+        self.assertEqual(DaikinState.PACKED_SIZE, len(data))
+        self.assertEqual(state, DaikinState.from_bytes(data))
+
+    def test_unpack_out_of_range(self):
+        with self.assertRaises(ValueError):
+            DaikinState.unpack(DaikinState.STATE_COUNT)
+        with self.assertRaises(ValueError):
+            DaikinState.unpack(-1)
+
+    def test_parse_changes(self):
+        self.assertEqual(
+            {
+                'ac_mode': AC_MODE.HEAT,
+                'fan_mode': FAN_MODE.AUTO,
+                'temperature': 22,
+                'economy': True,
+                'comfort': False,
+            },
+            DaikinState.parse_changes({
+                'ac_mode': 'heat',
+                'fan_mode': 'AUTO',
+                'temperature': 22,
+                'economy': True,
+                'comfort': False,
+            }))
+
+    def test_parse_changes_timer(self):
+        self.assertEqual({
+            'timer': TIMER_MODE.ON,
+            'timer_duration': 90
+        }, DaikinState.parse_changes({
+            'timer': 'on',
+            'timer_duration': 90
+        }))
+        self.assertEqual({'timer': TIMER_MODE.NONE},
+                         DaikinState.parse_changes({'timer': 'none'}))
+
+    def test_parse_changes_rejects_invalid(self):
+        for data in [
+            {},
+            [],
+            {'timer': True},
+            {'timer': 'off'},
+            {'timer': 'off', 'timer_duration': 721},
+            {'timer_duration': '60'},
+            {'temperature': 31},
+            {'temperature': '22'},
+            {'temperature': True},
+            {'ac_mode': 'warm'},
+            {'fan_mode': 3},
+            {'power': 'on'},
+        ]:
+            with self.assertRaises(ValueError):
+                DaikinState.parse_changes(data)
@@ -0,0 +1,193 @@
+import json
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from unittest import TestCase
+from mock import MagicMock, patch
+
+from daikin.daikin import (AC_MODE, TIMER_MODE, DaikinController, DaikinLIRC,
+                           DaikinState)
+from daikin.state_store import StateStore
+
+
+def increment(state):
+    # uses the whole packed range as a counter
+    return DaikinState.unpack((state.pack() + 1) % DaikinState.STATE_COUNT)
+
+
+def hammer(path, threads, increments):
+    store = StateStore(path)
+
+    def work():
+        for _ in range(increments):
+            store.update(increment)
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    store.close()
+
+
+class TestStateStore(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'state.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open_store(self, **kwargs):
+        store = StateStore(self.path, **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+    def test_initial_state(self):
+        initial = DaikinState(power=True, temperature=24)
+        store = self.open_store(initial=lambda: initial)
+        self.assertEqual((0, initial), store.read())
+        # only used when the store is created
+        other = self.open_store(initial=DaikinState)
+        self.assertEqual(initial, other.read()[1])
+
+    def test_timer_states(self):
+        store = self.open_store()
+        state = DaikinState(timer=TIMER_MODE.OFF, timer_duration=720)
+        store.write(state)
+        self.assertEqual(state, self.open_store().read()[1])
+
+    def test_reads_stores_from_before_timers(self):
+        state = DaikinState(power=True, temperature=22)
+        with open(self.path, 'wb') as f:
+            f.write(struct.pack('<4sQH', b'DKS1', 4, state.pack()).ljust(
+                16, b'\0'))
+        self.assertEqual((2, state), self.open_store().read())
+
+    def test_timer_deadline(self):
+        store = self.open_store()
+        state = DaikinState(timer=TIMER_MODE.ON, timer_duration=30)
+        store.write(state, timer_expires=1800.5)
+        self.assertEqual((1, state, 1800.5), self.open_store().read_record())
+        store.update(lambda state: state.replace(temperature=25))
+        self.assertEqual(1800.5, store.read_record()[2])
+        store.write(DaikinState())
+        self.assertIsNone(store.read_record()[2])
+
+    def test_extends_stores_from_before_timer_deadlines(self):
+        state = DaikinState(power=True, temperature=22)
+        with open(self.path, 'wb') as f:
+            f.write(struct.pack('<4sQI', b'DKS1', 4, state.pack()))
+        self.assertEqual((2, state, None), self.open_store().read_record())
+        self.assertEqual(StateStore.SIZE, os.path.getsize(self.path))
+
+    def test_compare_and_swap(self):
+        store = self.open_store()
+        version, state = store.read()
+        new_version = store.compare_and_swap(version,
+                                             state.replace(temperature=25))
+        self.assertEqual(version + 1, new_version)
+        # a stale version is refused
+        self.assertIsNone(
+            store.compare_and_swap(version, state.replace(temperature=20)))
+        self.assertEqual(25, store.read()[1].temperature)
+
+    def test_shared_between_instances(self):
+        first = self.open_store()
+        second = self.open_store()
+        first.write(DaikinState(ac_mode=AC_MODE.COOL))
+        self.assertEqual(AC_MODE.COOL, second.read()[1].ac_mode)
+
+    def test_rejects_other_files(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a state store')
+        with self.assertRaises(ValueError):
+            StateStore(self.path)
+
+    def test_recovers_interrupted_write(self):
+        store = self.open_store()
+        store.write(DaikinState(temperature=26))
+        # a writer that died between bumping the sequence and finishing
+        sequence = struct.unpack_from('<Q', store.map, 4)[0]
+        struct.pack_into('<Q', store.map, 4, sequence + 1)
+
+        version, state = store.read()
+        self.assertEqual(26, state.temperature)
+        self.assertEqual(0, struct.unpack_from('<Q', store.map, 4)[0] % 2)
+        self.assertIsNotNone(store.compare_and_swap(version, state))
+
+    def test_no_lost_updates(self):
+        processes, threads, increments = 4, 3, 150
+        self.open_store(initial=lambda: DaikinState.unpack(0))
+
+        context = multiprocessing.get_context('fork')
+        workers = [
+            context.Process(target=hammer,
+                            args=(self.path, threads, increments))
+            for _ in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(60)
+            self.assertEqual(0, worker.exitcode)
+
+        version, state = StateStore(self.path).read()
+        total = processes * threads * increments
+        self.assertEqual(total, state.pack())
+        self.assertEqual(total, version)
+
+
+class TestControllerWithStore(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.storage_file = os.path.join(self.dir, 'config.json')
+        self.store_file = os.path.join(self.dir, 'state.bin')
+        with open(self.storage_file, 'w') as f:
+            json.dump(DaikinState(temperature=21).serialize(), f)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def create_controller(self):
+        return DaikinController(storage_file=self.storage_file,
+                                store_file=self.store_file,
+                                lirc=MagicMock(spec=DaikinLIRC))
+
+    def test_seeded_from_storage_file(self):
+        self.assertEqual(21, self.create_controller().current_state()
+                         .temperature)
+
+    @patch('daikin.daikin.time.time')
+    def test_controllers_share_the_timer_deadline(self, now):
+        # eg. the web server arms it and a later command comes over MQTT
+        now.return_value = 1000.0
+        server = self.create_controller()
+        mqtt = self.create_controller()
+        server.arm_timer(TIMER_MODE.OFF, 60)
+
+        now.return_value += 20 * 60
+        mqtt.update(temperature=24)
+        sent = mqtt.lirc.send.call_args[0][0].state
+        self.assertEqual((TIMER_MODE.OFF, 40),
+                         (sent.timer, sent.timer_duration))
+        self.assertEqual(server.timer_expires, mqtt.timer_expires)
+
+    def test_concurrent_controllers_keep_both_changes(self):
+        # eg. the web server and the MQTT service
+        server = self.create_controller()
+        mqtt = self.create_controller()
+        server.current_state()
+        mqtt.current_state()
+
+        server.update(temperature=25)
+        mqtt.update(ac_mode=AC_MODE.HEAT)
+
+        state = server.current_state()
+        self.assertEqual(25, state.temperature)
+        self.assertEqual(AC_MODE.HEAT, state.ac_mode)
+        message = mqtt.lirc.send.call_args[0][0]
+        self.assertEqual(25, message.state.temperature)
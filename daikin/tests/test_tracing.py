@@ -0,0 +1,168 @@
+import json
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+from mock import MagicMock
+
+from daikin import tracing
+from daikin.daikin import AC_MODE, DaikinController, DaikinState
+from daikin.tracing import (DroppingQueueHandler, EventFormatter, event,
+                            span, traced)
+from daikin.worker import CoalescingWorker, LatestWinsWorker
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TracingTestCase(TestCase):
+    def setUp(self):
+        self.handler = ListHandler()
+        listener = tracing.configure(handler=self.handler)
+        self.addCleanup(self.restore, tracing.events.propagate)
+        self.listener = listener
+
+    def restore(self, propagate):
+        self.listener.stop()
+        for handler in list(tracing.events.handlers):
+            tracing.events.removeHandler(handler)
+        tracing.events.setLevel(logging.NOTSET)
+        tracing.events.propagate = propagate
+
+    def events(self):
+        # stop() writes out everything still queued
+        self.listener.stop()
+        self.listener.start()
+        return [(record.event, record.correlation_id)
+                for record in self.handler.records]
+
+
+class TestTracing(TracingTestCase):
+    def test_traced(self):
+        self.assertIsNone(tracing.current_id())
+        with traced() as outer:
+            self.assertEqual(16, len(outer))
+            with traced('abc'):
+                event('inner')
+            event('outer', value=1)
+        event('untraced')
+        self.assertEqual([('inner', 'abc'), ('outer', outer),
+                          ('untraced', None)], self.events())
+        self.assertEqual({'value': 1}, self.handler.records[1].fields)
+
+    def test_span(self):
+        with traced('abc'):
+            with self.assertRaises(KeyError):
+                with span('transmit', unit='bedroom'):
+                    raise KeyError('lircd')
+        self.assertEqual([('transmit', 'abc')], self.events())
+        fields = self.handler.records[0].fields
+        self.assertEqual('bedroom', fields['unit'])
+        self.assertIn('lircd', fields['error'])
+        self.assertGreaterEqual(fields['duration'], 0)
+
+    def test_formatter(self):
+        with traced('abc'):
+            event('save', state=DaikinState(power=True))
+        self.events()
+        data = json.loads(EventFormatter().format(self.handler.records[0]))
+        self.assertEqual('save', data['event'])
+        self.assertEqual('abc', data['id'])
+        self.assertEqual(DaikinState(power=True).key(), data['state'])
+        self.assertIn('monotonic', data)
+
+    def test_full_queue_drops(self):
+        handler = DroppingQueueHandler(queue.Queue(1))
+        logger = logging.getLogger('daikin.tests.dropping')
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        logger.warning('first')
+        logger.warning('second')
+        self.assertEqual(1, handler.dropped)
+
+    def test_disabled(self):
+        tracing.events.setLevel(logging.WARNING)
+        with traced('abc'), span('transmit'):
+            event('save')
+        self.assertEqual([], self.events())
+
+    def test_off_without_a_trace_file(self):
+        # as service.main's logging.basicConfig(level=logging.INFO)
+        root = ListHandler()
+        logger = logging.getLogger()
+        logger.addHandler(root)
+        self.addCleanup(logger.removeHandler, root)
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.INFO)
+        self.addCleanup(tracing.events.setLevel, logging.NOTSET)
+        self.addCleanup(setattr, tracing.events, 'propagate',
+                        tracing.events.propagate)
+        for handler in list(tracing.events.handlers):
+            tracing.events.removeHandler(handler)
+
+        self.assertIsNone(tracing.configure(path=None))
+        self.assertFalse(tracing.events.isEnabledFor(logging.INFO))
+        with traced('abc'), span('transmit'):
+            event('save')
+        self.assertEqual([], root.records)
+
+
+class TestPropagation(TracingTestCase):
+    def test_latest_wins_worker(self):
+        ids = []
+        done = threading.Event()
+        worker = LatestWinsWorker(
+            lambda item: (ids.append(tracing.current_id()), done.set()))
+        worker.start()
+        self.addCleanup(worker.stop)
+        with traced('abc'):
+            worker.submit(1)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(['abc'], ids)
+
+    def test_coalescer_logs_merged_ids(self):
+        target = MagicMock()
+        worker = CoalescingWorker(target, window=0, max_delay=0)
+        with traced('a'):
+            worker.submit(power=True)
+        with traced('b'):
+            worker.submit(temperature=22)
+        worker.start()
+        worker.stop(5)
+
+        target.assert_called_once_with(power=True, temperature=22)
+        self.assertEqual([('coalesced', 'b')], self.events())
+        self.assertEqual(['a', 'b'], self.handler.records[0].fields['merged'])
+
+    def test_controller_transmits_under_the_command_id(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        storage_file = os.path.join(directory, 'config.json')
+        with open(storage_file, 'w') as f:
+            json.dump({}, f)
+        controller = DaikinController(storage_file=storage_file,
+                                      lirc=MagicMock(),
+                                      background=True)
+        self.addCleanup(controller.stop)
+
+        with traced('abc'):
+            controller.update(power=True, ac_mode=AC_MODE.HEAT)
+        controller.transmitter.join_pending(5)
+        controller.persister.join_pending(5)
+
+        events = self.events()
+        for name in ('update', 'apply_state', 'save', 'transmit'):
+            self.assertIn((name, 'abc'), events)
+        transmit = [record for record in self.handler.records
+                    if record.event == 'transmit'][0]
+        self.assertEqual('daikin-transmitter', transmit.threadName)
@@ -0,0 +1,228 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+from mock import patch, MagicMock
+
+from daikin import mqtt_service
+from daikin.codebook import DaikinLIRCCodebook
+from daikin.daikin import (AC_MODE, DaikinController, DaikinLIRC,
+                           DaikinMessage, DaikinState)
+from daikin.lirc_device import DaikinLIRCDevice
+from daikin.metrics import MQTT_MESSAGES
+from daikin.units import (MQTT_TOPIC_PREFIX, Unit, UnitRegistry, emitter_of,
+                          load_unit_configs)
+
+
+def create_unit(name, topic_prefix, emitter=None):
+    return Unit(name, topic_prefix, MagicMock(spec=DaikinController),
+                emitter)
+
+
+class TestUnitRegistry(TestCase):
+    def setUp(self):
+        self.livingroom = create_unit('livingroom', 'livingroom/ac/')
+        self.bedroom = create_unit('bedroom', 'upstairs/bedroom/ac/')
+        self.registry = UnitRegistry([self.livingroom, self.bedroom])
+
+    def test_route(self):
+        self.assertEqual((self.bedroom, 'mode/set'),
+                         self.registry.route('upstairs/bedroom/ac/mode/set'))
+        self.assertEqual((self.livingroom, 'temperature/set'),
+                         self.registry.route('livingroom/ac/temperature/set'))
+
+    def test_route_unknown(self):
+        self.assertEqual((None, None), self.registry.route('kitchen/ac/x'))
+        self.assertEqual((None, None), self.registry.route('upstairs/x'))
+        # a prefix is matched by whole levels only
+        self.assertEqual((None, None),
+                         self.registry.route('livingroom/acx/mode/set'))
+
+    def test_longest_prefix_wins(self):
+        fan = create_unit('fan', 'livingroom/ac/fan/')
+        self.registry.add(fan)
+        self.assertEqual((fan, 'set'),
+                         self.registry.route('livingroom/ac/fan/set'))
+        self.assertEqual((self.livingroom, 'mode/set'),
+                         self.registry.route('livingroom/ac/mode/set'))
+
+    def test_duplicates_are_rejected(self):
+        with self.assertRaises(ValueError):
+            self.registry.add(create_unit('livingroom', 'other/ac/'))
+        with self.assertRaises(ValueError):
+            self.registry.add(create_unit('other', 'livingroom/ac'))
+
+    def test_subscriptions(self):
+        self.assertEqual(['livingroom/ac/#', 'upstairs/bedroom/ac/#'],
+                         self.registry.subscriptions())
+
+
+class TestUnitConfig(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'units.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_units(self, units):
+        with open(self.path, 'w') as f:
+            json.dump({'units': units}, f)
+
+    def test_single_unit_without_file(self):
+        configs = load_unit_configs(self.path)
+        self.assertEqual(1, len(configs))
+        self.assertEqual(MQTT_TOPIC_PREFIX, configs[0]['topic_prefix'])
+
+    def test_defaults(self):
+        self.write_units([{'name': 'bedroom'}])
+        config = load_unit_configs(self.path)[0]
+        self.assertEqual('bedroom/ac/', config['topic_prefix'])
+        self.assertEqual('daikin-bedroom', config['remote'])
+        self.assertEqual('bedroom.bin',
+                         os.path.basename(config['store_file']))
+
+    def test_emitters(self):
+        device = {'mode': 'device', 'device': '/dev/lirc1'}
+        self.assertEqual('/dev/lirc1', emitter_of(device))
+        # remotes on the same lircd share its transmitter
+        self.assertEqual(emitter_of({'mode': 'codebook', 'remote': 'a'}),
+                         emitter_of({'mode': 'dynamic', 'remote': 'b'}))
+        self.assertEqual('gpio22', emitter_of({'emitter': 'gpio22'}))
+
+    def test_load_builds_each_unit(self):
+        self.write_units([
+            {'name': 'livingroom', 'mode': 'codebook',
+             'storage_file': os.path.join(self.dir, 'livingroom.json'),
+             'store_file': os.path.join(self.dir, 'livingroom.bin')},
+            {'name': 'bedroom', 'mode': 'device', 'device': '/dev/lirc1',
+             'storage_file': os.path.join(self.dir, 'bedroom.json'),
+             'store_file': os.path.join(self.dir, 'bedroom.bin')},
+        ])
+        for name in ('livingroom', 'bedroom'):
+            with open(os.path.join(self.dir, name + '.json'), 'w') as f:
+                json.dump(DaikinState().serialize(), f)
+
+        with patch('daikin.codebook.LIRC_CONFIG_DIR', self.dir):
+            registry = UnitRegistry.load(self.path)
+
+        livingroom = registry.get('livingroom').controller.lirc
+        self.assertIsInstance(livingroom, DaikinLIRCCodebook)
+        self.assertEqual('daikin-livingroom', livingroom.remote_name)
+        self.assertIsInstance(registry.get('bedroom').controller.lirc,
+                              DaikinLIRCDevice)
+        self.assertEqual('/dev/lirc1', registry.get('bedroom').emitter)
+
+
+class TestRemoteName(TestCase):
+    @patch('daikin.daikin.subprocess')
+    def test_irsend(self, subprocess):
+        DaikinLIRC(remote_name='daikin-bedroom',
+                   socket='/var/run/lirc/bedroom').send_once('code')
+        subprocess.check_output.assert_called_once_with([
+            'irsend', '--device=/var/run/lirc/bedroom', 'SEND_ONCE',
+            'daikin-bedroom', 'code'
+        ])
+
+    def test_config(self):
+        lirc = DaikinLIRC(remote_name='daikin-bedroom')
+        config = lirc.get_config(DaikinMessage(DaikinState()))
+        self.assertIn('    name    daikin-bedroom\n', config)
+        self.assertNotIn('daikin-pi', config)
+
+
+class TestMultiUnitController(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def create_controller(self, name, pool, emitter, lirc):
+        storage_file = os.path.join(self.dir, name + '.json')
+        with open(storage_file, 'w') as f:
+            json.dump(DaikinState().serialize(), f)
+        controller = DaikinController(storage_file=storage_file,
+                                      lirc=lirc,
+                                      background=True,
+                                      pool=pool,
+                                      emitter=emitter)
+        return Unit(name, name + '/ac/', controller, emitter)
+
+    def test_shared_emitter_is_serialised(self):
+        from daikin.worker import WorkerPool
+        pool = WorkerPool(size=3)
+        pool.start()
+        lock = threading.Lock()
+        overlapped = []
+
+        def send(message):
+            if not lock.acquire(blocking=False):
+                overlapped.append(message)
+                return
+            threading.Event().wait(0.02)
+            lock.release()
+
+        lirc = MagicMock(spec=DaikinLIRC)
+        lirc.send.side_effect = send
+        units = [
+            self.create_controller(name, pool, 'lirc0', lirc)
+            for name in ('livingroom', 'bedroom', 'study')
+        ]
+        registry = UnitRegistry(units, pool=pool)
+        for unit in registry:
+            unit.send(power=True, ac_mode=AC_MODE.HEAT)
+        registry.stop(5)
+
+        self.assertEqual([], overlapped)
+        self.assertEqual(3, lirc.send.call_count)
+
+
+class TestMQTTRouting(TestCase):
+    def setUp(self):
+        self.livingroom = create_unit('livingroom', 'livingroom/ac/')
+        self.bedroom = create_unit('bedroom', 'bedroom/ac/')
+        registry = UnitRegistry([self.livingroom, self.bedroom])
+        patcher = patch('daikin.mqtt_service.registry', registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def message(self, topic, payload):
+        msg = MagicMock()
+        msg.topic = topic
+        msg.payload = payload.encode('utf-8')
+        with patch('daikin.mqtt_service.MQTT_TOPICS', [topic], create=True):
+            mqtt_service.on_message(None, None, msg)
+
+    def test_routed_to_unit(self):
+        self.message('bedroom/ac/mode/set', 'cool')
+        self.message('livingroom/ac/power/set', 'on')
+
+        self.bedroom.controller.update.assert_called_once_with(
+            ac_mode=AC_MODE.COOL)
+        self.livingroom.controller.update.assert_called_once_with(power=True)
+
+    def test_resend(self):
+        self.message('bedroom/ac/resend/set', '')
+        self.bedroom.controller.update.assert_called_once_with(force=True)
+        self.livingroom.controller.update.assert_not_called()
+
+    def test_unknown_topic(self):
+        self.message('kitchen/ac/mode/set', 'cool')
+        self.message('bedroom/ac/mode', 'cool')
+        self.bedroom.controller.update.assert_not_called()
+
+    def test_messages_are_counted_by_unit_and_control(self):
+        before = (MQTT_MESSAGES.value('bedroom', 'mode/set'),
+                  MQTT_MESSAGES.value('other', 'other'))
+        self.message('bedroom/ac/mode/set', 'cool')
+        self.message('kitchen/ac/mode/set', 'cool')
+        self.message('bedroom/ac/anything', 'cool')
+        self.assertEqual(
+            (before[0] + 1, before[1] + 2),
+            (MQTT_MESSAGES.value('bedroom', 'mode/set'),
+             MQTT_MESSAGES.value('other', 'other')))
+        # nothing a client picks for a topic becomes a label
+        self.assertNotIn('kitchen', str(list(MQTT_MESSAGES.values)))
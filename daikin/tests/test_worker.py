@@ -0,0 +1,236 @@
+import time
+import threading
+from unittest import TestCase
+
+from daikin.worker import CoalescingWorker, LatestWinsWorker, WorkerPool
+
+
+class Recorder:
+    def __init__(self):
+        self.calls = []
+        self.event = threading.Event()
+
+    def __call__(self, **values):
+        self.calls.append((time.monotonic(), values))
+        self.event.set()
+
+
+class TestCoalescingWorker(TestCase):
+    def setUp(self):
+        self.recorder = Recorder()
+
+    def start_worker(self, **kwargs):
+        worker = CoalescingWorker(self.recorder, **kwargs)
+        worker.start()
+        self.addCleanup(worker.stop, 5)
+        return worker
+
+    def test_merges_burst_into_one_update(self):
+        worker = self.start_worker(window=0.05, max_delay=1)
+        worker.submit(ac_mode='heat')
+        worker.submit(temperature=22)
+        worker.submit(fan_mode='auto')
+        worker.submit(temperature=23)
+
+        self.assertTrue(self.recorder.event.wait(2))
+        worker.stop(5)
+        self.assertEqual([{
+            'ac_mode': 'heat',
+            'temperature': 23,
+            'fan_mode': 'auto',
+        }], [values for _, values in self.recorder.calls])
+
+    def test_separate_bursts_are_sent_separately(self):
+        worker = self.start_worker(window=0.02, max_delay=1)
+        worker.submit(temperature=22)
+        self.assertTrue(self.recorder.event.wait(2))
+        self.recorder.event.clear()
+        worker.submit(temperature=23)
+        self.assertTrue(self.recorder.event.wait(2))
+
+        self.assertEqual([{
+            'temperature': 22
+        }, {
+            'temperature': 23
+        }], [values for _, values in self.recorder.calls])
+
+    def test_max_delay_caps_a_steady_stream(self):
+        worker = self.start_worker(window=0.1, max_delay=0.2)
+        start = time.monotonic()
+        while time.monotonic() - start < 0.6:
+            worker.submit(temperature=22)
+            time.sleep(0.01)
+
+        self.assertTrue(self.recorder.calls)
+        first_sent, _ = self.recorder.calls[0]
+        # would never have fired if only the quiet window counted
+        self.assertLess(first_sent - start, 0.45)
+
+    def test_stop_sends_pending(self):
+        worker = self.start_worker(window=10, max_delay=10)
+        worker.submit(power=True)
+        worker.stop(5)
+        self.assertEqual([{
+            'power': True
+        }], [values for _, values in self.recorder.calls])
+
+    def test_target_errors_do_not_stop_worker(self):
+        def target(**values):
+            self.recorder(**values)
+            raise ValueError('transmit failed')
+
+        worker = CoalescingWorker(target, window=0.01)
+        worker.start()
+        worker.submit(power=True)
+        self.assertTrue(self.recorder.event.wait(2))
+        self.recorder.event.clear()
+        worker.submit(power=False)
+        self.assertTrue(self.recorder.event.wait(2))
+        worker.stop(5)
+        self.assertEqual(2, len(self.recorder.calls))
+
+
+class TestLatestWinsWorker(TestCase):
+    def test_pending_item_is_replaced(self):
+        started = threading.Event()
+        release = threading.Event()
+        processed = []
+
+        def target(item):
+            started.set()
+            release.wait(5)
+            processed.append(item)
+
+        worker = LatestWinsWorker(target)
+        worker.start()
+        worker.submit(1)
+        self.assertTrue(started.wait(2))
+        # the worker is busy with 1, these queue up behind it
+        worker.submit(2)
+        worker.submit(3)
+        worker.submit(4)
+        release.set()
+        self.assertTrue(worker.join_pending(5))
+        worker.stop(5)
+
+        self.assertEqual([1, 4], processed)
+        self.assertEqual(4, worker.submitted)
+        self.assertEqual(2, worker.replaced)
+
+    def test_merge(self):
+        processed = []
+        worker = LatestWinsWorker(processed.append,
+                                  merge=lambda pending, item: pending + item)
+        worker.submit([1])
+        worker.submit([2])
+        worker.submit([3])
+        worker.start()
+        worker.stop(5)
+        self.assertEqual([[1, 2, 3]], processed)
+
+    def test_submit_does_not_block(self):
+        release = threading.Event()
+        worker = LatestWinsWorker(lambda item: release.wait(5))
+        worker.start()
+        self.addCleanup(worker.stop, 5)
+        self.addCleanup(release.set)
+
+        start = time.monotonic()
+        for item in range(1000):
+            worker.submit(item)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_stop_runs_pending(self):
+        processed = []
+        worker = LatestWinsWorker(processed.append)
+        worker.submit('last')
+        worker.start()
+        worker.stop(5)
+        self.assertEqual(['last'], processed)
+
+
+class TestWorkerPool(TestCase):
+    def start_pool(self, size):
+        pool = WorkerPool(size=size)
+        pool.start()
+        self.addCleanup(pool.stop, 5)
+        return pool
+
+    def test_lanes_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=2)
+        processed = []
+
+        def target(item):
+            # only gets past the barrier if both lanes are running at once
+            barrier.wait()
+            processed.append(item)
+
+        pool = self.start_pool(2)
+        pool.worker('lirc0', target).submit('livingroom')
+        pool.worker('lirc1', target).submit('bedroom')
+
+        self.assertTrue(pool.join_pending(5))
+        self.assertEqual(['bedroom', 'livingroom'], sorted(processed))
+
+    def test_lane_is_serialised(self):
+        lock = threading.Lock()
+        overlapped = []
+        processed = []
+
+        def target(item):
+            if not lock.acquire(blocking=False):
+                overlapped.append(item)
+                return
+            time.sleep(0.02)
+            processed.append(item)
+            lock.release()
+
+        pool = self.start_pool(4)
+        workers = [pool.worker('lirc0', target) for _ in range(4)]
+        for index, worker in enumerate(workers):
+            worker.submit(index)
+
+        self.assertTrue(pool.join_pending(5))
+        self.assertEqual([], overlapped)
+        self.assertEqual([0, 1, 2, 3], processed)
+
+    def test_pending_item_is_replaced(self):
+        started = threading.Event()
+        release = threading.Event()
+        processed = []
+
+        def target(item):
+            started.set()
+            release.wait(5)
+            processed.append(item)
+
+        pool = self.start_pool(1)
+        worker = pool.worker('lirc0', target)
+        worker.submit(1)
+        self.assertTrue(started.wait(2))
+        worker.submit(2)
+        worker.submit(3)
+        release.set()
+        self.assertTrue(worker.join_pending(5))
+
+        self.assertEqual([1, 3], processed)
+        self.assertEqual(1, worker.replaced)
+
+    def test_merge(self):
+        processed = []
+        pool = WorkerPool(size=1)
+        worker = pool.worker('lirc0', processed.append,
+                             merge=lambda pending, item: pending + item)
+        worker.submit([1])
+        worker.submit([2])
+        pool.start()
+        pool.stop(5)
+        self.assertEqual([[1, 2]], processed)
+
+    def test_stop_runs_pending(self):
+        processed = []
+        pool = WorkerPool(size=2)
+        pool.worker('lirc0', processed.append).submit('last')
+        pool.start()
+        pool.stop(5)
+        self.assertEqual(['last'], processed)
@@ -0,0 +1,158 @@
+"""
+Correlation IDs and structured events, so a command can be followed from
+the MQTT message or HTTP request that caused it through the update, the
+save and the IR transmission
+
+Each inbound command runs inside traced(), which gives it an ID held in a
+context variable. The workers (see worker.py) run their items in the
+context they were submitted from, so the ID carries over to the persister
+and transmitter threads. event() and span() log to the 'daikin.events'
+logger with a monotonic timestamp, configure() sends that logger through a
+queue so formatting and writing happen on a listener thread, never on the
+hot path.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import logging
+import contextvars
+from contextlib import contextmanager
+
+# JSON lines are written here ('-' for stderr) when set
+TRACE_FILE = os.environ.get('TRACE_FILE')
+# events beyond this many waiting to be written are dropped
+TRACE_QUEUE_SIZE = int(os.environ.get('TRACE_QUEUE_SIZE', '10000'))
+
+events = logging.getLogger('daikin.events')
+
+correlation_id = contextvars.ContextVar('correlation_id', default=None)
+
+
+def new_id():
+    return os.urandom(8).hex()
+
+
+def current_id():
+    return correlation_id.get()
+
+
+@contextmanager
+def traced(id=None):
+    """
+    Runs the block under a correlation ID (a new one unless given), yields
+    the ID
+    """
+    token = correlation_id.set(id or new_id())
+    try:
+        yield correlation_id.get()
+    finally:
+        correlation_id.reset(token)
+
+
+def event(name, **fields):
+    """
+    Logs a structured event for the current correlation ID
+    """
+    if events.isEnabledFor(logging.INFO):
+        events.info(name,
+                    extra={
+                        'event': name,
+                        'correlation_id': correlation_id.get(),
+                        'monotonic': time.monotonic(),
+                        'fields': fields,
+                    })
+
+
+@contextmanager
+def span(name, **fields):
+    """
+    Logs an event when the block ends with its start and duration, and
+    whether it raised
+    """
+    if not events.isEnabledFor(logging.INFO):
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    except BaseException as e:
+        fields['error'] = repr(e)
+        raise
+    finally:
+        fields['start'] = start
+        fields['duration'] = time.monotonic() - start
+        event(name, **fields)
+
+
+class EventFormatter(logging.Formatter):
+    """
+        One JSON object per line
+    """
+
+    def format(self, record):
+        data = {
+            'time': record.created,
+            'monotonic': getattr(record, 'monotonic', None),
+            'event': getattr(record, 'event', record.getMessage()),
+            'id': getattr(record, 'correlation_id', None),
+            'thread': record.threadName,
+        }
+        data.update(getattr(record, 'fields', {}))
+        return json.dumps(data, default=_default, sort_keys=True)
+
+
+def _default(value):
+    # states are passed as they are and only turned into their key here, on
+    # the listener thread
+    key = getattr(value, 'key', None)
+    return key() if callable(key) else str(value)
+
+
+class DroppingQueueHandler(logging.Handler):
+    """
+        Puts records on a queue for a QueueListener, never blocks the caller,
+        events that don't fit in a full queue are counted and dropped
+
+        The listener formats, records go on the queue as they are
+    """
+
+    def __init__(self, queue):
+        super().__init__()
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure(path=TRACE_FILE, handler=None, maxsize=TRACE_QUEUE_SIZE):
+    """
+    Starts writing events to path (or a handler of your own) from a
+    listener thread, returns the listener to stop() on exit, or None when
+    there's nowhere to write them and tracing is switched off
+    """
+    if handler is None and not path:
+        # event() and span() return straight away instead of going through
+        # the root logger's handlers (eg. logging.basicConfig's stderr)
+        events.setLevel(logging.WARNING)
+        events.propagate = False
+        return None
+
+    # logging.handlers pulls in socket and more, only load it when tracing
+    from logging.handlers import QueueListener
+
+    if handler is None:
+        handler = (logging.StreamHandler(sys.stderr)
+                   if path == '-' else logging.FileHandler(path))
+        handler.setFormatter(EventFormatter())
+    listener = QueueListener(queue.Queue(maxsize), handler)
+    events.addHandler(DroppingQueueHandler(listener.queue))
+    events.setLevel(logging.INFO)
+    events.propagate = False
+    listener.start()
+    return listener
@@ -0,0 +1,254 @@
+import os
+import json
+from collections import OrderedDict
+import logging
+
+from .daikin import (DAIKIN_LIRC_MODE, DaikinController, create_lirc,
+                     data_file)
+from .metrics import QUEUE_DEPTH
+from .worker import CoalescingWorker, WorkerPool
+logger = logging.getLogger(__name__)
+
+# a JSON file listing the units, without one there's a single unit
+# configured from the environment like before
+DAIKIN_UNITS_FILE = os.environ.get('DAIKIN_UNITS_FILE',
+                                   data_file('units.json'))
+MQTT_TOPIC_PREFIX = os.environ.get('MQTT_TOPIC_PREFIX', 'livingroom/ac/')
+"""
+# Example units.json, two rooms on their own GPIO transmitters (the living
+# room with a receiver for its remote too, a third LIRC device) and a
+# third room sent through lircd's socket
+{
+    "units": [
+        {"name": "livingroom", "topic_prefix": "livingroom/ac/",
+         "mode": "device", "device": "/dev/lirc0",
+         "receiver": "/dev/lirc2"},
+        {"name": "bedroom", "topic_prefix": "bedroom/ac/",
+         "mode": "device", "device": "/dev/lirc1"},
+        {"name": "study", "topic_prefix": "study/ac/",
+         "mode": "codebook", "sender": "socket",
+         "remote": "daikin-study"}
+    ]
+}
+"""
+
+
+def default_unit_config():
+    """
+    The single unit the services ran before units were configurable
+    """
+    from .state_store import STATE_STORE_FILE
+    from .decoder import LIRC_RECEIVER_DEVICE
+    return {
+        'name': 'default',
+        'topic_prefix': MQTT_TOPIC_PREFIX,
+        'store_file': STATE_STORE_FILE,
+        'receiver': LIRC_RECEIVER_DEVICE,
+    }
+
+
+def load_unit_configs(path=None):
+    path = path or DAIKIN_UNITS_FILE
+    try:
+        with open(path) as units_file:
+            configs = json.load(units_file)['units']
+    except (IOError, OSError):
+        return [default_unit_config()]
+
+    for config in configs:
+        name = config['name']
+        config.setdefault('topic_prefix', '{}/ac/'.format(name))
+        config.setdefault('remote', 'daikin-{}'.format(name))
+        config.setdefault('storage_file', data_file('{}.json'.format(name)))
+        config.setdefault('store_file', data_file('{}.bin'.format(name)))
+    return configs
+
+
+def emitter_of(config):
+    """
+    What physically transmits for a unit, units with the same emitter have
+    to take turns
+    """
+    if config.get('emitter'):
+        return config['emitter']
+    if config.get('mode', DAIKIN_LIRC_MODE) == 'device':
+        from .lirc_device import LIRC_DEVICE
+        return config.get('device') or LIRC_DEVICE
+    # every remote on one lircd goes out through the same transmitter
+    from .lircd_client import LIRCD_SOCKET
+    return config.get('socket') or LIRCD_SOCKET
+
+
+class Unit:
+    """
+        One AC unit: its topics, its state and the emitter it is sent from
+    """
+
+    def __init__(self, name, topic_prefix, controller, emitter=None,
+                 receiver_device=None):
+        self.name = name
+        self.topic_prefix = topic_prefix
+        self.controller = controller
+        self.emitter = emitter
+        self.coalescer = None
+        # the LIRC device of an IR receiver that hears the unit's remote
+        self.receiver_device = receiver_device
+        self.receiver = None
+        # a home_assistant.StatePublisher when the MQTT service runs it
+        self.publisher = None
+        for queue in ('transmitter', 'persister'):
+            worker = getattr(controller, queue, None)
+            if worker is not None:
+                QUEUE_DEPTH.set_function(worker.depth, queue, name)
+
+    def attach_publisher(self, publisher):
+        self.publisher = publisher
+        self.controller.on_transmit = publisher.publish
+
+    def start_coalescing(self, window, max_delay):
+        self.coalescer = CoalescingWorker(
+            self.controller.update,
+            window=window,
+            max_delay=max_delay,
+            name='daikin-coalescer-{}'.format(self.name))
+        self.coalescer.start()
+        QUEUE_DEPTH.set_function(self.coalescer.depth, 'coalescer', self.name)
+
+    def start_receiving(self):
+        """
+        Follows the unit's own remote when it has a receiver
+        """
+        if not self.receiver_device:
+            return
+        from .decoder import Receiver
+        self.receiver = Receiver(self.receiver_device,
+                                 self.controller.sync,
+                                 name='daikin-receiver-{}'.format(self.name))
+        self.receiver.start()
+
+    def send(self, **values):
+        if self.coalescer is not None:
+            self.coalescer.submit(**values)
+        else:
+            self.controller.update(**values)
+
+    def stop(self, timeout=None):
+        if self.receiver is not None:
+            self.receiver.stop()
+        if self.coalescer is not None:
+            self.coalescer.stop(timeout)
+        self.controller.stop(timeout)
+
+
+def create_unit(config, pool=None, **controller_args):
+    emitter = emitter_of(config)
+    lirc = create_lirc(mode=config.get('mode'),
+                       sender=config.get('sender'),
+                       remote_name=config.get('remote'),
+                       device=config.get('device'),
+                       socket=config.get('socket'))
+    controller = DaikinController(storage_file=config.get('storage_file'),
+                                  store_file=config.get('store_file'),
+                                  lirc=lirc,
+                                  pool=pool,
+                                  emitter=emitter,
+                                  **controller_args)
+    return Unit(config['name'],
+                config['topic_prefix'],
+                controller,
+                emitter,
+                receiver_device=config.get('receiver'))
+
+
+class UnitRegistry:
+    """
+        The configured units, indexed by name and by topic prefix
+
+        Topic prefixes are kept in a tree keyed by topic level, so routing a
+        message walks its levels once however many units there are and the
+        longest matching prefix wins
+    """
+
+    UNIT = object()
+
+    def __init__(self, units=(), pool=None):
+        self.units = OrderedDict()
+        self.index = {}
+        self.pool = pool
+        for unit in units:
+            self.add(unit)
+
+    @classmethod
+    def load(cls, path=None, background=False, **controller_args):
+        """
+        Builds every unit in the units file, transmitting through a pool
+        with a thread per emitter when background is set
+        """
+        configs = load_unit_configs(path)
+        pool = None
+        if background:
+            emitters = set(emitter_of(config) for config in configs)
+            pool = WorkerPool(size=len(emitters), name='daikin-transmitter')
+            pool.start()
+        units = [
+            create_unit(config,
+                        pool=pool,
+                        background=background,
+                        **controller_args) for config in configs
+        ]
+        return cls(units, pool=pool)
+
+    def add(self, unit):
+        if unit.name in self.units:
+            raise ValueError('Duplicate unit {}'.format(unit.name))
+        node = self.index
+        for level in self._levels(unit.topic_prefix):
+            node = node.setdefault(level, {})
+        if self.UNIT in node:
+            raise ValueError('{} and {} share the topic prefix {}'.format(
+                node[self.UNIT].name, unit.name, unit.topic_prefix))
+        node[self.UNIT] = unit
+        self.units[unit.name] = unit
+
+    def get(self, name):
+        return self.units[name]
+
+    def __iter__(self):
+        return iter(self.units.values())
+
+    def __len__(self):
+        return len(self.units)
+
+    def default(self):
+        return next(iter(self))
+
+    def route(self, topic):
+        """
+        (unit, control) for a topic, eg. 'bedroom/ac/mode/set' gives the
+        bedroom unit and 'mode/set', (None, None) if no unit matches
+        """
+        levels = topic.split('/')
+        node = self.index
+        match = None
+        for depth, level in enumerate(levels):
+            node = node.get(level)
+            if node is None:
+                break
+            if self.UNIT in node:
+                match = depth + 1, node[self.UNIT]
+        if match is None:
+            return None, None
+        depth, unit = match
+        return unit, '/'.join(levels[depth:])
+
+    def subscriptions(self):
+        return ['{}#'.format(unit.topic_prefix) for unit in self]
+
+    def stop(self, timeout=None):
+        for unit in self:
+            unit.stop(timeout)
+        if self.pool is not None:
+            self.pool.stop(timeout)
+
+    def _levels(self, prefix):
+        return prefix.rstrip('/').split('/')
@@ -0,0 +1,329 @@
+import time
+import threading
+import contextvars
+from collections import OrderedDict, deque
+import logging
+
+from .tracing import current_id, event
+logger = logging.getLogger(__name__)
+
+
+class CoalescingWorker(threading.Thread):
+    """
+        Collects field updates and hands them to `target` as one merged
+        update once they stop arriving
+
+        An update is sent `window` seconds after the last one arrived, but
+        never more than `max_delay` seconds after the first pending one, so a
+        steady stream can't hold a transmission off forever. Later values for
+        the same field replace earlier ones. The merged update runs in the
+        context of the last submit, the correlation IDs of the others are
+        logged with it.
+    """
+
+    def __init__(self, target, window=0.1, max_delay=1.0, name=None):
+        super().__init__(name=name or 'daikin-coalescer')
+        self.daemon = True
+        self.target = target
+        self.window = window
+        self.max_delay = max_delay
+        self.pending = {}
+        self.context = None
+        self.merged_ids = []
+        self.first_update = None
+        self.last_update = None
+        self.stopping = False
+        self.condition = threading.Condition()
+
+    def submit(self, **values):
+        with self.condition:
+            now = time.monotonic()
+            if not self.pending:
+                self.first_update = now
+            self.last_update = now
+            self.pending.update(values)
+            self.context = contextvars.copy_context()
+            self.merged_ids.append(current_id())
+            self.condition.notify()
+
+    def depth(self):
+        """
+        Number of fields waiting to be sent
+        """
+        return len(self.pending)
+
+    def stop(self, timeout=None):
+        """
+        Sends anything still pending straight away and stops the thread
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.join(timeout)
+
+    def run(self):
+        while True:
+            taken = self._take()
+            if taken is None:
+                return
+            values, context, merged_ids = taken
+            context.run(self._send, values, merged_ids)
+
+    def _send(self, values, merged_ids):
+        event('coalesced', fields=sorted(values), merged=merged_ids)
+        try:
+            self.target(**values)
+        except Exception:
+            logger.exception('Failed to send update {}'.format(values))
+
+    def _take(self):
+        with self.condition:
+            while not self.pending and not self.stopping:
+                self.condition.wait()
+
+            while self.pending and not self.stopping:
+                deadline = min(self.last_update + self.window,
+                               self.first_update + self.max_delay)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            if not self.pending:
+                return None
+            taken = self.pending, self.context, self.merged_ids
+            self.pending, self.context, self.merged_ids = {}, None, []
+            return taken
+
+
+class LatestWinsWorker(threading.Thread):
+    """
+        Runs `target` on a background thread for the most recently submitted
+        item
+
+        Only one item is ever pending, submitting while one is waiting
+        replaces it, so a slow target (IR transmission, disk writes) works
+        through the latest target state rather than a backlog of stale ones.
+        submit never blocks, the target runs in the submitter's context
+        (eg. its correlation ID).
+
+        With an interval, runs are spaced at least that many seconds apart
+        and everything submitted in between collapses into one run (eg.
+        batching disk writes), stop() skips the wait.
+    """
+
+    def __init__(self, target, name=None, interval=0, merge=None):
+        """
+        merge: called with the pending item and a new one replacing it,
+        returns the item to keep (the new one when not given)
+        """
+        super().__init__(name=name or 'daikin-worker')
+        self.daemon = True
+        self.target = target
+        self.interval = interval
+        self.merge = merge
+        self.last_run = None
+        self.pending = None
+        self.context = None
+        self.has_pending = False
+        self.busy = False
+        self.stopping = False
+        self.submitted = 0
+        self.replaced = 0
+        self.condition = threading.Condition()
+
+    def submit(self, item):
+        with self.condition:
+            if self.has_pending:
+                self.replaced += 1
+                if self.merge is not None:
+                    item = self.merge(self.pending, item)
+            self.pending = item
+            self.context = contextvars.copy_context()
+            self.has_pending = True
+            self.submitted += 1
+            self.condition.notify_all()
+
+    def depth(self):
+        return int(self.has_pending)
+
+    def join_pending(self, timeout=None):
+        """
+        Waits until nothing is pending or running, returns False on timeout
+        """
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: not self.has_pending and not self.busy, timeout)
+
+    def stop(self, timeout=None):
+        """
+        Lets the pending item run and stops the thread
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.join(timeout)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.has_pending and not self.stopping:
+                    self.condition.wait()
+                if not self.has_pending:
+                    return
+                while self.last_run is not None and not self.stopping:
+                    due = self.last_run + self.interval
+                    remaining = due - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                item, self.pending = self.pending, None
+                context, self.context = self.context, None
+                self.has_pending = False
+                self.busy = True
+
+            try:
+                context.run(self.target, item)
+            except Exception:
+                logger.exception('{} failed'.format(self.name))
+            finally:
+                with self.condition:
+                    self.last_run = time.monotonic()
+                    self.busy = False
+                    self.condition.notify_all()
+
+
+class WorkerPool:
+    """
+        A fixed set of threads shared by many latest-wins workers
+
+        Every worker belongs to a lane. Workers in different lanes run
+        concurrently, workers in the same lane (eg. units sharing an IR
+        emitter) take turns one item at a time in the order they became
+        pending. Like LatestWinsWorker each worker only ever has one pending
+        item and submitting replaces it.
+    """
+
+    def __init__(self, size=4, name=None):
+        self.size = size
+        self.name = name or 'daikin-pool'
+        self.lanes = {}
+        self.ready = deque()
+        self.busy = set()
+        self.stopping = False
+        self.threads = []
+        self.condition = threading.Condition()
+
+    def worker(self, lane, target, name=None, merge=None):
+        return PooledWorker(self, lane, target, name, merge)
+
+    def start(self):
+        for index in range(self.size):
+            thread = threading.Thread(target=self._run,
+                                      name='{}-{}'.format(self.name, index))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def depth(self):
+        """
+        Items waiting across all lanes
+        """
+        with self.condition:
+            return sum(len(pending) for pending in self.lanes.values())
+
+    def join_pending(self, timeout=None):
+        """
+        Waits until nothing is pending or running in any lane
+        """
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: not self.ready and not self.busy, timeout)
+
+    def stop(self, timeout=None):
+        """
+        Lets everything pending run and stops the threads
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def _submit(self, worker, item):
+        with self.condition:
+            pending = self.lanes.setdefault(worker.lane, OrderedDict())
+            if worker in pending:
+                worker.replaced += 1
+                if worker.merge is not None:
+                    item = worker.merge(pending[worker][0], item)
+            pending[worker] = (item, contextvars.copy_context())
+            worker.submitted += 1
+            if worker.lane not in self.busy and worker.lane not in self.ready:
+                self.ready.append(worker.lane)
+            self.condition.notify_all()
+
+    def _is_idle(self, worker):
+        return (not worker.busy
+                and worker not in self.lanes.get(worker.lane, ()))
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.ready and not self.stopping:
+                    self.condition.wait()
+                if not self.ready:
+                    return
+                lane = self.ready.popleft()
+                worker, (item, context) = self.lanes[lane].popitem(
+                    last=False)
+                if not self.lanes[lane]:
+                    del self.lanes[lane]
+                self.busy.add(lane)
+                worker.busy = True
+
+            try:
+                context.run(worker.target, item)
+            except Exception:
+                logger.exception('{} failed'.format(worker.name))
+            finally:
+                with self.condition:
+                    worker.busy = False
+                    worker.last_run = time.monotonic()
+                    self.busy.discard(lane)
+                    if lane in self.lanes:
+                        self.ready.append(lane)
+                    self.condition.notify_all()
+
+
+class PooledWorker:
+    """
+        A LatestWinsWorker lookalike whose runs happen on a WorkerPool,
+        stopping it only waits for its own items, the pool's owner stops
+        the pool
+    """
+
+    def __init__(self, pool, lane, target, name=None, merge=None):
+        self.pool = pool
+        self.lane = lane
+        self.target = target
+        self.name = name or '{}-{}'.format(pool.name, lane)
+        self.merge = merge
+        self.busy = False
+        self.last_run = None
+        self.submitted = 0
+        self.replaced = 0
+
+    def submit(self, item):
+        self.pool._submit(self, item)
+
+    def depth(self):
+        return int(self in self.pool.lanes.get(self.lane, ()))
+
+    def join_pending(self, timeout=None):
+        with self.pool.condition:
+            return self.pool.condition.wait_for(
+                lambda: self.pool._is_idle(self), timeout)
+
+    def stop(self, timeout=None):
+        self.join_pending(timeout)
@@ -1,3 +1,3 @@
 #!/bin/bash
 
-tmux new-session -d -s daikin-pi '/root/.venvs/daikin/bin/python /home/pi/daikin-pi/daikin/mqtt_service.py'
+tmux new-session -d -s daikin-pi 'cd /home/pi/daikin-pi && /root/.venvs/daikin/bin/python -m daikin.service'
@@ -8,7 +8,22 @@ setup(
     author='Danny Shaw',
     author_email='code@dannyshaw.io',
     license='MIT',
-    packages=['daikin-pi'],
+    packages=['daikin'],
+    # the list of MQTT topics seen so far starts from this one
+    package_data={'daikin': ['topics']},
+    python_requires='>=3.7',
+    install_requires=[
+        'Flask>=1.1',
+        # the service uses paho's 1.x callback signatures
+        'paho-mqtt>=1.5,<2',
+    ],
+    extras_require={
+        # building the frame table and the batch decoder
+        'numpy': ['numpy'],
+    },
+    entry_points={
+        'console_scripts': ['daikin = daikin.cli:main'],
+    },
     zip_safe=False,
     test_suite='nose.collector',
     tests_require=['nose'],